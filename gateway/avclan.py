@@ -0,0 +1,949 @@
+"""
+AVC-LAN (IEBus) Frame Decoder / Encoder
+=======================================
+
+Word-level field extraction for frames captured by the `avclan_rx_framed`
+PIO program. The PIO shifts bits in MSB-first and autopushes 32-bit words,
+so frame bit N lives at bit (31 - N % 32) of word N // 32.
+
+Frame layout (bits):
+    master(12) P | slave(12) P | control(4) P | length(8) P | data(8) P * length
+
+Every field is read with at most two word shift/mask operations instead of
+one division/modulo/shift per bit, and each field is fetched together with
+its parity bit so validation is a single table lookup.
+
+The encoder packs whole parity-extended fields into 32-bit words for the
+`avclan_tx` PIO program and caches the result per frame.
+
+Pure Python, no hardware imports: runs on the RP2040 and on a host PC
+(see test-bench/bench_avclan_decode.py).
+"""
+
+import array
+
+try:
+    from ubinascii import unhexlify
+except ImportError:
+    from binascii import unhexlify
+
+MAX_DATA_LEN = 32       # Longest payload we accept (IEBus mode 2 limit)
+HEADER_BITS = 40        # master+P, slave+P, control+P, length+P
+BYTE_BITS = 9           # 8 data bits + parity
+MAX_FRAME_BITS = HEADER_BITS + MAX_DATA_LEN * BYTE_BITS     # 328
+
+# ============================================================================
+# PARITY TABLE
+# ============================================================================
+# AVC-LAN uses odd parity: a field is valid when popcount(field) + P is odd.
+# Popcount does not depend on field width, so one 12-bit table serves the
+# 4-bit control, 8-bit length/data and 12-bit address fields alike.
+# PARITY_ODD[v] = 1 if popcount(v) is odd (the bit needed to make it even).
+
+def _build_parity_table(bits):
+    table = bytearray(1 << bits)
+    for v in range(1, 1 << bits):
+        table[v] = table[v >> 1] ^ (v & 1)
+    return table
+
+PARITY_ODD = _build_parity_table(12)
+
+def parity_bit(val):
+    """Parity bit to transmit after `val` (up to 12 bits)."""
+    return PARITY_ODD[val] ^ 1
+
+# ============================================================================
+# FIELD EXTRACTION
+# ============================================================================
+
+def get_bits(buf, pos, width):
+    """
+    Read `width` bits (1-32) starting at bit offset `pos`.
+
+    Touches at most two words: the one holding the first bit and, if the
+    field straddles a word boundary, the next one. Caller guarantees that
+    both words are inside the valid part of `buf`.
+    """
+    idx = pos >> 5
+    end = (pos & 31) + width
+    mask = (1 << width) - 1
+    if end <= 32:
+        return (buf[idx] >> (32 - end)) & mask
+    return ((buf[idx] << (end - 32)) | (buf[idx + 1] >> (64 - end))) & mask
+
+def decode_header(buf, ptr):
+    """
+    Validate the 40-bit header at `ptr`.
+
+    Each field is pulled together with its trailing parity bit; the field
+    is valid when the combined popcount is odd. Caller guarantees that
+    HEADER_BITS bits are available.
+
+    Returns:
+        (m, s, c, length) or None if a parity check or the length limit fails
+    """
+    v = get_bits(buf, ptr, 13)
+    m = v >> 1
+    if not (PARITY_ODD[m] ^ (v & 1)): return None
+
+    v = get_bits(buf, ptr + 13, 13)
+    s = v >> 1
+    if not (PARITY_ODD[s] ^ (v & 1)): return None
+
+    v = get_bits(buf, ptr + 26, 5)
+    c = v >> 1
+    if not (PARITY_ODD[c] ^ (v & 1)): return None
+
+    v = get_bits(buf, ptr + 31, 9)
+    l = v >> 1
+    if not (PARITY_ODD[l] ^ (v & 1)): return None
+
+    if l > MAX_DATA_LEN: return None
+    return (m, s, c, l)
+
+def header_fault(buf, ptr):
+    """
+    Which header check fails at `ptr` (slow path, for telemetry only).
+
+    Returns:
+        0 master parity, 1 slave parity, 2 control parity, 3 length parity,
+        4 length > MAX_DATA_LEN, or -1 if the header is valid
+    """
+    for i, (off, width) in enumerate(((0, 13), (13, 13), (26, 5), (31, 9))):
+        v = get_bits(buf, ptr + off, width)
+        if not (PARITY_ODD[v >> 1] ^ (v & 1)): return i
+    if (get_bits(buf, ptr + 31, 9) >> 1) > MAX_DATA_LEN: return 4
+    return -1
+
+def read_data(buf, ptr, length):
+    """Read `length` data bytes (each followed by a parity bit) starting at `ptr`."""
+    data = bytearray(length)
+    for i in range(length):
+        data[i] = get_bits(buf, ptr, 8)
+        ptr += BYTE_BITS
+    return bytes(data)
+
+def try_decode(buf, ptr, total_bits):
+    """
+    Decode one frame starting exactly at bit `ptr`.
+
+    Args:
+        buf: array('I') of captured words
+        ptr: bit offset of the first master address bit
+        total_bits: number of valid bits in `buf`
+
+    Returns:
+        (m, s, c, data_bytes, bit_len) or None if parity/length fails or the
+        frame does not fit into `total_bits`.
+    """
+    if ptr + HEADER_BITS > total_bits: return None
+    hdr = decode_header(buf, ptr)
+    if not hdr: return None
+    m, s, c, l = hdr
+
+    bit_len = HEADER_BITS + l * BYTE_BITS
+    if ptr + bit_len > total_bits: return None
+
+    return (m, s, c, read_data(buf, ptr + HEADER_BITS, l), bit_len)
+
+def decode_smart(buf, ptr, total_bits):
+    """
+    Decode at `ptr`, falling back to a +1 bit shift rescue.
+
+    Transceiver latency occasionally makes the PIO sample one bit late at
+    the start of a frame; retrying at ptr+1 recovers those frames.
+
+    Returns:
+        ((m, s, c, data_bytes), bits_consumed) or (None, 0)
+    """
+    res = try_decode(buf, ptr, total_bits)
+    if res:
+        return res[:4], res[4]
+
+    res = try_decode(buf, ptr + 1, total_bits)
+    if res:
+        # +1 so the caller's pointer skips the shifted-in bit as well
+        return res[:4], res[4] + 1
+
+    return None, 0
+
+# ============================================================================
+# RESYNC PRE-FILTER
+# ============================================================================
+# After a corrupted frame the decoder has to find the next frame start bit by
+# bit. Running decode_header() with the +1 rescue at every offset tests each
+# offset twice and builds a tuple per attempt; next_candidate() walks the
+# offsets with the cheapest checks first and returns only those worth a full
+# decode. Shift +1 needs no separate attempt here: it is simply the next
+# offset of the walk.
+
+# IEBus defines control codes 0,3,4,5,6,7,A,B,E,F; 1,2,8,9,C,D never appear
+CONTROL_MASK_IEBUS = 0xCCF9
+
+def next_candidate(buf, ptr, end, control_mask=CONTROL_MASK_IEBUS):
+    """
+    First offset in [ptr, end - HEADER_BITS] with a plausible header.
+
+    Plausible: master and slave parity valid, control code allowed by
+    `control_mask` (bit c set), length <= MAX_DATA_LEN, control and length
+    parity valid.
+
+    Returns:
+        bit offset, or -1 if no offset in the window qualifies
+    """
+    par = PARITY_ODD
+    last = end - HEADER_BITS
+    while ptr <= last:
+        v = get_bits(buf, ptr, 13)
+        if par[v >> 1] ^ (v & 1):
+            v = get_bits(buf, ptr + 13, 13)
+            if par[v >> 1] ^ (v & 1):
+                v = get_bits(buf, ptr + 26, 14)     # control+P, length+P
+                c = v >> 10
+                l = (v >> 1) & 0xFF
+                if ((control_mask >> c) & 1) and l <= MAX_DATA_LEN:
+                    if (par[c] ^ ((v >> 9) & 1)) and (par[l] ^ (v & 1)):
+                        return ptr
+        ptr += 1
+    return -1
+
+# ============================================================================
+# STREAMING DECODER
+# ============================================================================
+# Framed capture: at the end of every frame the PIO pushes the partial last
+# word (valid bits right-aligned, possibly none) followed by a trailer word
+# holding ~bit_count. A trailer is recognised by its 0xFFFF tag, but data
+# words of 0xFF payload bytes (0xFFFFxxxx) carry the tag as well, so a
+# tagged word is only accepted when
+#   - the number of words seen since the previous trailer equals the word
+#     count its bit count implies,
+#   - the word before it (the partial push) is zero above the valid bits,
+#   - the header at the start of the frame decodes and its length field
+#     gives exactly that bit count (one more for a leading glitch bit).
+# The first two words of a frame are copied aside as they arrive, since the
+# open region may decode the frame and compact it away before its trailer.
+# After a trailer was lost (captured words dropped) the count no longer
+# matches; a tagged word is then accepted only if the word just before the
+# frame it describes was a trailer candidate itself (the lost frame's
+# successor, stored as data), and the words in between become a resync
+# region.
+
+TRAILER_TAG = 0xFFFF
+
+class StreamDecoder:
+    """
+    Resumable AVC-LAN decoder fed one PIO word at a time.
+
+    Keeps its bit pointer across main loop iterations and emits each frame
+    as soon as the length field says all of its bits have arrived, instead
+    of waiting for bus silence and scanning the whole buffer in one pass.
+    Consumed words are compacted away, so sustained back-to-back traffic
+    never fills the buffer as long as the loop keeps up.
+
+    With `framed=True` the PIO trailer words split the stream into regions
+    that each start on a word boundary, so decoding starts at the known
+    frame offset. The resync scan only runs inside a region whose first
+    decode attempt (shift 0 and +1) failed, and even then full decodes are
+    limited to the offsets next_candidate() lets through.
+
+    last_skipped / last_tried describe the resync effort spent before the
+    most recently returned frame: offsets rejected by the pre-filter and
+    offsets that went through a full decode attempt.
+
+    Health counters (cumulative): frames, rescues (+1 shift hits), dropped
+    words, and header_faults[] indexed like header_fault() for first decode
+    attempts that failed.
+    """
+
+    def __init__(self, size=512, framed=False, max_marks=32):
+        self.size = size
+        self.framed = framed
+        self.buf = array.array('I', [0] * size)
+        self._mv = memoryview(self.buf)
+        self.count = 0      # Words held in buf
+        self.ptr = 0        # Bit offset of the next frame candidate
+        self.dropped = 0    # Words lost because buf was full
+
+        # Closed region ends (bit offsets into buf), oldest first
+        self._marks = array.array('i', [0] * max_marks)
+        self._mark_n = 0
+        self._frame_words = 0   # Words stored since the last trailer
+        self._head = array.array('I', [0, 0])   # First two words since the last trailer
+        self._tag_pos = -1                      # Word index of the last unaccepted trailer candidate
+        self._tag_head = array.array('I', [0, 0])   # First two words after it
+        self._hw = array.array('I', [0, 0])     # Header words of a trailer candidate
+        self.frames_marked = 0  # Trailers accepted
+        self.resyncs = 0        # Trailers that also closed an unterminated region
+
+        # Resync pre-filter
+        self.control_mask = CONTROL_MASK_IEBUS
+        self._resync = False    # First attempt at the current offset failed
+        self._skipped = 0
+        self._tried = 0
+        self.last_skipped = 0
+        self.last_tried = 0
+
+        # Health counters
+        self.frames = 0
+        self.rescues = 0
+        self.header_faults = array.array('I', [0] * 5)
+
+    def feed(self, word):
+        """Append one captured word. Returns False if it had to be dropped."""
+        if self.framed and (word >> 16) == TRAILER_TAG:
+            nbits = 0xFFFFFFFF - word
+            need = (nbits >> 5) + 1
+            fw = self._frame_words
+            if (HEADER_BITS <= nbits <= MAX_FRAME_BITS + 1 and need <= fw
+                    and not self.buf[self.count - 1] >> (nbits & 31)):
+                if need == fw:
+                    head = self._head
+                elif fw - need - 1 == self._tag_pos:
+                    head = self._tag_head   # Frame follows an unaccepted trailer
+                else:
+                    head = None
+                if head and self._header_fits(head, nbits, need):
+                    self._close_frame(nbits, need)
+                    return True
+                self._tag_pos = fw
+        if self.count >= self.size:
+            self.compact()
+            if self.count >= self.size:
+                self.dropped += 1
+                return False
+        self.buf[self.count] = word
+        self.count += 1
+        # The first words of a frame are kept apart: they may be decoded and
+        # compacted away before the frame's trailer arrives
+        fw = self._frame_words
+        if fw < 2:
+            self._head[fw] = word
+        k = fw - self._tag_pos - 1
+        if 0 <= k < 2:
+            self._tag_head[k] = word
+        self._frame_words = fw + 1
+        return True
+
+    def _header_fits(self, head, nbits, need):
+        """True if `head` (first two words of the frame) holds a header whose length gives nbits."""
+        hw = self._hw
+        hw[0] = head[0]
+        w = head[1]
+        if need == 2:
+            # Second word is the partial push: left-align its valid bits
+            w = (w << (32 - (nbits & 31))) & 0xFFFFFFFF
+        hw[1] = w
+        h = decode_header(hw, 0)
+        if h and nbits == HEADER_BITS + h[3] * BYTE_BITS:
+            return True
+        # Frame captured with one leading glitch bit (the +1 rescue shift)
+        h = decode_header(hw, 1)
+        return h is not None and nbits == HEADER_BITS + 1 + h[3] * BYTE_BITS
+
+    def in_frame(self):
+        """True while words of a frame whose trailer has not arrived are held."""
+        return self._frame_words > 0
+
+    def _close_frame(self, nbits, need):
+        start = self.count - need
+        if self._frame_words > need:
+            # Previous trailer was lost: words before this frame form a
+            # region of their own that can only be brute-force scanned.
+            self._push_mark(start << 5)
+            self.resyncs += 1
+        rem = nbits & 31
+        if rem:
+            last = self.count - 1
+            self.buf[last] = (self.buf[last] << (32 - rem)) & 0xFFFFFFFF
+        else:
+            self.count -= 1     # Empty push: frame ended on a word boundary
+        self._push_mark((start << 5) + nbits)
+        self._frame_words = 0
+        self._tag_pos = -1
+        self.frames_marked += 1
+
+    def _push_mark(self, bit_pos):
+        # Below 0 when the words were compacted away (decoded before the
+        # trailer came): what is left starts at the front of buf
+        if self._mark_n < len(self._marks):
+            self._marks[self._mark_n] = bit_pos if bit_pos > 0 else 0
+            self._mark_n += 1
+
+    def _pop_mark(self):
+        marks = self._marks
+        n = self._mark_n - 1
+        for i in range(n):
+            marks[i] = marks[i + 1]
+        self._mark_n = n
+
+    def compact(self):
+        """Drop fully consumed words from the front of buf."""
+        words = self.ptr >> 5
+        if words == 0: return
+        keep = self.count - words
+        if keep > 0:
+            self._mv[0:keep] = self._mv[words:self.count]
+        self.count = keep if keep > 0 else 0
+        bits = words << 5
+        self.ptr -= bits
+        for i in range(self._mark_n):
+            self._marks[i] -= bits
+
+    def _scan(self, ptr, end, closed):
+        # Returns (frame, new_ptr). In an open region an incomplete frame
+        # stops the scan (its bits are still in flight); in a closed region
+        # it can never complete, so the scan moves on.
+        buf = self.buf
+        while ptr + HEADER_BITS <= end:
+            shift = 0
+            if self._resync:
+                cand = next_candidate(buf, ptr, end, self.control_mask)
+                if cand < 0:
+                    # Every offset whose header bits are all present failed
+                    last = end - HEADER_BITS + 1
+                    self._skipped += last - ptr
+                    ptr = last
+                    break
+                self._skipped += cand - ptr
+                ptr = cand
+                self._tried += 1
+                hdr = decode_header(buf, ptr)
+            else:
+                # 1. Normal attempt (Shift = 0), 2. Rescue attempt (Shift = +1)
+                self._tried += 1
+                hdr = decode_header(buf, ptr)
+                if not hdr:
+                    self.header_faults[header_fault(buf, ptr)] += 1
+                    if ptr + HEADER_BITS + 1 > end:
+                        if not closed: break
+                        self._resync = True
+                        ptr += 1
+                        continue
+                    shift = 1
+                    self._tried += 1
+                    hdr = decode_header(buf, ptr + 1)
+                    if not hdr:
+                        # Offsets ptr and ptr+1 are both done; walk from ptr+2
+                        self._resync = True
+                        ptr += 2
+                        continue
+
+            m, s, c, l = hdr
+            start = ptr + shift + HEADER_BITS
+            stop = start + l * BYTE_BITS
+            if stop > end:
+                if not closed: break
+                self._resync = True
+                ptr += shift + 1
+                continue
+
+            self.frames += 1
+            if shift: self.rescues += 1
+            self.last_skipped = self._skipped
+            self.last_tried = self._tried
+            self._skipped = 0
+            self._tried = 0
+            self._resync = False
+            return (m, s, c, read_data(buf, start, l)), stop
+        return None, ptr
+
+    def next_frame(self, flush=False):
+        """
+        Decode the next complete frame.
+
+        Args:
+            flush: bus has gone idle; a frame that is still incomplete will
+                   never finish, so treat it as garbage and keep scanning.
+
+        Returns:
+            (m, s, c, data_bytes) or None if more bits are needed
+        """
+        ptr = self.ptr
+        while True:
+            if self._mark_n:
+                frame, ptr = self._scan(ptr, self._marks[0], True)
+                if frame: break
+                # Region exhausted: next frame starts on the following word
+                ptr = (self._marks[0] + 31) & ~31
+                self._pop_mark()
+                self._resync = False
+                continue
+
+            end = self.count << 5
+            if self.framed and not flush:
+                end -= 32   # Newest word may be a partial push awaiting its trailer
+            frame, ptr = self._scan(ptr, end, flush)
+            if flush and frame is None:
+                # Idle bus and nothing decodable left: discard the tail
+                self.count = 0
+                self._frame_words = 0
+                self._tag_pos = -1
+                self._resync = False
+                ptr = 0
+            break
+
+        self.ptr = ptr
+        self.compact()
+        return frame
+
+# ============================================================================
+# ADDRESS FILTER
+# ============================================================================
+
+class AddressFilter:
+    """
+    First-match allow/deny rules on (master, slave) addresses.
+
+    A rule matches when (m & m_mask) == (rule_m & m_mask) and likewise for
+    the slave address; a zero mask is a wildcard. Frames that match no rule
+    get the default policy. Rules are kept in flat arrays so a check is a
+    handful of integer operations per rule.
+    """
+
+    def __init__(self, max_rules=8):
+        self.max_rules = max_rules
+        self.value = array.array('I', [0] * max_rules)  # (m << 12 | s) & mask
+        self.mask = array.array('I', [0] * max_rules)   # m_mask << 12 | s_mask
+        self.allow = bytearray(max_rules)
+        self.hits = array.array('I', [0] * max_rules)
+        self.n = 0
+        self.default_allow = True
+        self.default_hits = 0
+
+    def clear(self):
+        self.n = 0
+        self.default_allow = True
+        self.default_hits = 0
+
+    def add(self, allow, m, m_mask, s, s_mask):
+        """Append a rule. Returns False if the table is full."""
+        if self.n >= self.max_rules: return False
+        i = self.n
+        mask = ((m_mask & 0xFFF) << 12) | (s_mask & 0xFFF)
+        self.mask[i] = mask
+        self.value[i] = ((m << 12) | s) & mask
+        self.allow[i] = 1 if allow else 0
+        self.hits[i] = 0
+        self.n = i + 1
+        return True
+
+    def accept(self, m, s):
+        """True if a frame from master `m` to slave `s` should be forwarded."""
+        key = (m << 12) | s
+        mask = self.mask
+        value = self.value
+        for i in range(self.n):
+            if key & mask[i] == value[i]:
+                self.hits[i] += 1
+                return self.allow[i] == 1
+        self.default_hits += 1
+        return self.default_allow
+
+# ============================================================================
+# DEVICE STATE CACHE
+# ============================================================================
+
+class StateCache:
+    """
+    Latest frame per (master, slave, first data byte).
+
+    Fixed-size open-addressing table (linear probing) in preallocated
+    arrays, so an update is a hash and usually a single compare. When the
+    table is full a new key replaces the least recently updated entry on
+    its probe path. Frames without data use -1 as the first byte.
+
+    Entries are stamped with a time since boot that does not wrap, as
+    (seconds, microseconds) from timebase.Clock, so the oldest entry is
+    simply the smallest stamp. `evicted` counts since the last clear().
+    """
+
+    def __init__(self, size=64):
+        self.size = size                                # Must be a power of two
+        self.addr = array.array('i', [-1] * size)       # m << 12 | s, -1 = empty
+        self.op = array.array('h', [0] * size)
+        self.ctrl = bytearray(size)
+        self.ts_s = array.array('I', [0] * size)
+        self.ts_us = array.array('I', [0] * size)
+        self.data = [b''] * size
+        self.n = 0
+        self.evicted = 0
+
+    def clear(self):
+        for i in range(self.size):
+            self.addr[i] = -1
+            self.data[i] = b''
+        self.n = 0
+        self.evicted = 0
+
+    def update(self, sec, us, m, s, c, data):
+        addr = (m << 12) | s
+        op = data[0] if data else -1
+        mask = self.size - 1
+        i = ((addr ^ (addr >> 12)) * 31 + op) & mask
+        ts_s = self.ts_s
+        ts_us = self.ts_us
+        oldest = -1
+        for _ in range(self.size):
+            a = self.addr[i]
+            if a == addr and self.op[i] == op:
+                break
+            if a < 0:
+                self.n += 1
+                break
+            if oldest < 0 or ts_s[i] < ts_s[oldest] or (ts_s[i] == ts_s[oldest] and ts_us[i] < ts_us[oldest]):
+                oldest = i
+            i = (i + 1) & mask
+        else:
+            i = oldest
+            self.evicted += 1
+        self.addr[i] = addr
+        self.op[i] = op
+        self.ctrl[i] = c
+        ts_s[i] = sec
+        ts_us[i] = us
+        self.data[i] = data
+
+    def entry(self, i):
+        """(sec, us, m, s, c, data) of slot i, or None if it is empty."""
+        a = self.addr[i]
+        if a < 0:
+            return None
+        return (self.ts_s[i], self.ts_us[i], a >> 12, a & 0xFFF, self.ctrl[i], self.data[i])
+
+    def entries(self):
+        """Yield (sec, us, m, s, c, data) for every cached frame."""
+        for i in range(self.size):
+            e = self.entry(i)
+            if e:
+                yield e
+
+# ============================================================================
+# TRANSMIT QUEUE
+# ============================================================================
+
+class TxQueue:
+    """
+    Bounded FIFO of pre-encoded frames (word arrays for the TX PIO).
+
+    The caller hands words of the head frame to the state machine as FIFO
+    room appears and advances `pos`; pop() retires the frame once its
+    outcome is known, rewind() puts it back for another attempt. Enqueue
+    times (ticks_us) are kept per slot so the drain side can measure
+    queueing latency, along with the (m, s, c, data) tuple the loopback
+    check compares against and the retries spent so far.
+    """
+
+    def __init__(self, slots=8):
+        self.slots = slots
+        self.frames = [None] * slots
+        self.ts = array.array('I', [0] * slots)     # Enqueue time (ticks_us)
+        self.meta = [None] * slots                  # (m, s, c, data) expected back
+        self.tag = bytearray(slots)                 # Producer: 0 = host, else responder rule + 1
+        self.retries = bytearray(slots)
+        self.head = 0
+        self.n = 0
+        self.pos = 0        # Words of the head frame already handed out
+        self.hwm = 0        # Deepest queue seen
+        self.dropped = 0    # Frames rejected because the queue was full
+        self.sent = 0       # Frames confirmed on the bus (or sent unchecked)
+        self.failed = 0     # Frames given up after the last retry
+        self.retried = 0    # Repeat attempts
+
+    def push(self, words, ts, frame=None, tag=0):
+        """Queue one encoded frame. Returns False if the queue is full."""
+        if self.n >= self.slots:
+            self.dropped += 1
+            return False
+        i = (self.head + self.n) % self.slots
+        self.frames[i] = words
+        self.ts[i] = ts
+        self.meta[i] = frame
+        self.tag[i] = tag
+        self.retries[i] = 0
+        self.n += 1
+        if self.n > self.hwm: self.hwm = self.n
+        return True
+
+    def peek(self):
+        return self.frames[self.head] if self.n else None
+
+    def rewind(self):
+        """Send the head frame again from its first word."""
+        self.retries[self.head] += 1
+        self.retried += 1
+        self.pos = 0
+
+    def pop(self, ok=True):
+        self.frames[self.head] = None
+        self.meta[self.head] = None
+        self.head = (self.head + 1) % self.slots
+        self.n -= 1
+        self.pos = 0
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+# ============================================================================
+# FRAME ENCODER
+# ============================================================================
+
+def _pack(out, acc, fill, val, width):
+    """Append `width` bits of `val` to the accumulator, flushing full words."""
+    room = 32 - fill
+    if width < room:
+        return (acc << width) | val, fill + width
+    rest = width - room
+    out.append((acc << room) | (val >> rest))
+    return val & ((1 << rest) - 1), rest
+
+def encode_frame(m, s, c, data):
+    """
+    Encode a frame into 32-bit words for the TX PIO.
+
+    The first word is the frame length in bits minus one (the PIO bit
+    counter), followed by the frame bits MSB-first. Each field is packed
+    together with its parity bit (one table lookup) in a single shift/or,
+    instead of one Python iteration per bit. The last word is left-aligned,
+    unused bits are zero and never sent.
+    """
+    out = array.array('I', [HEADER_BITS + BYTE_BITS * len(data) - 1])
+    acc, fill = _pack(out, 0, 0, (m << 1) | (PARITY_ODD[m] ^ 1), 13)
+    acc, fill = _pack(out, acc, fill, (s << 1) | (PARITY_ODD[s] ^ 1), 13)
+    acc, fill = _pack(out, acc, fill, (c << 1) | (PARITY_ODD[c] ^ 1), 5)
+    n = len(data)
+    acc, fill = _pack(out, acc, fill, (n << 1) | (PARITY_ODD[n] ^ 1), 9)
+    for b in data:
+        acc, fill = _pack(out, acc, fill, (b << 1) | (PARITY_ODD[b] ^ 1), 9)
+    if fill:
+        out.append(acc << (32 - fill))
+    return out
+
+def parse_payload(d):
+    """
+    Data bytes from a TX command: an array of hex strings (["01","FF"]) or
+    one compact hex string ("01FF"). Raises ValueError on bad input.
+    """
+    if isinstance(d, str):
+        data = unhexlify(d)
+    else:
+        data = bytes([int(x, 16) for x in d])
+    if len(data) > MAX_DATA_LEN:
+        raise ValueError("payload too long")
+    return data
+
+class FrameEncoder:
+    """
+    encode_frame() behind a small LRU cache keyed by (m, s, c, data).
+
+    The host resends the same button and mode frames over and over, so a
+    hit returns the already packed words. Entries carry a use stamp; when
+    the cache is full the least recently used one is replaced.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self._cache = {}    # key -> [words, stamp]
+        self._stamp = 0
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, m, s, c, data):
+        self._stamp += 1
+        key = (m, s, c, data)
+        entry = self._cache.get(key)
+        if entry:
+            entry[1] = self._stamp
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        words = encode_frame(m, s, c, data)
+        cache = self._cache
+        if len(cache) >= self.size:
+            oldest = None
+            oldest_stamp = self._stamp
+            for k in cache:
+                if cache[k][1] < oldest_stamp:
+                    oldest_stamp = cache[k][1]
+                    oldest = k
+            del cache[oldest]
+        cache[key] = [words, self._stamp]
+        return words
+
+# ============================================================================
+# DEVICE EMULATION
+# ============================================================================
+
+FROM_MASTER = -1    # Reply address taken from the triggering frame's master
+FROM_SLAVE = -2     # ... or from its slave address
+MAX_REPLIES = 4
+ANY_CTRL = 0xFF     # Rule control value matching every frame
+
+class Responder:
+    """
+    Host-uploaded response table for emulating devices on the gateway.
+
+    A rule matches on master/slave address with masks (as AddressFilter),
+    optionally the control field, and a masked prefix of the data bytes.
+    The first matching rule produces its reply frames. Each reply is
+    (m, s, c, data, subs): m/s may be FROM_MASTER/FROM_SLAVE to answer
+    whoever asked, subs is a tuple of (reply_index, trigger_index) pairs
+    copying bytes of the triggering frame into the reply.
+
+    Per rule: hits, replies that failed on the bus, and the latency from
+    capture of the trigger to the reply starting on the bus (last / max).
+    """
+
+    def __init__(self, max_rules=8):
+        self.max_rules = max_rules
+        self.value = array.array('I', [0] * max_rules)
+        self.mask = array.array('I', [0] * max_rules)
+        self.ctrl = bytearray([ANY_CTRL] * max_rules)
+        self.pat = [b''] * max_rules                        # Pre-masked data prefix
+        self.pat_mask = [b''] * max_rules
+        self.replies = [None] * max_rules
+        self.hits = array.array('I', [0] * max_rules)
+        self.failed = array.array('I', [0] * max_rules)
+        self.lat_us = array.array('I', [0] * max_rules)
+        self.lat_max = array.array('I', [0] * max_rules)
+        self.n = 0
+
+    def clear(self):
+        for i in range(self.n):
+            self.replies[i] = None
+        self.n = 0
+
+    def add(self, m, m_mask, s, s_mask, c, pat, pat_mask, replies):
+        """Append a rule (c < 0: any control value). Returns False if the table is full."""
+        if self.n >= self.max_rules: return False
+        i = self.n
+        mask = ((m_mask & 0xFFF) << 12) | (s_mask & 0xFFF)
+        self.mask[i] = mask
+        self.value[i] = ((m << 12) | s) & mask
+        self.ctrl[i] = ANY_CTRL if c < 0 else c & 0xF
+        self.pat[i] = bytes([p & k for p, k in zip(pat, pat_mask)])
+        self.pat_mask[i] = bytes(pat_mask)
+        self.replies[i] = replies[:MAX_REPLIES]
+        self.hits[i] = 0
+        self.failed[i] = 0
+        self.lat_us[i] = 0
+        self.lat_max[i] = 0
+        self.n = i + 1
+        return True
+
+    def match(self, m, s, c, data):
+        """Index of the first rule matching the frame, or -1."""
+        key = (m << 12) | s
+        n_data = len(data)
+        for i in range(self.n):
+            if key & self.mask[i] != self.value[i]: continue
+            rc = self.ctrl[i]
+            if rc != ANY_CTRL and rc != c: continue
+            pat = self.pat[i]
+            if len(pat) > n_data: continue
+            pm = self.pat_mask[i]
+            for k in range(len(pat)):
+                if data[k] & pm[k] != pat[k]: break
+            else:
+                self.hits[i] += 1
+                return i
+        return -1
+
+    def build(self, reply, m, s, data):
+        """Reply frame (m, s, c, data) for a trigger from `m` to `s`."""
+        rm, rs, rc, rdata, subs = reply
+        if rm < 0: rm = m if rm == FROM_MASTER else s
+        if rs < 0: rs = m if rs == FROM_MASTER else s
+        if subs:
+            buf = bytearray(rdata)
+            for dst, src in subs:
+                if dst < len(buf) and src < len(data):
+                    buf[dst] = data[src]
+            rdata = bytes(buf)
+        return rm, rs, rc, rdata
+
+    def record(self, i, us):
+        self.lat_us[i] = us
+        if us > self.lat_max[i]: self.lat_max[i] = us
+
+# ============================================================================
+# SAMPLE POINT CALIBRATION
+# ============================================================================
+
+class DelayCalibrator:
+    """
+    Sweep of the RX PIO sample delay over [lo, hi].
+
+    For each delay the caller lets traffic run, then reports the decoder
+    counters; the score is the clean yield in permille: frames decoded at
+    the first attempt (no +1 rescue) over all first attempts (clean frames
+    plus header faults). Steps that saw fewer than `min_frames` frames
+    score 0. The chosen delay is the centre of the widest run of steps
+    within `tolerance` of the best score, which keeps the sample point
+    away from the bit edges; if no step scored, the previous delay stays.
+    """
+
+    def __init__(self, lo=8, hi=22, min_frames=8, tolerance=10):
+        self.lo = lo
+        self.hi = hi
+        self.min_frames = min_frames
+        self.tolerance = tolerance
+        self.scores = array.array('H', [0] * (hi - lo + 1))
+        self.active = False
+        self.delay = lo
+        self.prev = lo
+        self._base = (0, 0, 0)
+
+    def start(self, current, frames, rescues, faults):
+        """Begin a sweep. Returns the first delay to apply."""
+        self.active = True
+        self.prev = current
+        self.delay = self.lo
+        self._base = (frames, rescues, faults)
+        return self.delay
+
+    def step_frames(self, frames):
+        """Frames decoded at the current delay so far."""
+        return frames - self._base[0]
+
+    def sample(self, frames, rescues, faults):
+        """
+        Score the current delay from the cumulative decoder counters.
+        Returns the next delay to apply, or the chosen one with `active`
+        cleared once the sweep is complete.
+        """
+        f = frames - self._base[0]
+        clean = f - (rescues - self._base[1])
+        bad = faults - self._base[2]
+        score = 0
+        if f >= self.min_frames and clean + bad:
+            score = clean * 1000 // (clean + bad)
+        self.scores[self.delay - self.lo] = score
+        self._base = (frames, rescues, faults)
+        if self.delay < self.hi:
+            self.delay += 1
+            return self.delay
+        self.active = False
+        self.delay = self.best()
+        return self.delay
+
+    def best(self):
+        scores = self.scores
+        top = max(scores)
+        if top == 0:
+            return self.prev
+        floor = top - self.tolerance
+        best_start = 0
+        best_len = 0
+        run_start = 0
+        run_len = 0
+        for i in range(len(scores)):
+            if scores[i] >= floor:
+                if run_len == 0: run_start = i
+                run_len += 1
+                if run_len > best_len:
+                    best_len = run_len
+                    best_start = run_start
+            else:
+                run_len = 0
+        return self.lo + best_start + (best_len - 1) // 2
@@ -0,0 +1,152 @@
+"""
+Binary Record Output
+====================
+
+Compact alternative to the NDJSON frame lines for the high-rate CAN and
+AVC-LAN streams, enabled with {"id":0,"d":{"bin":true}}. A CAN frame takes
+18-26 bytes on the wire instead of 60-80.
+
+Record (little-endian):
+    type(1) | ts_s(4) | ts_us(3) | seq(2) | id(4) | dlc(1) | data(dlc) [| cnt(2)] | crc16(2)
+
+    type  TYPE_CAN / TYPE_CAN_EXT: id = CAN ID
+          TYPE_CAN_SUB | slot << 4: subscription response, id = response ID
+          TYPE_AVC:       id = c << 24 | m << 12 | s
+          TYPE_AVC_BURST: as TYPE_AVC plus cnt (burst aggregation)
+    ts_s, ts_us  time since boot when the frame was read, seconds and
+          microseconds (timebase.Clock, does not wrap)
+    crc16 CRC-16/CCITT-FALSE over everything before it
+
+Each record is COBS-encoded and sent as 0x00 <cobs> 0x00. COBS output
+never contains 0x00 and NDJSON lines never contain it either, so the host
+can tell the two apart in the same byte stream (see host/gateway_bin.py).
+
+All buffers are preallocated; writing a record allocates nothing. Like
+jsonrec.py, the writer methods take (buf, pos, ...) and return the
+position after the record, so records can be built straight into an
+output buffer; MAX_FRAMED is the most one record can take.
+"""
+
+import array
+
+TYPE_CAN = 1
+TYPE_CAN_EXT = 2
+TYPE_CAN_SUB = 3
+TYPE_AVC = 4
+TYPE_AVC_BURST = 5
+
+HEADER_LEN = 15
+MAX_DATA = 32
+MAX_RECORD = HEADER_LEN + MAX_DATA + 2 + 2
+MAX_FRAMED = MAX_RECORD + 3             # COBS code byte + two delimiters
+
+# ============================================================================
+# CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF)
+# ============================================================================
+
+def _build_crc_table():
+    table = array.array('H', [0] * 256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+CRC_TABLE = _build_crc_table()
+
+def crc16(buf, n):
+    table = CRC_TABLE
+    crc = 0xFFFF
+    for i in range(n):
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ buf[i]]
+    return crc
+
+# ============================================================================
+# COBS
+# ============================================================================
+
+def cobs_encode(src, n, dst, o=0):
+    """
+    COBS-encode src[:n] into dst at offset o, framed by 0x00 at both ends.
+    Returns the offset after the closing 0x00. Records are < 254 bytes, so
+    a single code block split per zero byte is all that is needed.
+    """
+    dst[o] = 0
+    code_pos = o + 1
+    code = 1
+    o += 2
+    for i in range(n):
+        b = src[i]
+        if b == 0:
+            dst[code_pos] = code
+            code_pos = o
+            code = 1
+        else:
+            dst[o] = b
+            code += 1
+        o += 1
+    dst[code_pos] = code
+    dst[o] = 0
+    return o + 1
+
+# ============================================================================
+# RECORD WRITER
+# ============================================================================
+
+class RecordWriter:
+    """Builds a record in its own buffer, then COBS-frames it into the caller's."""
+
+    def __init__(self):
+        self.rec = bytearray(MAX_RECORD)
+
+    def _header(self, rtype, ts_s, ts_us, seq, ident, dlc):
+        r = self.rec
+        r[0] = rtype
+        r[1] = ts_s & 0xFF
+        r[2] = (ts_s >> 8) & 0xFF
+        r[3] = (ts_s >> 16) & 0xFF
+        r[4] = (ts_s >> 24) & 0xFF
+        r[5] = ts_us & 0xFF
+        r[6] = (ts_us >> 8) & 0xFF
+        r[7] = (ts_us >> 16) & 0xFF
+        r[8] = seq & 0xFF
+        r[9] = (seq >> 8) & 0xFF
+        r[10] = ident & 0xFF
+        r[11] = (ident >> 8) & 0xFF
+        r[12] = (ident >> 16) & 0xFF
+        r[13] = (ident >> 24) & 0xFF
+        r[14] = dlc
+
+    def _finish(self, n, buf, o):
+        r = self.rec
+        crc = crc16(r, n)
+        r[n] = crc & 0xFF
+        r[n + 1] = crc >> 8
+        return cobs_encode(r, n + 2, buf, o)
+
+    def _data(self, data, n):
+        r = self.rec
+        o = HEADER_LEN
+        for i in range(n):
+            r[o + i] = data[i]
+        return o + n
+
+    def can(self, buf, o, ts_s, ts_us, seq, can_id, data, ext=False, slot=-1):
+        n = len(data)
+        if slot >= 0:
+            rtype = TYPE_CAN_SUB | (slot << 4)
+        else:
+            rtype = TYPE_CAN_EXT if ext else TYPE_CAN
+        self._header(rtype, ts_s, ts_us, seq, can_id, n)
+        return self._finish(self._data(data, n), buf, o)
+
+    def avc(self, buf, o, ts_s, ts_us, seq, m, s, c, data, cnt=0):
+        n = len(data)
+        self._header(TYPE_AVC_BURST if cnt else TYPE_AVC, ts_s, ts_us, seq, (c << 24) | (m << 12) | s, n)
+        end = self._data(data, n)
+        if cnt:
+            self.rec[end] = cnt & 0xFF
+            self.rec[end + 1] = (cnt >> 8) & 0xFF
+            end += 2
+        return self._finish(end, buf, o)
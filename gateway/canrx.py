@@ -0,0 +1,374 @@
+"""
+CAN Receive-Side Processing
+===========================
+
+Per-frame work done on the gateway between the MCP2515 and the USB output
+ring, kept out of the driver and main loop.
+
+IdFilter: software acceptance filter for ID sets that the MCP2515's six
+hardware filters cannot hold (e.g. 40 scattered Prius IDs). Rules are
+allow/deny ranges applied in order, later rules overriding earlier ones.
+The 11-bit ID space is compiled into a 256-byte bitmap, so a standard
+frame is accepted or rejected with one index and one AND:
+
+    idf = canrx.IdFilter()
+    idf.clear(False)                    # default: deny
+    idf.add(True, 0x2C4, 0x2C4)         # allow one ID
+    idf.add(True, 0x3C8, 0x3CF)         # allow a range
+    can.id_filter = idf                 # checked in recv_fast()
+
+Extended IDs are too many for a bitmap; their rules are scanned newest
+first. Drops are counted per rule (drops[1 + rule index], drops[0] for the
+default): for standard IDs the deciding rule is stored per ID in `owner`,
+so counting a drop is O(1) as well.
+
+PolicyTable: per-ID output policy applied before a frame is formatted.
+ECUs repeat most IDs at 50-100 Hz with unchanged payloads; the table lets
+the host keep only what it needs:
+
+    PASS      every frame (the default)
+    CHANGE    only frames whose payload differs from the previous one
+    DECIMATE  at most one frame per period
+    MUTE      nothing
+
+IDs tracked with CHANGE or DECIMATE are re-emitted periodically
+(keyframes) so a host that joins late or lost a record still converges on
+the current state.
+
+Summary: per-ID statistics over a fixed window (frame count, last payload,
+per-byte minimum and maximum) for dashboards that need the state of the
+bus rather than every frame. One record per active ID is emitted when the
+window closes.
+
+Pure Python, no hardware imports.
+"""
+
+import array
+
+STD_IDS = 0x800
+
+class IdFilter:
+
+    def __init__(self, max_rules=32):
+        self.max_rules = max_rules
+        self.bitmap = bytearray(STD_IDS >> 3)   # 1 bit per standard ID, 1 = pass
+        self.owner = bytearray(STD_IDS)         # Deciding rule per ID: 1 + index, 0 = default
+        self.lo = array.array('I', [0] * max_rules)
+        self.hi = array.array('I', [0] * max_rules)
+        self.allow = bytearray(max_rules)
+        self.ext = bytearray(max_rules)
+        self.drops = array.array('I', [0] * (max_rules + 1))
+        self.n = 0
+        self.n_ext = 0
+        self.clear()
+
+    def clear(self, default_allow=True):
+        """Remove all rules; IDs matching none get `default_allow`."""
+        self.default_allow = default_allow
+        fill = 0xFF if default_allow else 0
+        for i in range(len(self.bitmap)):
+            self.bitmap[i] = fill
+        for i in range(STD_IDS):
+            self.owner[i] = 0
+        for i in range(len(self.drops)):
+            self.drops[i] = 0
+        self.n = 0
+        self.n_ext = 0
+
+    def add(self, allow, lo, hi, ext=False):
+        """Append a rule for IDs lo..hi. Returns False if full or out of range."""
+        if self.n >= self.max_rules or lo > hi or hi > (0x1FFFFFFF if ext else 0x7FF):
+            return False
+        i = self.n
+        self.lo[i] = lo
+        self.hi[i] = hi
+        self.allow[i] = 1 if allow else 0
+        self.ext[i] = 1 if ext else 0
+        self.n = i + 1
+        if ext:
+            self.n_ext += 1
+            return True
+        bitmap = self.bitmap
+        owner = self.owner
+        k = i + 1
+        for can_id in range(lo, hi + 1):
+            if allow:
+                bitmap[can_id >> 3] |= 1 << (can_id & 7)
+            else:
+                bitmap[can_id >> 3] &= ~(1 << (can_id & 7))
+            owner[can_id] = k
+        return True
+
+    def accept(self, can_id, ext=False):
+        """True if the frame should be forwarded; rejected frames are counted."""
+        if not ext:
+            if self.bitmap[can_id >> 3] & (1 << (can_id & 7)):
+                return True
+            self.drops[self.owner[can_id]] += 1
+            return False
+        if self.n_ext:
+            lo = self.lo
+            hi = self.hi
+            flags = self.ext
+            for i in range(self.n - 1, -1, -1):
+                if flags[i] and lo[i] <= can_id <= hi[i]:
+                    if self.allow[i]:
+                        return True
+                    self.drops[i + 1] += 1
+                    return False
+        if self.default_allow:
+            return True
+        self.drops[0] += 1
+        return False
+
+# ============================================================================
+# OUTPUT POLICY TABLE
+# ============================================================================
+
+PASS = 0
+CHANGE = 1
+DECIMATE = 2
+MUTE = 3
+
+EXT_FLAG = 0x20000000       # Key bit for extended IDs (29-bit ID | flag stays a small int)
+
+class PolicyTable:
+    """
+    Output policy per CAN ID.
+
+    Fixed-size open-addressing table (linear probing) in preallocated
+    arrays, keyed by the ID (EXT_FLAG set for extended IDs). IDs are
+    installed by the host with set(); with a default other than PASS,
+    IDs seen on the bus are added on first sight. Entries are never
+    removed individually, and the table is filled to 3/4 at most so a
+    probe always ends at an empty slot. Frames of IDs that do not fit
+    pass unchanged (counted in `full`).
+
+    The last payload is kept per entry as the tuple the caller already
+    built, so the on-change test is a single tuple compare. Times are
+    (seconds, microseconds) since boot from timebase.Clock, which do not
+    wrap, so a period is measured correctly however long an ID was quiet.
+    """
+
+    def __init__(self, size=128):
+        self.size = size                                # Must be a power of two
+        self.limit = size * 3 // 4
+        self.keys = array.array('i', [-1] * size)       # can_id | EXT_FLAG, -1 = empty
+        self.mode = bytearray(size)
+        self.period = array.array('I', [0] * size)      # DECIMATE: µs between frames
+        self.last_s = array.array('I', [0] * size)      # Time of the last frame sent (s, µs)
+        self.last_us = array.array('I', [0] * size)
+        self.auto = bytearray(size)                     # 1 = added from the bus by the default
+        self.sup = array.array('I', [0] * size)         # Frames held back per entry
+        self.data = [None] * size                       # Latest payload (None = none yet)
+        self.key_ms = 0             # Keyframe interval, 0 = off
+        self.kf = -1                # Next slot to refresh, -1 = no keyframe running
+        self._key_s = 0
+        self._key_us = 0
+        self.clear()
+
+    def clear(self, default=PASS, period=0):
+        """Remove all entries; unlisted IDs get `default` (with `period` µs)."""
+        for i in range(self.size):
+            self.keys[i] = -1
+            self.data[i] = None
+        self.default = default
+        self.default_period = period
+        self.n = 0
+        self.kf = -1
+        self.suppressed = 0
+        self.full = 0
+        self.active = default != PASS
+
+    def _slot(self, key):
+        """Slot holding `key`, or the empty slot where it would go."""
+        mask = self.size - 1
+        i = (key ^ (key >> 7)) & mask
+        keys = self.keys
+        while True:
+            k = keys[i]
+            if k == key or k < 0:
+                return i
+            i = (i + 1) & mask
+
+    def _fill(self, i, key, mode, period, auto):
+        if self.keys[i] < 0:
+            self.n += 1
+        self.keys[i] = key
+        self.mode[i] = mode
+        self.period[i] = period
+        self.auto[i] = auto
+        self.sup[i] = 0
+        self.data[i] = None
+
+    def set(self, can_id, ext, mode, period=0):
+        """Install or change the policy of one ID. Returns False if full."""
+        key = can_id | EXT_FLAG if ext else can_id
+        i = self._slot(key)
+        if self.keys[i] < 0 and self.n >= self.limit:
+            return False
+        self._fill(i, key, mode, period, 0)
+        if mode != PASS:
+            self.active = True
+        return True
+
+    def check(self, can_id, ext, data, sec, us):
+        """True if the frame (payload tuple `data`, time sec/us) should be sent."""
+        key = can_id | EXT_FLAG if ext else can_id
+        i = self._slot(key)
+        if self.keys[i] < 0:
+            if self.default == PASS:
+                return True
+            if self.n >= self.limit:
+                self.full += 1
+                return True
+            self._fill(i, key, self.default, self.default_period, 1)
+        m = self.mode[i]
+        if m == PASS:
+            return True
+        if m == CHANGE:
+            if data == self.data[i]:
+                self.sup[i] += 1
+                self.suppressed += 1
+                return False
+        elif m == DECIMATE:
+            if self.data[i] is not None and (sec - self.last_s[i]) * 1000000 + us - self.last_us[i] < self.period[i]:
+                # Keep the newest payload for keyframes
+                self.data[i] = data
+                self.sup[i] += 1
+                self.suppressed += 1
+                return False
+        else:
+            self.sup[i] += 1
+            self.suppressed += 1
+            return False
+        self.data[i] = data
+        self.last_s[i] = sec
+        self.last_us[i] = us
+        return True
+
+    def tick(self, sec, us):
+        """Start a keyframe once key_ms has passed since the last one."""
+        if self.key_ms and (sec - self._key_s) * 1000 + (us - self._key_us) // 1000 >= self.key_ms:
+            self._key_s = sec
+            self._key_us = us
+            self.kf = 0
+
+    def next_key(self):
+        """Slot of the next entry to refresh in the running keyframe, or -1."""
+        i = self.kf
+        if i < 0:
+            return -1
+        mode = self.mode
+        data = self.data
+        while i < self.size:
+            if self.keys[i] >= 0 and data[i] is not None and (mode[i] == CHANGE or mode[i] == DECIMATE):
+                self.kf = i + 1
+                return i
+            i += 1
+        self.kf = -1
+        return -1
+
+    def entry(self, i):
+        """(can_id, ext, payload) of slot i."""
+        k = self.keys[i]
+        return (k & ~EXT_FLAG, k >= EXT_FLAG, self.data[i])
+
+# ============================================================================
+# WINDOWED SUMMARY
+# ============================================================================
+
+class Summary:
+    """
+    Per-ID frame statistics over one window.
+
+    Same table layout as PolicyTable; payload bytes live in flat
+    bytearrays, 8 per slot (`last`, `lo`, `hi` at slot * 8), so add() only
+    stores bytes. IDs stay in the table across windows (a bus carries a
+    stable ID set); the slots active in the current window are listed in
+    `order`. Frames of IDs that do not fit are counted in `full`.
+
+        sm.add(can_id, ext, data)       # per received frame
+        for j in range(sm.n_active):    # when the window closes
+            i = sm.order[j]
+            ... sm.count[i], sm.last / sm.lo / sm.hi at i * 8
+        sm.reset()
+    """
+
+    def __init__(self, size=128):
+        self.size = size                                # Must be a power of two
+        self.limit = size * 3 // 4
+        self.keys = array.array('i', [-1] * size)       # can_id | EXT_FLAG, -1 = empty
+        self.count = array.array('I', [0] * size)       # Frames in the current window
+        self.dlc = bytearray(size)                      # Length of the last payload
+        self.span = bytearray(size)                     # Longest payload in the window
+        self.last = bytearray(size * 8)
+        self.lo = bytearray(size * 8)
+        self.hi = bytearray(size * 8)
+        self.order = array.array('H', [0] * self.limit) # Active slots, first seen first
+        self.n_active = 0
+        self.clear()
+
+    def clear(self):
+        for i in range(self.size):
+            self.keys[i] = -1
+            self.count[i] = 0
+        self.n = 0
+        self.n_active = 0
+        self.full = 0
+
+    def add(self, can_id, ext, data):
+        key = can_id | EXT_FLAG if ext else can_id
+        mask = self.size - 1
+        i = (key ^ (key >> 7)) & mask
+        keys = self.keys
+        while True:
+            k = keys[i]
+            if k == key:
+                break
+            if k < 0:
+                if self.n >= self.limit:
+                    self.full += 1
+                    return
+                keys[i] = key
+                self.n += 1
+                break
+            i = (i + 1) & mask
+        n = len(data)
+        o = i << 3
+        last = self.last
+        lo = self.lo
+        hi = self.hi
+        if self.count[i]:
+            span = self.span[i]
+        else:
+            self.order[self.n_active] = i
+            self.n_active += 1
+            span = 0
+        for j in range(n):
+            b = data[j]
+            last[o + j] = b
+            if j >= span:
+                lo[o + j] = b
+                hi[o + j] = b
+            elif b < lo[o + j]:
+                lo[o + j] = b
+            elif b > hi[o + j]:
+                hi[o + j] = b
+        if n > span:
+            self.span[i] = n
+        self.dlc[i] = n
+        self.count[i] += 1
+
+    def entry_id(self, i):
+        """(can_id, ext) of slot i."""
+        k = self.keys[i]
+        return (k & ~EXT_FLAG, k >= EXT_FLAG)
+
+    def reset(self):
+        """Close the window: start counting again for every ID."""
+        order = self.order
+        count = self.count
+        for j in range(self.n_active):
+            count[order[j]] = 0
+        self.n_active = 0
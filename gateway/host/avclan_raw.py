@@ -0,0 +1,256 @@
+"""
+AVC-LAN Raw Capture Decoder (host side)
+=======================================
+
+Decodes captures recorded with the gateway's raw streaming mode
+({"id":0,"d":{"avc_raw":true}}): the PIO words of avclan_rx_framed,
+base64-packed (little-endian uint32) in NDJSON lines
+
+    {"id":2,"ts":<ms>,"d":{"raw":"<base64>","us":<µs since boot>,"w":<index>,"drop":<n>}}
+
+Everything is done in bulk with NumPy: the frame trailers are located with
+one vectorized compare, every frame is expanded into a row of a bit matrix
+and all header fields, parities, the +1 bit shift rescue and the data
+bytes are computed as matrix operations over all frames at once.
+
+A trailer (0xFFFF tag) only counts under the gateway's rules: the
+partial push before it has no bits above the valid ones, the header at
+the start of its frame has the length its bit count implies, and the
+frame starts right after the last accepted trailer (or, after a lost
+one, right after a tagged word that was not accepted). Data words of
+0xFF payload bytes (0xFFFFxxxx) therefore cannot split or swallow frames.
+Regions not closed by their own trailer (lost trailer or dropped words)
+are skipped, not brute-force scanned like on the gateway.
+
+Usage:
+    python3 host/avclan_raw.py capture.jsonl > frames.jsonl
+"""
+
+import base64
+import json
+import sys
+
+import numpy as np
+
+MAX_DATA_LEN = 32
+HEADER_BITS = 40
+BYTE_BITS = 9
+MAX_FRAME_BITS = HEADER_BITS + MAX_DATA_LEN * BYTE_BITS     # 328
+TRAILER_TAG = 0xFFFF
+WORD_INDEX_PERIOD = 1 << 30 # Running word index "w" is masked to 30 bits on the gateway
+
+# (offset, width) of the header fields, parity bit follows each field
+FIELDS = ((0, 12), (13, 12), (26, 4), (31, 8))
+
+# ============================================================================
+# CAPTURE LOADING
+# ============================================================================
+
+def load_capture(lines):
+    """
+    Collect the raw batches of an NDJSON capture (other lines are ignored).
+
+    Returns (words, word_us, gaps): all words as a uint32 array, the µs
+    timestamp (since gateway boot) of the batch each word arrived in, and the
+    number of words lost between batches according to the running index.
+    """
+    chunks = []
+    stamps = []
+    gaps = 0
+    expect = None
+    for line in lines:
+        line = line.strip()
+        if not line or '"raw"' not in line:
+            continue
+        try:
+            d = json.loads(line)["d"]
+            w = np.frombuffer(base64.b64decode(d["raw"]), dtype="<u4")
+        except (ValueError, KeyError, TypeError):
+            continue
+        if expect is not None:
+            gaps += (d["w"] - expect) % WORD_INDEX_PERIOD
+        expect = (d["w"] + len(w)) % WORD_INDEX_PERIOD
+        chunks.append(w)
+        stamps.append(np.full(len(w), d["us"], dtype=np.int64))
+    if not chunks:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64), 0
+    return np.concatenate(chunks).astype(np.uint32), np.concatenate(stamps), gaps
+
+# ============================================================================
+# FRAME EXTRACTION
+# ============================================================================
+
+def frame_bits(words):
+    """
+    Split a word stream at its PIO trailers into a bit matrix.
+
+    Returns (bits, nbits, trailer_idx, unframed): bits is uint8 of shape
+    (frames, MAX_FRAME_BITS + 1), one frame per row starting at column 0,
+    zero padded; nbits the captured bit count per frame; trailer_idx the
+    word index of each frame's trailer; unframed the number of words that
+    belong to no complete frame.
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    # Candidates: tagged, plausible bit count, clean partial push before it
+    t_idx = np.nonzero((words >> 16) == TRAILER_TAG)[0]
+    t_idx = t_idx[t_idx > 0]
+    nbits = (0xFFFFFFFF - words[t_idx]).astype(np.int64)
+    partial = words[t_idx - 1].astype(np.uint64) >> (nbits & 31).astype(np.uint64)
+    ok = (nbits >= HEADER_BITS) & (nbits <= MAX_FRAME_BITS + 1) & (partial == 0)
+    t_idx, nbits = t_idx[ok], nbits[ok]
+    need = (nbits >> 5) + 1
+    start = t_idx - need
+    ok = start >= 0
+    t_idx, nbits, need, start = t_idx[ok], nbits[ok], need[ok], start[ok]
+    fits = _header_fits(words, start, need, nbits)
+
+    # Chain: a frame must start right after the last accepted trailer, or
+    # (lost trailer) right after a candidate that was not accepted since
+    keep = np.zeros(len(t_idx), dtype=bool)
+    last = -1
+    tag = -2
+    for j, (t, st) in enumerate(zip(t_idx.tolist(), start.tolist())):
+        if st <= last:
+            continue
+        if fits[j] and (st - 1 == last or st - 1 == tag):
+            keep[j] = True
+            last = t
+            tag = -2
+        else:
+            tag = t
+    t_idx, nbits, need, start = t_idx[keep], nbits[keep], need[keep], start[keep]
+    n = len(t_idx)
+    cols = MAX_FRAME_BITS + 1
+    width_words = (cols + 31) // 32 + 1
+
+    # Gather each frame's words into a fixed-width row
+    k = np.arange(width_words)
+    gather = start[:, None] + k[None, :]
+    valid = k[None, :] < need[:, None]
+    rows = np.where(valid, words[np.clip(gather, 0, max(len(words) - 1, 0))], 0).astype(np.uint32)
+
+    # Partial last word is right-aligned: left-align it (empty push -> 0)
+    rem = (nbits & 31).astype(np.uint32)
+    last = need - 1
+    r = np.arange(n)
+    lw = rows[r, last]
+    rows[r, last] = np.where(rem > 0, (lw.astype(np.uint64) << (32 - rem)) & 0xFFFFFFFF, 0).astype(np.uint32)
+
+    bits = np.unpackbits(rows.astype(">u4").view(np.uint8).reshape(n, width_words * 4), axis=1)[:, :cols]
+    bits = np.where(np.arange(cols)[None, :] < nbits[:, None], bits, 0).astype(np.uint8)
+    framed_words = int(need.sum() + n)
+    return bits, nbits, t_idx, len(words) - framed_words
+
+def _header_fits(words, start, need, nbits):
+    """True per candidate if the header at `start` has the length nbits implies."""
+    n = len(start)
+    if not n:
+        return np.zeros(0, dtype=bool)
+    w0 = words[start]
+    w1 = words[start + 1].astype(np.uint64)
+    # need == 2: the second word is the partial push, left-align it
+    rem = (nbits & 31).astype(np.uint64)
+    w1 = np.where(need == 2, (w1 << (32 - rem)) & 0xFFFFFFFF, w1)
+    hw = np.stack([w0, w1.astype(np.uint32)], axis=1).astype(">u4")
+    hb = np.unpackbits(hw.view(np.uint8).reshape(n, 8), axis=1)
+    fits = np.zeros(n, dtype=bool)
+    for shift in (0, 1):
+        b = hb[:, shift:shift + HEADER_BITS]
+        ok = np.ones(n, dtype=bool)
+        for off, width in FIELDS:
+            ok &= _parity_ok(b, off, width)
+        l = _field(b, 31, 8)
+        fits |= ok & (l <= MAX_DATA_LEN) & (nbits == HEADER_BITS + shift + l * BYTE_BITS)
+    return fits
+
+# ============================================================================
+# BULK DECODE
+# ============================================================================
+
+def _field(bits, off, width):
+    weights = (1 << np.arange(width - 1, -1, -1)).astype(np.int64)
+    return bits[:, off:off + width].astype(np.int64) @ weights
+
+def _parity_ok(bits, off, width):
+    # Odd parity: popcount(field) + P is odd
+    return (bits[:, off:off + width + 1].sum(axis=1) & 1) == 1
+
+def _decode_at(bits, nbits, shift):
+    b = bits[:, shift:shift + MAX_FRAME_BITS]
+    hdr_ok = np.ones(len(b), dtype=bool)
+    vals = []
+    for off, width in FIELDS:
+        vals.append(_field(b, off, width))
+        hdr_ok &= _parity_ok(b, off, width)
+    m, s, c, l = vals
+    ok = hdr_ok & (l <= MAX_DATA_LEN) & (HEADER_BITS + l * BYTE_BITS + shift <= nbits)
+    data9 = b[:, HEADER_BITS:].reshape(len(b), MAX_DATA_LEN, BYTE_BITS).astype(np.int64)
+    data = (data9[:, :, :8] @ (1 << np.arange(7, -1, -1))).astype(np.uint8)
+    dpar = (data9.sum(axis=2) & 1) == 1
+    return ok, m, s, c, l, data, dpar
+
+def decode_frames(bits, nbits):
+    """
+    Decode every row of a frame_bits() matrix.
+
+    Returns a dict of arrays: valid, shift (0, or 1 for the rescue), m, s,
+    c, l, data (frames x 32, bytes past l are meaningless) and data_parity
+    (True when every data byte within l has odd parity).
+    """
+    ok0, m0, s0, c0, l0, d0, p0 = _decode_at(bits, nbits, 0)
+    ok1, m1, s1, c1, l1, d1, p1 = _decode_at(bits, nbits, 1)
+    use1 = ~ok0 & ok1
+    pick = lambda a, b: np.where(use1, b, a)
+    l = pick(l0, l1)
+    dpar = np.where(use1[:, None], p1, p0) | (np.arange(MAX_DATA_LEN)[None, :] >= l[:, None])
+    return {
+        "valid": ok0 | ok1,
+        "shift": use1.astype(np.uint8),
+        "m": pick(m0, m1),
+        "s": pick(s0, s1),
+        "c": pick(c0, c1),
+        "l": l,
+        "data": np.where(use1[:, None], d1, d0),
+        "data_parity": dpar.all(axis=1),
+    }
+
+def decode_words(words, word_us=None):
+    """
+    Decode a raw word stream. Returns decode_frames() output plus "ts_us"
+    (batch timestamp of each frame's trailer, if word_us is given) and the
+    count of "unframed" words.
+    """
+    bits, nbits, t_idx, unframed = frame_bits(words)
+    out = decode_frames(bits, nbits)
+    if word_us is not None:
+        out["ts_us"] = np.asarray(word_us)[t_idx]
+    out["unframed"] = unframed
+    return out
+
+def iter_frames(dec):
+    """Yield (m, s, c, data_bytes, shift) for the valid frames of a decode."""
+    for i in np.nonzero(dec["valid"])[0]:
+        yield (int(dec["m"][i]), int(dec["s"][i]), int(dec["c"][i]),
+               bytes(dec["data"][i, :dec["l"][i]]), int(dec["shift"][i]))
+
+def main(path):
+    with open(path) as f:
+        words, word_us, gaps = load_capture(f)
+    dec = decode_words(words, word_us)
+    ts = dec.get("ts_us")
+    for i in np.nonzero(dec["valid"])[0]:
+        d = dec["data"][i, :dec["l"][i]]
+        rec = {"id": 2, "ts_us": int(ts[i]), "d": {"m": "%03X" % dec["m"][i], "s": "%03X" % dec["s"][i],
+               "c": int(dec["c"][i]), "d": ["%02X" % b for b in d]}}
+        if dec["shift"][i]:
+            rec["d"]["rs"] = [0, 2]
+        sys.stdout.write(json.dumps(rec, separators=(",", ":")) + "\n")
+    sys.stderr.write("words=%d frames=%d valid=%d rescued=%d unframed=%d lost=%d\n" % (
+        len(words), len(dec["valid"]), int(dec["valid"].sum()), int(dec["shift"].sum()),
+        dec["unframed"], gaps))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: avclan_raw.py capture.jsonl\n")
+        sys.exit(1)
+    main(sys.argv[1])
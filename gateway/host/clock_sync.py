@@ -0,0 +1,119 @@
+"""
+Gateway Clock Sync (host side)
+==============================
+
+Maps gateway timestamps (µs since gateway boot: "ts" with
+{"id":0,"d":{"ts_us":true}}, or "ts_us" of binary records) onto the
+host clock.
+
+Each exchange is NTP-style:
+
+    host  -> {"id":0,"d":{"sync":n}}                                h0
+    host  <- {"id":0,"d":{"sync":n,"rx":<µs>,"tx":<µs>}}            h1
+
+rx is when the gateway had the command line, tx when it queued the reply.
+The round trip without the gateway's own processing time is
+(h1 - h0) - (tx - rx); the exchanges with the shortest round trips are
+the ones least delayed by USB scheduling, so only those are used. A
+least-squares line through their midpoints gives offset and drift (the
+RP2040 crystal is typically within +-50 ppm).
+
+Usage:
+    python3 host/clock_sync.py /dev/ttyACM0     (needs pyserial)
+
+From Python:
+    cm = clock_sync.ClockMap()
+    cm.add(h0, rx, tx, h1)          # per exchange, h0/h1 host seconds
+    cm.fit()
+    host_s = cm.to_host(gateway_us)
+"""
+
+import json
+import sys
+import time
+
+class ClockMap:
+
+    def __init__(self, keep=0.25):
+        self.keep = keep            # Fraction of exchanges (shortest RTT) used by fit()
+        self.samples = []           # (rtt_s, gateway_us, host_s)
+        self.offset = None          # host_s at gateway_us == ref_us
+        self.drift = 0.0            # host seconds per gateway second - 1
+        self.ref_us = 0
+        self.rtt = None             # Best round trip seen (s)
+
+    def add(self, h0, rx_us, tx_us, h1):
+        """One sync exchange: host send/receive times (s), gateway rx/tx (µs)."""
+        rtt = (h1 - h0) - (tx_us - rx_us) / 1e6
+        # Gateway midpoint matches host midpoint if both USB legs take equally long
+        g_mid = (rx_us + tx_us) / 2.0
+        h_mid = (h0 + h1) / 2.0
+        self.samples.append((rtt, g_mid, h_mid))
+        if self.rtt is None or rtt < self.rtt:
+            self.rtt = rtt
+
+    def fit(self):
+        if not self.samples:
+            raise ValueError("no sync samples")
+        best = sorted(self.samples)[:max(2, int(len(self.samples) * self.keep))]
+        self.ref_us = best[0][1]
+        xs = [(g - self.ref_us) / 1e6 for _, g, _ in best]
+        ys = [h for _, _, h in best]
+        n = len(best)
+        mx = sum(xs) / n
+        my = sum(ys) / n
+        sxx = sum((x - mx) ** 2 for x in xs)
+        if n < 2 or sxx < 1.0:
+            # Too short a span to see drift: offset only
+            self.drift = 0.0
+        else:
+            self.drift = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx - 1.0
+        self.offset = my - mx * (1.0 + self.drift)
+        return self
+
+    def to_host(self, gateway_us):
+        """Host clock time (s) of a gateway timestamp (µs)."""
+        if self.offset is None:
+            self.fit()
+        return self.offset + (gateway_us - self.ref_us) / 1e6 * (1.0 + self.drift)
+
+def sync(port, count=32, interval=0.05, clock=time.time):
+    """Run `count` exchanges on an open serial port, return a fitted ClockMap."""
+    cm = ClockMap()
+    buf = b""
+    for n in range(count):
+        h0 = clock()
+        port.write(b'{"id":0,"d":{"sync":%d}}\n' % n)
+        deadline = h0 + 0.5
+        while clock() < deadline:
+            buf += port.read(port.in_waiting or 1)
+            h1 = clock()
+            lines = buf.split(b"\n")
+            buf = lines.pop()
+            reply = None
+            for line in lines:
+                if b'"sync"' in line:
+                    try:
+                        d = json.loads(line)["d"]
+                    except ValueError:
+                        continue
+                    if d.get("sync") == n and "rx" in d:
+                        reply = d
+            if reply:
+                cm.add(h0, reply["rx"], reply["tx"], h1)
+                break
+        time.sleep(interval)
+    return cm.fit()
+
+def main(path):
+    import serial
+    port = serial.Serial(path, 1000000, timeout=0.01)
+    cm = sync(port)
+    sys.stdout.write("samples=%d best_rtt=%.0fus drift=%.1fppm gateway_boot=%.6f\n" % (
+        len(cm.samples), cm.rtt * 1e6, cm.drift * 1e6, cm.to_host(0)))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: clock_sync.py <serial port>\n")
+        sys.exit(1)
+    main(sys.argv[1])
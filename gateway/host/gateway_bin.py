@@ -0,0 +1,156 @@
+"""
+Gateway Binary Record Decoder (host side)
+=========================================
+
+Splits the gateway's USB byte stream into NDJSON lines and binary records
+(enabled with {"id":0,"d":{"bin":true}}, format in gateway/binrec.py) and
+decodes the records into the same dicts the NDJSON lines carry.
+
+Binary records are sent as 0x00 <COBS> 0x00; NDJSON lines never contain
+0x00, so a zero byte outside a record always starts one.
+
+Usage:
+    python3 host/gateway_bin.py /dev/ttyACM0     (needs pyserial)
+    python3 host/gateway_bin.py capture.bin
+
+Pure Python, no NumPy needed.
+"""
+
+import json
+import struct
+import sys
+
+TYPE_CAN = 1
+TYPE_CAN_EXT = 2
+TYPE_CAN_SUB = 3
+TYPE_AVC = 4
+TYPE_AVC_BURST = 5
+
+HEADER = struct.Struct("<BIHBHIB")  # type, ts_s, ts_us (low 16, high 8 bits), seq, id, dlc
+
+def crc16(data):
+    """CRC-16/CCITT-FALSE."""
+    crc = 0xFFFF
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        crc &= 0xFFFF
+    return crc
+
+def cobs_decode(data):
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        code = data[i]
+        if code == 0:
+            raise ValueError("zero byte in COBS data")
+        end = i + code
+        if end > n + 1:
+            raise ValueError("truncated COBS block")
+        out += data[i + 1:end]
+        i = end
+        if code < 0xFF and i < n:
+            out.append(0)
+    return bytes(out)
+
+def decode_record(rec):
+    """
+    Decode one un-COBSed record into a gateway-style dict, or raise
+    ValueError on a CRC or length error.
+    """
+    if len(rec) < HEADER.size + 2:
+        raise ValueError("short record")
+    if crc16(rec[:-2]) != struct.unpack_from("<H", rec, len(rec) - 2)[0]:
+        raise ValueError("CRC mismatch")
+    rtype, ts_s, us_lo, us_hi, seq, ident, dlc = HEADER.unpack_from(rec)
+    ts_us = ts_s * 1000000 + (us_hi << 16 | us_lo)
+    data = rec[HEADER.size:HEADER.size + dlc]
+    base = rtype & 0x0F
+    out = {"ts_us": ts_us, "seq": seq}
+    if base in (TYPE_CAN, TYPE_CAN_EXT):
+        out.update(id=1, d={"i": "0x%X" % ident, "d": list(data)})
+        if base == TYPE_CAN_EXT:
+            out["d"]["e"] = True
+    elif base == TYPE_CAN_SUB:
+        out.update(id=1, d={"a": "sub", "slot": rtype >> 4, "i": "0x%X" % ident, "d": list(data)})
+    elif base in (TYPE_AVC, TYPE_AVC_BURST):
+        d = {"m": "%03X" % ((ident >> 12) & 0xFFF), "s": "%03X" % (ident & 0xFFF),
+             "c": (ident >> 24) & 0xF, "d": ["%02X" % b for b in data]}
+        if base == TYPE_AVC_BURST:
+            d["cnt"] = struct.unpack_from("<H", rec, HEADER.size + dlc)[0]
+        out.update(id=2, d=d)
+    else:
+        raise ValueError("unknown record type %d" % rtype)
+    return out
+
+class StreamSplitter:
+    """
+    Incremental parser: feed() raw bytes, get back a list of decoded
+    messages (dicts). Bad records are counted in `errors`, not raised.
+    """
+
+    def __init__(self):
+        self._text = bytearray()
+        self._rec = bytearray()
+        self._in_rec = False
+        self.errors = 0
+        self.records = 0
+        self.lines = 0
+
+    def feed(self, data):
+        msgs = []
+        for b in data:
+            if self._in_rec:
+                if b == 0:
+                    self._in_rec = False
+                    try:
+                        msgs.append(decode_record(cobs_decode(bytes(self._rec))))
+                        self.records += 1
+                    except ValueError:
+                        self.errors += 1
+                    self._rec.clear()
+                else:
+                    self._rec.append(b)
+            elif b == 0:
+                self._in_rec = True
+            elif b == 0x0A:
+                line = self._text.strip()
+                self._text.clear()
+                if line:
+                    try:
+                        msgs.append(json.loads(line))
+                        self.lines += 1
+                    except ValueError:
+                        self.errors += 1
+            else:
+                self._text.append(b)
+        return msgs
+
+def main(path):
+    splitter = StreamSplitter()
+    if path.startswith("/dev/") or path.upper().startswith("COM"):
+        import serial
+        src = serial.Serial(path, 1000000, timeout=0.1)
+        src.write(b'{"id":0,"d":{"bin":true}}\n')
+        read = lambda: src.read(4096)
+    else:
+        src = open(path, "rb")
+        read = lambda: src.read(65536)
+    try:
+        while True:
+            chunk = read()
+            if not chunk and not hasattr(src, "in_waiting"):
+                break
+            for msg in splitter.feed(chunk):
+                sys.stdout.write(json.dumps(msg, separators=(",", ":")) + "\n")
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write("records=%d lines=%d errors=%d\n" % (splitter.records, splitter.lines, splitter.errors))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: gateway_bin.py <serial port | capture file>\n")
+        sys.exit(1)
+    main(sys.argv[1])
@@ -0,0 +1,204 @@
+"""
+NDJSON Frame Line Serializer
+============================
+
+Writes the CAN, CAN subscription and AVC-LAN frame lines byte by byte
+into a caller-supplied bytearray, producing exactly the text the string
+based formatters in main.py used to build:
+
+    {"id":1,"ts":2200,"seq":17,"d":{"i":"0x2C4","d":[0,0,12,55]}}
+    {"id":1,"ts":2200,"seq":18,"d":{"a":"sub","slot":0,"i":"0x7E8","d":[4,65,12,11]}}
+    {"id":2,"ts":3500,"seq":19,"d":{"m":"190","s":"110","c":0,"d":["01","FF"],"cnt":3,"rs":[0,2]}}
+    {"id":1,"ts":2300,"seq":20,"d":{"a":"sum","i":"0x2C4","n":10,"d":[0,0,12,55],"lo":[0,0,9,40],"hi":[0,0,12,60]}}
+
+The timestamp is passed split as (sec, frac, digits), see timebase.py:
+"ts" is written as sec followed by frac zero-padded to `digits`, or just
+frac while sec is 0, so it never needs a long int.
+
+Digits and hex come from lookup tables and constant fragments are copied
+with index loops, so formatting a frame allocates nothing: no str(),
+format(), join() or concatenation temporaries, and no slice objects.
+
+Each function takes (buf, pos, ...) and returns the position after the
+line, so the caller can serialize straight into an output buffer. The
+caller makes sure `buf` has room: a CAN line is at most CAN_LINE_MAX
+bytes, an AVC-LAN line at most AVC_LINE_MAX, a CAN summary line at most
+SUM_LINE_MAX, a subscription line SUB_LINE_FIXED + 4 bytes per data byte.
+
+Pure Python, runs on the RP2040 and on a host PC (see
+test-bench/bench_serializer.py).
+"""
+
+HEX = b"0123456789ABCDEF"
+
+CAN_LINE_MAX = 130
+AVC_LINE_MAX = 290
+SUB_LINE_FIXED = 120
+SUM_LINE_MAX = 230
+
+_ID1_TS = b'{"id":1,"ts":'
+_ID2_TS = b'{"id":2,"ts":'
+_SEQ = b',"seq":'
+_CAN_I = b',"d":{"i":"0x'
+_SUB_SLOT = b',"d":{"a":"sub","slot":'
+_SUB_I = b',"i":"0x'
+_D_ARR = b'","d":['
+_END = b']}}\n'
+_AVC_M = b',"d":{"m":"'
+_AVC_S = b'","s":"'
+_AVC_C = b'","c":'
+_AVC_D = b',"d":['
+_AVC_CNT = b'],"cnt":'
+_AVC_RS = b',"rs":['
+_CLOSE = b'}}\n'
+_SUM_I = b',"d":{"a":"sum","i":"0x'
+_SUM_N = b'","n":'
+_SUM_D = b',"d":['
+_SUM_LO = b'],"lo":['
+_SUM_HI = b'],"hi":['
+
+def _put(buf, o, frag):
+    for i in range(len(frag)):
+        buf[o + i] = frag[i]
+    return o + len(frag)
+
+def _dec(buf, o, v):
+    """Unsigned decimal."""
+    if v < 10:
+        buf[o] = 48 + v
+        return o + 1
+    n = 1
+    t = v
+    while t >= 10:
+        t //= 10
+        n += 1
+    end = o + n
+    while n:
+        n -= 1
+        buf[o + n] = 48 + v % 10
+        v //= 10
+    return end
+
+def _hex(buf, o, v):
+    """Uppercase hex without leading zeros (like '{:X}')."""
+    n = 1
+    t = v >> 4
+    while t:
+        t >>= 4
+        n += 1
+    end = o + n
+    while n:
+        n -= 1
+        buf[o + n] = HEX[v & 15]
+        v >>= 4
+    return end
+
+def _dec_list(buf, o, data):
+    n = len(data)
+    for i in range(n):
+        if i:
+            buf[o] = 44     # ,
+            o += 1
+        o = _dec(buf, o, data[i])
+    return o
+
+def _dec_run(buf, o, src, off, n):
+    """Like _dec_list over src[off:off + n], without the slice."""
+    for i in range(n):
+        if i:
+            buf[o] = 44     # ,
+            o += 1
+        o = _dec(buf, o, src[off + i])
+    return o
+
+def _ts(buf, o, sec, frac, digits):
+    if sec == 0:
+        return _dec(buf, o, frac)
+    o = _dec(buf, o, sec)
+    end = o + digits
+    while digits:
+        digits -= 1
+        buf[o + digits] = 48 + frac % 10
+        frac //= 10
+    return end
+
+def _head(buf, o, prefix, sec, frac, digits, seq):
+    o = _put(buf, o, prefix)
+    o = _ts(buf, o, sec, frac, digits)
+    if seq >= 0:
+        o = _put(buf, o, _SEQ)
+        o = _dec(buf, o, seq)
+    return o
+
+def can_line(buf, o, sec, frac, digits, seq, can_id, data):
+    """CAN frame line. seq < 0 leaves the "seq" field out."""
+    o = _head(buf, o, _ID1_TS, sec, frac, digits, seq)
+    o = _put(buf, o, _CAN_I)
+    o = _hex(buf, o, can_id)
+    o = _put(buf, o, _D_ARR)
+    o = _dec_list(buf, o, data)
+    return _put(buf, o, _END)
+
+def sub_line(buf, o, sec, frac, digits, seq, slot, resp_id, data):
+    """CAN subscription response line."""
+    o = _head(buf, o, _ID1_TS, sec, frac, digits, seq)
+    o = _put(buf, o, _SUB_SLOT)
+    o = _dec(buf, o, slot)
+    o = _put(buf, o, _SUB_I)
+    o = _hex(buf, o, resp_id)
+    o = _put(buf, o, _D_ARR)
+    o = _dec_list(buf, o, data)
+    return _put(buf, o, _END)
+
+def avc_line(buf, o, sec, frac, digits, seq, m, s, c, data, rs_skip=0, rs_try=1, cnt=0):
+    """AVC-LAN frame line; "cnt" only if cnt, "rs" only if resync was needed."""
+    o = _head(buf, o, _ID2_TS, sec, frac, digits, seq)
+    o = _put(buf, o, _AVC_M)
+    buf[o] = HEX[(m >> 8) & 15]; buf[o + 1] = HEX[(m >> 4) & 15]; buf[o + 2] = HEX[m & 15]
+    o = _put(buf, o + 3, _AVC_S)
+    buf[o] = HEX[(s >> 8) & 15]; buf[o + 1] = HEX[(s >> 4) & 15]; buf[o + 2] = HEX[s & 15]
+    o = _put(buf, o + 3, _AVC_C)
+    o = _dec(buf, o, c)
+    o = _put(buf, o, _AVC_D)
+    for i in range(len(data)):
+        b = data[i]
+        if i:
+            buf[o] = 44     # ,
+            o += 1
+        buf[o] = 34         # "
+        buf[o + 1] = HEX[b >> 4]
+        buf[o + 2] = HEX[b & 15]
+        buf[o + 3] = 34
+        o += 4
+    if cnt:
+        o = _put(buf, o, _AVC_CNT)
+        o = _dec(buf, o, cnt)
+    else:
+        buf[o] = 93         # ]
+        o += 1
+    if rs_skip or rs_try > 1:
+        o = _put(buf, o, _AVC_RS)
+        o = _dec(buf, o, rs_skip)
+        buf[o] = 44
+        o = _dec(buf, o + 1, rs_try)
+        buf[o] = 93
+        o += 1
+    return _put(buf, o, _CLOSE)
+
+def sum_line(buf, o, sec, frac, digits, seq, can_id, n, data, lo, hi, off, dlc, span):
+    """
+    CAN summary line: frame count `n`, last payload data[off:off + dlc] and
+    per-byte minimum/maximum lo/hi[off:off + span] over the window.
+    """
+    o = _head(buf, o, _ID1_TS, sec, frac, digits, seq)
+    o = _put(buf, o, _SUM_I)
+    o = _hex(buf, o, can_id)
+    o = _put(buf, o, _SUM_N)
+    o = _dec(buf, o, n)
+    o = _put(buf, o, _SUM_D)
+    o = _dec_run(buf, o, data, off, dlc)
+    o = _put(buf, o, _SUM_LO)
+    o = _dec_run(buf, o, lo, off, span)
+    o = _put(buf, o, _SUM_HI)
+    o = _dec_run(buf, o, hi, off, span)
+    return _put(buf, o, _END)
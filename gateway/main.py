@@ -3,17 +3,25 @@ from machine import Pin, SPI, UART
 import utime
 import gc
 import array
+import uctypes
+import ubinascii
 import sys
 import uselect
 import ujson
 import mcp2515
+import avclan
+import binrec
+import jsonrec
+import usbout
+import timebase
+import canrx
 
 # --- HARDWARE CONFIGURATION ---
 # RP2040-Zero
 RX_PIN = 0
 TX_PIN = 1
 BAUDRATE = 1000000
-FW_VERSION = "2.27.0"  # AVC-LAN: drain PIO FIFO during CAN RX burst, diagnostics, and RS485 reads
+FW_VERSION = "2.52.13"  # Pending TX echo settled when raw mode changes
 
 # CAN CONFIG
 CAN_BAUDRATE = 500000   # Prius Gen2 OBD-II uses 500kbps
@@ -44,11 +52,122 @@ SPI_BAUDRATE = 4000000  # 4MHz - safe for prototype wiring
 DEV_ID_GATEWAY = 0
 DEV_ID_CAN     = 1
 DEV_ID_AVCLAN  = 2
+CH_RS485       = 3  # Output channel of forwarded RS485 lines (satellite ids 6-255)
 
 # CONFIG FLAGS
-ENABLE_SEQ_COUNTER = True # Adds "seq": <int> to all RX frames for continuity check
+ENABLE_SEQ_COUNTER = True # Adds "seq": <int> to all RX frames for continuity check (one counter per channel)
 ENABLE_ISOTP_DEBUG = False  # Enable ISO-TP state machine debug logging
 
+# TIMESTAMPS
+# Every CAN frame, subscription response and AVC-LAN frame is stamped with
+# ticks_us when it is read (MCP2515) or its capture pass is drained (PIO),
+# extended by timebase.Clock to a time since boot that does not wrap.
+# "ts" on frame lines is in ms by default, in µs with ENABLE_TS_US. Command
+# replies and status lines are stamped from the same clock (clk.ts_str()).
+# Forwarded RS485 lines without their own "ts" get one too.
+# {"id":0,"d":{"sync":n}} returns the gateway clock for host-side mapping.
+ENABLE_TS_US = False
+clk = timebase.Clock(ENABLE_TS_US)
+usb_rx_us = 0       # ticks_us when the last host command line was complete
+
+# BINARY OUTPUT
+# CAN frames, subscription responses and AVC-LAN frames as COBS-framed
+# binary records (binrec.py) instead of NDJSON lines. Everything else
+# (id 0 messages, TX status, RS485) stays NDJSON in the same stream.
+ENABLE_BINARY_OUTPUT = False
+bin_writer = binrec.RecordWriter()
+usb_bin = getattr(sys.stdout, "buffer", sys.stdout)
+
+# USB OUTPUT RING
+# Everything the main loop sends goes through a bounded ring (usbout.py)
+# that is drained only as far as the CDC endpoint accepts, so a host that
+# stops reading costs dropped records instead of a blocked loop (and with
+# it overflowing MCP2515 buffers and a lost AVC-LAN FIFO). Records are
+# coalesced: a burst goes out once USB_FLUSH_BYTES are queued or the oldest
+# record has waited USB_FLUSH_US. Frame serializers write straight into the
+# ring (jsonrec.py / binrec.py) and allocate nothing.
+# Drop policy: "low" refuses AVC-LAN records above 50% fill and CAN records
+# above 75%, keeping the rest for gateway messages; "old" discards the
+# oldest queued records. Dropped frames still take a sequence number.
+USB_RING_SIZE = 8192
+USB_FLUSH_BYTES = 512
+USB_FLUSH_US = 2000
+USB_DROP_POLICY = usbout.DROP_LOW
+USB_DROP_LIMITS = (100, 75, 50, 75)    # % of the ring per channel (id 0, 1, 2, RS485), "low" policy
+usb_out = usbout.OutputRing(usb_bin, USB_RING_SIZE, USB_FLUSH_BYTES, USB_FLUSH_US,
+                            policy=USB_DROP_POLICY, limits=USB_DROP_LIMITS)
+usb_diag_last = 0
+
+# AVC-LAN BURST AGGREGATION
+# Head units repeat identical status/ping frames many times a second. When
+# enabled, identical (m, s, c, data) frames within the window are folded
+# into one line carrying "cnt"; the line is flushed when a different frame
+# arrives or the window expires.
+AVC_AGG_ENABLED = False
+AVC_AGG_WINDOW_MS = 100
+
+# AVC-LAN RAW CAPTURE STREAMING
+# When enabled the gateway skips on-device decoding and forwards the PIO
+# words (frame trailers included) base64-packed, in batches of up to
+# AVC_RAW_WORDS or every AVC_RAW_FLUSH_MS. Decoding happens on the host
+# (host/avclan_raw.py). Address filter, state cache, emulation and the TX
+# loopback check need decoded frames and are inactive in this mode.
+AVC_RAW_ENABLED = False
+AVC_RAW_WORDS = 96          # 384 bytes -> 512 base64 chars per line
+AVC_RAW_FLUSH_MS = 20
+
+# AVC-LAN ADDRESS FILTER
+# Host-installed allow/deny rules on master/slave addresses, checked right
+# after a frame is decoded so rejected frames are never formatted for USB.
+avc_filter = avclan.AddressFilter(8)
+
+# AVC-LAN DEVICE STATE CACHE
+# Latest frame per (master, slave, first data byte), updated before the
+# address filter so a host can resync full bus state with one "snap" query
+# even when the live stream is filtered down.
+AVC_CACHE_SIZE = 64
+avc_cache = avclan.StateCache(AVC_CACHE_SIZE)
+# A snapshot goes out AVC_SNAP_CHUNK entries per line, one line per loop
+# iteration while the USB ring is at most half full, so neither a large
+# string nor a burst that evicts live records is ever built.
+AVC_SNAP_CHUNK = 4
+avc_snap = -1               # Next cache slot to dump, -1 = no snapshot running
+avc_snap_part = 0
+avc_snap_clr = False
+
+# AVC-LAN DEVICE EMULATION
+# Host-uploaded rules answered on the gateway itself: polls and pings need a
+# reply within a few ms, which a round trip over USB JSON cannot guarantee.
+avc_resp = avclan.Responder(8)
+
+# CAN SOFTWARE ID FILTER
+# Host-installed allow/deny ID ranges for sets larger than the MCP2515's six
+# hardware filters. Checked in recv_fast() right after the ID is parsed, so
+# rejected frames are never built or formatted. Attached to the driver only
+# while rules are installed.
+can_idfilter = canrx.IdFilter(32)
+
+# CAN OUTPUT POLICY
+# Per-ID output policy (pass / on-change / decimate / mute) applied before a
+# frame is formatted, plus periodic keyframes re-sending the latest payload
+# of every on-change and decimated ID. CAN_KEYFRAME_BATCH bounds how many
+# keyframe lines one main loop iteration queues.
+can_policy = canrx.PolicyTable(128)
+CAN_KEYFRAME_MS = 1000
+CAN_KEYFRAME_BATCH = 4
+CAN_POLICY_MODES = {"pass": canrx.PASS, "change": canrx.CHANGE, "dec": canrx.DECIMATE, "mute": canrx.MUTE}
+
+# CAN SUMMARY MODE
+# Instead of every frame, one line per active ID every CAN_SUMMARY_MS: frame
+# count, last payload and per-byte min/max over the window, accumulated in
+# preallocated tables. CAN_SUMMARY_RAW keeps the raw frame stream running
+# alongside the summaries.
+CAN_SUMMARY_ENABLED = False
+CAN_SUMMARY_MS = 100
+CAN_SUMMARY_RAW = False
+can_sum = canrx.Summary(128)
+can_sum_ms = 0          # ticks_ms when the current window opened
+
 # CAN MODE FLAGS
 CAN_TX_ENABLED = False  # Start in listen-only mode (passive sniffing)
 
@@ -76,8 +195,16 @@ OBD2_RESPONSE_IDS = [0x7E8, 0x7E9, 0x7EA, 0x7EB, 0x7EC, 0x7ED, 0x7EE, 0x7EF]
 gc.collect()
 
 # --- PIO 1: RX (SNIFFER - STABLE) ---
+# Frame boundary markers: Y counts down from ~0 once per sampled bit. On the
+# end-of-frame timeout the partial last word is pushed (valid bits
+# right-aligned, may be empty) followed by a trailer word = ~bit_count, so
+# the decoder knows where each frame starts and how many bits it holds.
+# The sample delay is pulled into the OSR once at start (the RX program
+# never shifts out) and copied to X for every bit, so it can be tuned by
+# restarting the SM with a new value instead of patching the program.
 @rp2.asm_pio(set_init=rp2.PIO.IN_HIGH, autopush=True, push_thresh=32)
 def avclan_rx_framed():
+    pull()                      # Sample delay
     wrap_target()
     label("idle_state")
     set(x, 31)
@@ -86,6 +213,7 @@ def avclan_rx_framed():
     jmp(pin, "idle_state")
     jmp(x_dec, "check_start") [2]
     wait(1, pin, 0)
+    mov(y, invert(null))        # Bit counter = 0xFFFFFFFF
 
     label("read_next_bit")
     set(x, 20)
@@ -94,34 +222,44 @@ def avclan_rx_framed():
     jmp("got_edge")
     label("check_timeout")
     jmp(x_dec, "wait_edge") [9]
+    push()                      # Partial last word
+    mov(isr, y)                 # Trailer: ~bit_count
     push()
     jmp("idle_state")
 
     label("got_edge")
     wait(1, pin, 0)
     
-    # Standard sampling point
-    set(x, 15)
+    # Sampling point: 2 cycles per delay count after the rising edge
+    mov(x, osr)
     label("delay_sample")
     jmp(x_dec, "delay_sample") [1]
     in_(pins, 1)
-    jmp("read_next_bit")
+    jmp(y_dec, "read_next_bit") # Count the bit (Y never reaches 0 within a frame)
     wrap()
 
 # --- PIO 2: TX (GENERATOR - STANDARD) ---
-@rp2.asm_pio(sideset_init=rp2.PIO.OUT_LOW, out_init=rp2.PIO.OUT_LOW, set_init=rp2.PIO.OUT_LOW, autopull=False)
+# Each frame is a bit-count word (bits - 1) followed by the data words. X
+# counts the bits down, so the start bit is sent once per frame and the
+# zero padding of the last word is never clocked out. The bit value is
+# shifted into Y, which is free again for the bit timing loops right after
+# the branch. With autopull a PULL is a no-op when the OSR was already
+# refilled with the next count word.
+@rp2.asm_pio(sideset_init=rp2.PIO.OUT_LOW, out_init=rp2.PIO.OUT_LOW, set_init=rp2.PIO.OUT_LOW, autopull=True, pull_thresh=32)
 def avclan_tx():
     pull() .side(0)
-    set(x, 29) .side(1)
+    mov(x, osr) .side(0)        # Bit counter
+    out(null, 32) .side(0)      # Empty the OSR: first data word is autopulled
+    set(y, 29) .side(1)
     label("start_on")
-    jmp(x_dec, "start_on") [5]
-    set(x, 19) .side(0)
+    jmp(y_dec, "start_on") [5]
+    set(y, 19) .side(0)
     label("start_off")
-    jmp(x_dec, "start_off")
+    jmp(y_dec, "start_off")
 
     label("bit_loop")
-    out(x, 1) .side(0)
-    jmp(not_x, "send_zero") .side(0)
+    out(y, 1) .side(0)
+    jmp(not_y, "send_zero") .side(0)
 
     set(y, 19) .side(1)
     label("one_on")
@@ -140,17 +278,80 @@ def avclan_tx():
     jmp(y_dec, "zero_off")
 
     label("check_end")
-    jmp(not_osre, "bit_loop") .side(0)
+    jmp(x_dec, "bit_loop") .side(0)
     nop() .side(0)
     wrap()
 
 # --- SETUP AVC-LAN ---
+# AVC-LAN SAMPLE POINT CALIBRATION
+# Transceiver latency shifts where the bit value is valid; a bad sample
+# point shows up as +1 shift rescues. A sweep tries every delay in
+# [AVC_CAL_LO, AVC_CAL_HI] for AVC_CAL_STEP_FRAMES frames (or
+# AVC_CAL_STEP_MS on a quiet bus) and keeps the one with the best clean
+# yield. It runs on request and again whenever the rescue rate over a diag
+# interval exceeds AVC_CAL_RESCUE_PERMILLE.
+AVC_SAMPLE_DELAY = 15       # Boot default (the former fixed set(x, 15))
+AVC_CAL_LO = 8
+AVC_CAL_HI = 22
+AVC_CAL_STEP_FRAMES = 40
+AVC_CAL_STEP_MS = 2000
+AVC_CAL_RESCUE_PERMILLE = 50
+AVC_CAL_MIN_FRAMES = 50     # Frames per diag interval before the rescue rate counts
+AVC_CAL_HOLDOFF_MS = 60000  # Minimum time between automatic sweeps
+avc_sample_delay = AVC_SAMPLE_DELAY
+avc_cal = avclan.DelayCalibrator(AVC_CAL_LO, AVC_CAL_HI, min_frames=8)
+avc_cal_step_ms = 0
+avc_cal_last_ms = 0
+avc_cal_base = (0, 0)       # frames, rescues at the start of the diag interval
+
 sm_rx = rp2.StateMachine(0, avclan_rx_framed, freq=BAUDRATE, in_base=Pin(RX_PIN), jmp_pin=Pin(RX_PIN))
+sm_rx.put(avc_sample_delay)
 sm_rx.active(1)
 
+def avc_set_sample_delay(delay):
+    # Restart clears the ISR and shift counters; a frame being captured is
+    # cut short and lands in the decoder as an unterminated region.
+    global avc_sample_delay
+    avc_sample_delay = delay
+    sm_rx.active(0)
+    sm_rx.restart()
+    sm_rx.put(delay)
+    sm_rx.active(1)
+
 tx_phy = Pin(TX_PIN, Pin.OUT, value=0)
 sm_tx = rp2.StateMachine(4, avclan_tx, freq=BAUDRATE, sideset_base=tx_phy, out_shiftdir=rp2.PIO.SHIFT_LEFT)
 sm_tx.active(1)
+rx_pin = Pin(RX_PIN)    # Bus idle level reads high
+
+# --- AVC-LAN TX QUEUE ---
+# Frames are encoded when the command arrives and queued; the main loop
+# starts a new frame only after the bus has been quiet for the inter-frame
+# gap, and a DMA channel then feeds all of its words to sm_tx's 4-word
+# FIFO, so a blocking call in the loop cannot let the FIFO run dry and cut
+# the frame short. Without DMA the loop hands words over while the FIFO
+# has room, and avc_tx_settle() completes the frame before a blocking call.
+# A busy bus never blocks the loop.
+AVC_TX_SLOTS = 8
+AVC_TX_GAP_US = 600         # Quiet time before a frame may start (~15 bit times)
+SM_TX_FIFO_DEPTH = 4
+DREQ_PIO1_TX0 = 8           # sm_tx is PIO1 SM0
+avc_txq = avclan.TxQueue(AVC_TX_SLOTS)
+avc_encoder = avclan.FrameEncoder(16)  # LRU of packed frames, hosts resend the same ones
+avc_rx_us = 0               # ticks_us of the last captured word
+avc_tx_us = 0               # Queue latency of the last frame started
+avc_tx_us_max = 0           # Longest queue latency in the current diag interval
+
+# TX loopback check: sm_rx captures our own frame too. The first frame
+# decoded after a transmission started must be identical to it; another
+# frame (lost arbitration) or none within AVC_TX_ECHO_MS (collision garbled
+# it) means the attempt failed and it is repeated after a backoff.
+AVC_TX_ECHO_MS = 30         # Longest frame is ~13 ms on the wire
+AVC_TX_RETRIES = 3
+AVC_TX_BACKOFF_US = 2000    # Doubled per retry, plus up to 1 ms jitter
+avc_tx_echo = None          # (m, s, c, data) awaiting loopback, None if idle
+avc_tx_start_ms = 0
+avc_tx_hold = False         # Head frame is backing off until avc_tx_hold_us
+avc_tx_hold_us = 0
 
 # --- SETUP CAN ---
 # MCP2515 requires SPI Mode 0,0 (CPOL=0, CPHA=0)
@@ -187,7 +388,7 @@ def rs485_send(data_str):
         
         rs485_en.value(0)
     except Exception as e:
-        sys.stdout.write(f'{{"id":0,"d":{{"err":"RS485_TX_FAIL: {str(e)}"}}}}\n')
+        usb_out.put(f'{{"id":0,"d":{{"err":"RS485_TX_FAIL: {str(e)}"}}}}\n')
 
 def debug_mcp2515_connection(spi, cs_pin):
     try:
@@ -244,114 +445,286 @@ else:
     can_ready = False
 
 # --- RX BUFFERS ---
+# Streaming decoder owns the capture buffer: words are fed as they leave the
+# PIO FIFO and frames are emitted as soon as their last bit has arrived.
+# framed=True: the PIO trailer words mark where each frame starts.
 RX_BUF_SIZE = 512
-rx_buffer = array.array('I', [0] * RX_BUF_SIZE)
+AVC_IDLE_MS = 8  # Bus silence after which an incomplete frame is abandoned
+avc_rx = avclan.StreamDecoder(RX_BUF_SIZE, framed=True)
+
+# --- AVC-LAN DMA CAPTURE ---
+# The PIO RX FIFO is only 8 words deep, so capture used to depend on every
+# blocking CAN/SPI/RS485 wait remembering to drain it. Instead a DMA channel
+# paced by the sm_rx DREQ streams words into a ring split into two halves:
+# DMA fills one half while the decoder takes the completed words of the
+# other. The write address wraps in hardware (ring_sel=write), so a main
+# loop that is blocked for longer than one ring period overwrites old words
+# (counted as dropped) instead of running DMA past the buffer end.
+AVC_DMA_RING_BITS = 10                          # Ring size = 2^10 bytes
+AVC_DMA_WORDS = (1 << AVC_DMA_RING_BITS) >> 2   # 256 words = 2 x 128-word halves
+AVC_DMA_COUNT = 0x3FFFFFFF                      # Transfers per arm (largest small int)
+DREQ_PIO0_RX0 = 4
+
+# Ring must be aligned to its size: over-allocate and pick the aligned window
+avc_dma_raw = array.array('I', [0] * (AVC_DMA_WORDS * 2))
+avc_dma_base = ((-uctypes.addressof(avc_dma_raw)) & ((1 << AVC_DMA_RING_BITS) - 1)) >> 2
+avc_dma_done = 0    # Words consumed since the channel was armed
+avc_dma = None
+
+def avc_dma_arm():
+    global avc_dma_done
+    avc_dma.config(read=sm_rx, write=uctypes.addressof(avc_dma_raw) + avc_dma_base * 4,
+                   count=AVC_DMA_COUNT, ctrl=avc_dma_ctrl, trigger=True)
+    avc_dma_done = 0
+
+try:
+    avc_dma = rp2.DMA()
+    avc_dma_ctrl = avc_dma.pack_ctrl(size=2, inc_read=False, inc_write=True,
+                                     ring_size=AVC_DMA_RING_BITS, ring_sel=True,
+                                     treq_sel=DREQ_PIO0_RX0, irq_quiet=True)
+    avc_dma_arm()
+except Exception as e:
+    avc_dma = None
+    sys.stdout.write(f'{{"id":0,"d":{{"log":"AVC DMA init error: {str(e)}, using FIFO polling"}}}}\n')
+
+# AVC-LAN TX DMA: one transfer per frame, paced by sm_tx's TX FIFO
+avc_tx_dma = None
+avc_tx_dma_busy = False     # Transfer of the head frame still running
+try:
+    avc_tx_dma = rp2.DMA()
+    avc_tx_dma_ctrl = avc_tx_dma.pack_ctrl(size=2, inc_read=True, inc_write=False,
+                                           treq_sel=DREQ_PIO1_TX0, irq_quiet=True)
+except Exception as e:
+    avc_tx_dma = None
+    sys.stdout.write(f'{{"id":0,"d":{{"log":"AVC TX DMA init error: {str(e)}, feeding the FIFO from the loop"}}}}\n')
 
 # --- CAN DIAGNOSTICS (periodic, from Core 0 main loop) ---
 can_diag_last = 0
 CAN_DIAG_INTERVAL = 5000  # ms
 
+# --- AVC-LAN DIAGNOSTICS (published with the same cadence as can_diag) ---
+avc_diag_last = 0
+avc_hwm = 0         # Capture backlog high-water mark (words waiting at poll time)
+avc_pass_us = 0     # Duration of the last decode pass
+avc_pass_max = 0    # Longest decode pass in the current diag interval
+
 serial_poll = uselect.poll()
 serial_poll.register(sys.stdin, uselect.POLLIN)
 input_buffer = ""
 
-# Sequence Counter (Cyclic 0-65535)
-tx_seq_counter = 0
+# Sequence Counters (Cyclic 0-65535), one per output channel (CAN, AVC-LAN,
+# RS485) so a gap on the host points at the stream that lost data. What the
+# gateway itself drops is counted per channel and sent with the drops summary.
+seq_counters = array.array('H', [0] * usbout.CHANNELS)
+rs485_bad = 0       # RS485 lines that were not valid JSON
 
-def get_next_seq():
-    global tx_seq_counter
-    seq = tx_seq_counter
-    tx_seq_counter = (tx_seq_counter + 1) & 0xFFFF
+def get_next_seq(ch):
+    seq = seq_counters[ch]
+    seq_counters[ch] = (seq + 1) & 0xFFFF
     return seq
 
 # --- LOGIC ---
-def get_bits_static(buf, start_bit, count):
-    result = 0
-    for i in range(count):
-        curr_ptr = start_bit + i
-        word_idx = curr_ptr // 32
-        if word_idx >= RX_BUF_SIZE: return -1
-        bit_in_word = 31 - (curr_ptr % 32)
-        bit = (buf[word_idx] >> bit_in_word) & 1
-        result = (result << 1) | bit
-    return result
-
-def check_parity_fast(val, width, parity_bit):
-    count = 0
-    v = val
-    while v: v &= (v - 1); count += 1
-    return ((count + parity_bit) % 2) != 0
-
-def print_avclan_frame(ts, m, s, c, data_bytes):
-    # Single sys.stdout.write() to minimize USB CDC packet fragmentation
-    d_str = ','.join('"' + '{:02X}'.format(b) + '"' for b in data_bytes)
-    seq_str = ',"seq":' + str(get_next_seq()) if ENABLE_SEQ_COUNTER else ''
-    sys.stdout.write('{"id":2,"ts":' + str(ts) + seq_str + ',"d":{"m":"' + '{:03X}'.format(m) + '","s":"' + '{:03X}'.format(s) + '","c":' + str(c) + ',"d":[' + d_str + ']}}\n')
-
-def print_can_frame(ts, can_id, data, ext):
-    # Single sys.stdout.write() to minimize USB CDC packet fragmentation
-    d_str = ','.join(str(b) for b in data)
-    seq_str = ',"seq":' + str(get_next_seq()) if ENABLE_SEQ_COUNTER else ''
-    sys.stdout.write('{"id":1,"ts":' + str(ts) + seq_str + ',"d":{"i":"0x' + '{:X}'.format(can_id) + '","d":[' + d_str + ']}}\n')
-
-# Helper function for frame decoding (used in retry loop)
-def try_decode(buf, ptr):
-    m = get_bits_static(buf, ptr, 12)
-    p = get_bits_static(buf, ptr+12, 1)
-    if not check_parity_fast(m, 12, p): return None
-    
-    s = get_bits_static(buf, ptr+13, 12)
-    p = get_bits_static(buf, ptr+25, 1)
-    if not check_parity_fast(s, 12, p): return None
-    
-    c = get_bits_static(buf, ptr+26, 4)
-    p = get_bits_static(buf, ptr+30, 1)
-    if not check_parity_fast(c, 4, p): return None
-    
-    l = get_bits_static(buf, ptr+31, 8)
-    p = get_bits_static(buf, ptr+39, 1)
-    if not check_parity_fast(l, 8, p): return None
-    
-    if l > 32: return None
-    
-    d_list = []
-    curr = ptr + 40
-    for _ in range(l):
-        val = get_bits_static(buf, curr, 8)
-        d_list.append(val)
-        curr += 9
-        
-    return (m, s, c, bytes(d_list), 40 + (l*9))
+def print_avclan_frame(t_us, m, s, c, data_bytes, rs_skip=0, rs_try=1, cnt=0):
+    o = usb_out.reserve(binrec.MAX_FRAMED if ENABLE_BINARY_OUTPUT else jsonrec.AVC_LINE_MAX, DEV_ID_AVCLAN)
+    if o < 0:
+        if ENABLE_SEQ_COUNTER: get_next_seq(DEV_ID_AVCLAN)     # Leave a gap the host can see
+        return
+    clk.stamp(t_us)
+    if ENABLE_BINARY_OUTPUT:
+        o = bin_writer.avc(usb_out.buf, o, clk.sec, clk.us, get_next_seq(DEV_ID_AVCLAN) if ENABLE_SEQ_COUNTER else 0, m, s, c, data_bytes, cnt)
+    else:
+        o = jsonrec.avc_line(usb_out.buf, o, clk.sec, clk.frac, clk.digits, get_next_seq(DEV_ID_AVCLAN) if ENABLE_SEQ_COUNTER else -1, m, s, c, data_bytes, rs_skip, rs_try, cnt)
+    usb_out.commit(o, DEV_ID_AVCLAN)
 
-def decode_smart_static(buf, ptr, limit_idx):
-    if (ptr // 32) > limit_idx: return None, 0
-    
-    # 1. Normal attempt (Shift = 0)
-    res = try_decode(buf, ptr)
-    if res:
-        m, s, c, d, length = res
-        return (m, s, c, d), length
-    
-    # 2. Rescue attempt (Shift = +1)
-    # If first attempt failed, try 1-bit shift
-    # (only if we have enough data)
-    res = try_decode(buf, ptr + 1)
-    if res:
-        m, s, c, d, length = res
-        # Return length + 1 to adjust pointer for the shift
-        return (m, s, c, d), length + 1
-        
-    return None, 0
-
-def tx_push(val, w, acc, fill):
-    for i in range(w - 1, -1, -1):
-        bit = (val >> i) & 1
-        acc = (acc << 1) | bit
-        fill += 1
-        if fill == 32:
-            sm_tx.put(acc)
-            acc = 0; fill = 0
-    return acc, fill
+# Pending burst: [t_us_first, m, s, c, data, rs_skip, rs_try, cnt] or None
+avc_agg = None
+
+def avc_agg_flush():
+    global avc_agg
+    if avc_agg:
+        t_us, m, s, c, d, rs_skip, rs_try, cnt = avc_agg
+        avc_agg = None
+        print_avclan_frame(t_us, m, s, c, d, rs_skip, rs_try, cnt)
+
+def emit_avclan_frame(t_us, m, s, c, d, rs_skip, rs_try):
+    global avc_agg
+    if not AVC_AGG_ENABLED:
+        print_avclan_frame(t_us, m, s, c, d, rs_skip, rs_try)
+        return
+    if avc_agg and avc_agg[1] == m and avc_agg[2] == s and avc_agg[3] == c and avc_agg[4] == d:
+        avc_agg[7] += 1
+        return
+    avc_agg_flush()
+    avc_agg = [t_us, m, s, c, d, rs_skip, rs_try, 1]
+
+def print_can_frame(t_us, can_id, data, ext):
+    o = usb_out.reserve(binrec.MAX_FRAMED if ENABLE_BINARY_OUTPUT else jsonrec.CAN_LINE_MAX, DEV_ID_CAN)
+    if o < 0:
+        if ENABLE_SEQ_COUNTER: get_next_seq(DEV_ID_CAN)
+        return
+    clk.stamp(t_us)
+    if ENABLE_BINARY_OUTPUT:
+        o = bin_writer.can(usb_out.buf, o, clk.sec, clk.us, get_next_seq(DEV_ID_CAN) if ENABLE_SEQ_COUNTER else 0, can_id, data, ext)
+    else:
+        o = jsonrec.can_line(usb_out.buf, o, clk.sec, clk.frac, clk.digits, get_next_seq(DEV_ID_CAN) if ENABLE_SEQ_COUNTER else -1, can_id, data)
+    usb_out.commit(o, DEV_ID_CAN)
+
+# Close the summary window: one line per ID seen in it
+def can_summary_flush():
+    global can_sum_ms
+    can_sum_ms = utime.ticks_ms()
+    clk.now()
+    for j in range(can_sum.n_active):
+        i = can_sum.order[j]
+        o = usb_out.reserve(jsonrec.SUM_LINE_MAX, DEV_ID_CAN)
+        if o < 0:
+            if ENABLE_SEQ_COUNTER: get_next_seq(DEV_ID_CAN)
+            continue
+        s_id, _ = can_sum.entry_id(i)
+        o = jsonrec.sum_line(usb_out.buf, o, clk.sec, clk.frac, clk.digits, get_next_seq(DEV_ID_CAN) if ENABLE_SEQ_COUNTER else -1,
+                             s_id, can_sum.count[i], can_sum.last, can_sum.lo, can_sum.hi, i << 3, can_sum.dlc[i], can_sum.span[i])
+        usb_out.commit(o, DEV_ID_CAN)
+    can_sum.reset()
+
+# Start the queued head frame once the bus is idle and hand its words (up
+# to 12, the FIFO holds 4) to the TX DMA, or without DMA feed them as FIFO
+# room appears. The frame stays queued until its loopback verdict.
+def drain_avclan_tx():
+    global avc_tx_us, avc_tx_us_max, avc_tx_echo, avc_tx_start_ms, avc_tx_hold, avc_tx_dma_busy
+    words = avc_txq.peek()
+    if words is None: return
+    pos = avc_txq.pos
+    n = len(words)
+    if avc_tx_dma_busy:
+        if avc_tx_dma.active(): return
+        # Every word is in the FIFO: the frame has left as far as the
+        # loopback check is concerned
+        avc_tx_dma_busy = False
+        avc_txq.pos = n
+        return
+    if pos >= n:
+        if avc_tx_echo is None:
+            avc_txq.pop()   # Queued without a loopback reference
+        elif utime.ticks_diff(utime.ticks_ms(), avc_tx_start_ms) > AVC_TX_ECHO_MS:
+            avc_tx_verdict(False)
+        return
+    if pos == 0:
+        now = utime.ticks_us()
+        if avc_tx_hold:
+            if utime.ticks_diff(now, avc_tx_hold_us) < 0: return
+            avc_tx_hold = False
+        quiet = utime.ticks_diff(now, avc_rx_us)
+        if quiet < AVC_TX_GAP_US or not rx_pin.value(): return
+        # A frame without its trailer yet is still on the bus, unless the
+        # trailer was lost and the decoder has given up on it
+        if avc_rx.in_frame() and quiet < AVC_IDLE_MS * 1000: return
+        head = avc_txq.head
+        avc_tx_us = utime.ticks_diff(now, avc_txq.ts[head])
+        if avc_tx_us > avc_tx_us_max: avc_tx_us_max = avc_tx_us
+        if avc_txq.tag[head] and not avc_txq.retries[head]:
+            avc_resp.record(avc_txq.tag[head] - 1, avc_tx_us)
+        avc_tx_echo = None if AVC_RAW_ENABLED else avc_txq.meta[avc_txq.head]
+        avc_tx_start_ms = utime.ticks_ms()
+        if avc_tx_dma is not None:
+            avc_tx_dma.config(read=words, write=sm_tx, count=n, ctrl=avc_tx_dma_ctrl, trigger=True)
+            avc_tx_dma_busy = True
+            return
+    while pos < n and sm_tx.tx_fifo() < SM_TX_FIFO_DEPTH:
+        sm_tx.put(words[pos])
+        pos += 1
+    avc_txq.pos = pos
+
+# True once every word of the head frame is in the FIFO. Asks the DMA
+# directly, as the decode pass may run before drain_avclan_tx() saw it end.
+def avc_tx_left():
+    if avc_tx_dma_busy:
+        return not avc_tx_dma.active()
+    return avc_txq.pos >= len(avc_txq.peek())
+
+# Without TX DMA: put the rest of a frame being sent into the FIFO before a
+# blocking CAN call, which would otherwise let the FIFO run dry mid-frame.
+# Blocks for at most one frame time (put() waits for FIFO room).
+def avc_tx_settle():
+    if avc_tx_dma is not None: return
+    words = avc_txq.peek()
+    pos = avc_txq.pos
+    if words is None or pos == 0: return
+    while pos < len(words):
+        sm_tx.put(words[pos])
+        pos += 1
+    avc_txq.pos = pos
+
+# Outcome of the frame on the bus: retry after a backoff, or retire it and
+# report the result with the retries spent in one status line.
+def avc_tx_verdict(ok):
+    global avc_tx_echo, avc_tx_hold, avc_tx_hold_us, avc_tx_dma_busy
+    m, s, c, d = avc_tx_echo
+    avc_tx_echo = None
+    avc_tx_dma_busy = False     # Verdicts come only after the transfer ended
+    rt = avc_txq.retries[avc_txq.head]
+    if not ok and rt < AVC_TX_RETRIES:
+        avc_txq.rewind()
+        now = utime.ticks_us()
+        avc_tx_hold = True
+        avc_tx_hold_us = utime.ticks_add(now, (AVC_TX_BACKOFF_US << rt) + (now & 0x3FF))
+        return
+    tag = avc_txq.tag[avc_txq.head]
+    avc_txq.pop(ok)
+    if tag:
+        # Emulated reply: no status line, failures are counted per rule
+        if not ok: avc_resp.failed[tag - 1] += 1
+        return
+    usb_out.put('{"id":2,"ts":' + clk.now().ts_str() + ',"d":{"a":"tx","m":"' + '{:03X}'.format(m) + '","s":"' + '{:03X}'.format(s) + '","ok":' + ('true' if ok else 'false') + ',"rt":' + str(rt) + '}}\n')
+
+# Queue the replies of the first response rule matching a decoded frame.
+# Queue time is the capture of the trigger, so the per-rule latency covers
+# decode, queueing and waiting for the bus.
+def avc_respond(m, s, c, d):
+    i = avc_resp.match(m, s, c, d)
+    if i < 0: return
+    for reply in avc_resp.replies[i]:
+        rm, rs, rc, rd = avc_resp.build(reply, m, s, d)
+        if not avc_txq.push(avc_encoder.encode(rm, rs, rc, rd), avc_rx_us, (rm, rs, rc, rd), i + 1):
+            avc_resp.failed[i] += 1
+            break
+
+# One line of a running snapshot; the last one carries the totals and ends it
+def avc_snap_step():
+    global avc_snap, avc_snap_part
+    if usb_out.used > usb_out.size // 2: return
+    parts = []
+    i = avc_snap
+    while i < avc_cache.size and len(parts) < AVC_SNAP_CHUNK:
+        e = avc_cache.entry(i)
+        i += 1
+        if not e: continue
+        e_s, e_us, m, s, c, d = e
+        parts.append('{"ts":' + clk.fmt(e_s, e_us) + ',"m":"' + '{:03X}'.format(m) + '","s":"' + '{:03X}'.format(s) + '","c":' + str(c) + ',"d":[' + ','.join('"' + '{:02X}'.format(b) + '"' for b in d) + ']}')
+    line = '{"id":2,"ts":' + clk.now().ts_str() + ',"d":{"snap":[' + ','.join(parts) + '],"part":' + str(avc_snap_part)
+    if i < avc_cache.size:
+        usb_out.put(line + '}}\n')
+        avc_snap = i
+        avc_snap_part += 1
+        return
+    usb_out.put(line + ',"last":true,"n":' + str(avc_cache.n) + ',"evict":' + str(avc_cache.evicted) + '}}\n')
+    avc_snap = -1
+    if avc_snap_clr:
+        avc_cache.clear()
+
+def parse_resp_addr(v):
+    if v == "$m": return avclan.FROM_MASTER
+    if v == "$s": return avclan.FROM_SLAVE
+    return int(v, 16) & 0xFFF
+
+def avc_fault_total():
+    hf = avc_rx.header_faults
+    return hf[0] + hf[1] + hf[2] + hf[3] + hf[4]
+
+def avc_cal_start(now):
+    global avc_cal_step_ms, avc_cal_last_ms
+    avc_cal_step_ms = now
+    avc_cal_last_ms = now
+    avc_set_sample_delay(avc_cal.start(avc_sample_delay, avc_rx.frames, avc_rx.rescues, avc_fault_total()))
 
 def process_usb_command(json_line):
     global CAN_TX_ENABLED, CAN_SUBSCRIPTIONS
@@ -364,7 +737,7 @@ def process_usb_command(json_line):
         # Debug: echo received command type for diagnostics
         data_peek = cmd.get("d", {})
         action_peek = data_peek.get("a", "") if isinstance(data_peek, dict) else ""
-        sys.stdout.write('{"id":0,"d":{"log":"USB_RX","dev":' + str(dev_id) + ',"a":"' + str(action_peek) + '"}}\n')
+        usb_out.put('{"id":0,"d":{"log":"USB_RX","dev":' + str(dev_id) + ',"a":"' + str(action_peek) + '"}}\n')
         
         # System Commands (Configuration)
         if dev_id == DEV_ID_GATEWAY:
@@ -374,38 +747,201 @@ def process_usb_command(json_line):
             if "seq" in cfg:
                 global ENABLE_SEQ_COUNTER
                 ENABLE_SEQ_COUNTER = bool(cfg["seq"])
-                sys.stdout.write('{"id":0,"d":{"msg":"CFG_UPDATED","seq":' + str(ENABLE_SEQ_COUNTER).lower() + '}}\n')
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","seq":' + str(ENABLE_SEQ_COUNTER).lower() + '}}\n')
             
             if "isotp_debug" in cfg:
                 global ENABLE_ISOTP_DEBUG
                 ENABLE_ISOTP_DEBUG = bool(cfg["isotp_debug"])
-                sys.stdout.write('{"id":0,"d":{"msg":"CFG_UPDATED","isotp_debug":' + str(ENABLE_ISOTP_DEBUG).lower() + '}}\n')
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","isotp_debug":' + str(ENABLE_ISOTP_DEBUG).lower() + '}}\n')
+
+            if "bin" in cfg:
+                global ENABLE_BINARY_OUTPUT
+                ENABLE_BINARY_OUTPUT = bool(cfg["bin"])
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","bin":' + str(ENABLE_BINARY_OUTPUT).lower() + '}}\n')
+
+            if "ts_us" in cfg:
+                global ENABLE_TS_US
+                ENABLE_TS_US = bool(cfg["ts_us"])
+                clk.set_units(ENABLE_TS_US)
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","ts_us":' + str(ENABLE_TS_US).lower() + '}}\n')
+
+            # --- Clock sync: rx = command line complete, tx = reply queued (µs since boot) ---
+            if "sync" in cfg:
+                rx = clk.stamp(usb_rx_us).us_str()
+                usb_out.put('{"id":0,"d":{"sync":' + str(int(cfg["sync"])) + ',"rx":' + rx + ',"tx":' + clk.now().us_str() + '}}\n', urgent=True)
+                usb_out.poll()
+
+            if "usb_flush_bytes" in cfg or "usb_flush_us" in cfg:
+                if "usb_flush_bytes" in cfg:
+                    usb_out.threshold = max(0, min(USB_RING_SIZE, int(cfg["usb_flush_bytes"])))
+                if "usb_flush_us" in cfg:
+                    usb_out.deadline_us = max(0, int(cfg["usb_flush_us"]))
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","usb_flush_bytes":' + str(usb_out.threshold) + ',"usb_flush_us":' + str(usb_out.deadline_us) + '}}\n')
+
+            if "usb_drop" in cfg:
+                usb_out.policy = usbout.DROP_OLDEST if cfg["usb_drop"] == "old" else usbout.DROP_LOW
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","usb_drop":"' + ("low" if usb_out.policy == usbout.DROP_LOW else "old") + '"}}\n')
+
+            if "avc_dly" in cfg:
+                avc_set_sample_delay(max(0, min(31, int(cfg["avc_dly"]))))
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","avc_dly":' + str(avc_sample_delay) + '}}\n')
+
+            if cfg.get("avc_cal") and not avc_cal.active:
+                avc_cal_start(utime.ticks_ms())
+                usb_out.put('{"id":0,"d":{"msg":"AVC_CAL_STARTED","from":' + str(AVC_CAL_LO) + ',"to":' + str(AVC_CAL_HI) + '}}\n')
+
+            if "avc_raw" in cfg:
+                global AVC_RAW_ENABLED, avc_tx_echo
+                if not cfg["avc_raw"]: avc_raw_flush()
+                if bool(cfg["avc_raw"]) != AVC_RAW_ENABLED:
+                    # Nothing decodes the frame awaiting its echo across the
+                    # switch: retire it unchecked, as raw mode sends frames
+                    avc_tx_echo = None
+                AVC_RAW_ENABLED = bool(cfg["avc_raw"])
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","avc_raw":' + str(AVC_RAW_ENABLED).lower() + '}}\n')
+
+            if "avc_agg" in cfg or "avc_agg_ms" in cfg:
+                global AVC_AGG_ENABLED, AVC_AGG_WINDOW_MS
+                if "avc_agg" in cfg:
+                    AVC_AGG_ENABLED = bool(cfg["avc_agg"])
+                    if not AVC_AGG_ENABLED: avc_agg_flush()
+                if "avc_agg_ms" in cfg:
+                    AVC_AGG_WINDOW_MS = max(1, int(cfg["avc_agg_ms"]))
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","avc_agg":' + str(AVC_AGG_ENABLED).lower() + ',"avc_agg_ms":' + str(AVC_AGG_WINDOW_MS) + '}}\n')
+
+            if "can_sum" in cfg or "can_sum_ms" in cfg or "can_raw" in cfg:
+                global CAN_SUMMARY_ENABLED, CAN_SUMMARY_MS, CAN_SUMMARY_RAW, can_sum_ms
+                if "can_sum_ms" in cfg:
+                    CAN_SUMMARY_MS = max(10, int(cfg["can_sum_ms"]))
+                if "can_raw" in cfg:
+                    CAN_SUMMARY_RAW = bool(cfg["can_raw"])
+                if "can_sum" in cfg:
+                    on = bool(cfg["can_sum"])
+                    if on and not CAN_SUMMARY_ENABLED:
+                        can_sum.clear()
+                        can_sum_ms = utime.ticks_ms()
+                    elif CAN_SUMMARY_ENABLED and not on:
+                        can_summary_flush()
+                    CAN_SUMMARY_ENABLED = on
+                usb_out.put('{"id":0,"d":{"msg":"CFG_UPDATED","can_sum":' + str(CAN_SUMMARY_ENABLED).lower() + ',"can_sum_ms":' + str(CAN_SUMMARY_MS) + ',"can_raw":' + str(CAN_SUMMARY_RAW).lower() + '}}\n')
             return
 
         data = cmd.get("d")
         if not data: return
 
         if dev_id == DEV_ID_AVCLAN:
-            m = int(data["m"], 16); s = int(data["s"], 16); c = int(data["c"])
-            d_arr = [int(x, 16) for x in data["d"]]
-            acc = 0; fill = 0
-            for val, w in [(m,12), (s,12), (c,4), (len(d_arr),8)]:
-                cnt = 0; v=val
-                while v: v &= (v-1); cnt += 1
-                p = 1 if (cnt % 2) == 0 else 0
-                acc, fill = tx_push(val, w, acc, fill)
-                acc, fill = tx_push(p, 1, acc, fill)
-            for b in d_arr:
-                cnt = 0; v=b
-                while v: v &= (v-1); cnt += 1
-                p = 1 if (cnt % 2) == 0 else 0
-                acc, fill = tx_push(b, 8, acc, fill)
-                acc, fill = tx_push(p, 1, acc, fill)
-            if fill > 0: sm_tx.put(acc << (32 - fill))
+            action = data.get("a", "tx")  # Default action is "tx" (send frame)
+
+            # --- ACTION: tx (Send AVC-LAN frame) ---
+            # "d" is ["01","FF"] or the compact form "01FF"
+            if action == "tx":
+                m = int(data["m"], 16); s = int(data["s"], 16); c = int(data["c"])
+                try:
+                    payload = avclan.parse_payload(data.get("d", []))
+                except ValueError:
+                    usb_out.put('{"id":0,"d":{"err":"AVC_BAD_PAYLOAD"}}\n')
+                    return
+                m &= 0xFFF; s &= 0xFFF; c &= 0xF
+                words = avc_encoder.encode(m, s, c, payload)
+                # Queued, sent from the main loop once the bus is idle
+                if not avc_txq.push(words, utime.ticks_us(), (m, s, c, payload)):
+                    usb_out.put('{"id":0,"d":{"err":"TX_QUEUE_FULL"}}\n')
+
+            # --- ACTION: filter (Install address allow/deny rules) ---
+            elif action == "filter":
+                # {"id":2,"d":{"a":"filter","r":[{"p":"allow","m":"190"},{"p":"deny","s":"1F0","sm":"FF0"}],"def":"deny"}}
+                # Replaces the whole rule set; "r":[] clears it (everything passes)
+                rules = data.get("r", [])
+                if len(rules) > avc_filter.max_rules:
+                    usb_out.put('{"id":0,"d":{"err":"FILTER_FULL"}}\n')
+                    return
+                # Every rule is parsed before the table is touched, so a bad
+                # request leaves the previous rules in place.
+                parsed = []
+                try:
+                    for r in rules:
+                        f_m = int(r.get("m", "0"), 16) & 0xFFF
+                        f_s = int(r.get("s", "0"), 16) & 0xFFF
+                        # Mask defaults: exact match if the address is given, wildcard otherwise
+                        f_mm = int(r.get("mm", "FFF" if "m" in r else "0"), 16)
+                        f_sm = int(r.get("sm", "FFF" if "s" in r else "0"), 16)
+                        parsed.append((r.get("p", "allow") == "allow", f_m, f_mm, f_s, f_sm))
+                except (ValueError, TypeError, AttributeError):
+                    usb_out.put('{"id":0,"d":{"err":"AVC_FILTER_BAD"}}\n')
+                    return
+                avc_filter.clear()
+                for rule in parsed:
+                    avc_filter.add(*rule)
+                avc_filter.default_allow = data.get("def", "allow") == "allow"
+                usb_out.put('{"id":0,"d":{"msg":"AVC_FILTER_OK","n":' + str(avc_filter.n) + '}}\n')
+
+            # --- ACTION: filters (List rules with hit counts) ---
+            elif action == "filters":
+                rule_list = []
+                for i in range(avc_filter.n):
+                    mask = avc_filter.mask[i]
+                    val = avc_filter.value[i]
+                    rule_list.append({
+                        "p": "allow" if avc_filter.allow[i] else "deny",
+                        "m": "{:03X}".format(val >> 12), "mm": "{:03X}".format(mask >> 12),
+                        "s": "{:03X}".format(val & 0xFFF), "sm": "{:03X}".format(mask & 0xFFF),
+                        "hit": avc_filter.hits[i]
+                    })
+                usb_out.put('{"id":0,"d":{"avc_filters":' + ujson.dumps(rule_list) + ',"def":"' + ("allow" if avc_filter.default_allow else "deny") + '","def_hit":' + str(avc_filter.default_hits) + '}}\n')
+
+            # --- ACTION: resp (Install device emulation rules) ---
+            elif action == "resp":
+                # {"id":2,"d":{"a":"resp","r":[{"s":"1F1","d":"00","dm":"FF","tx":[{"m":"$s","s":"$m","c":0,"d":"0001"}]}]}}
+                # Replaces the whole table; "r":[] stops emulation
+                rules = data.get("r", [])
+                if len(rules) > avc_resp.max_rules:
+                    usb_out.put('{"id":0,"d":{"err":"RESP_FULL"}}\n')
+                    return
+                # Every rule is parsed before the table is touched, so a bad
+                # request leaves the previous rules in place.
+                parsed = []
+                try:
+                    for r in rules:
+                        pat = avclan.parse_payload(r.get("d", ""))
+                        pat_mask = avclan.parse_payload(r["dm"]) if "dm" in r else b'\xff' * len(pat)
+                        replies = []
+                        for t in r.get("tx", []):
+                            subs = tuple((int(p[0]), int(p[1])) for p in t.get("sub", []))
+                            replies.append((parse_resp_addr(t.get("m", "$s")), parse_resp_addr(t.get("s", "$m")),
+                                            int(t.get("c", 0)) & 0xF, avclan.parse_payload(t.get("d", "")), subs))
+                        parsed.append((int(r.get("m", "0"), 16), int(r.get("mm", "FFF" if "m" in r else "0"), 16),
+                                       int(r.get("s", "0"), 16), int(r.get("sm", "FFF" if "s" in r else "0"), 16),
+                                       int(r.get("c", -1)), pat, pat_mask, replies))
+                except (ValueError, TypeError, IndexError):
+                    usb_out.put('{"id":0,"d":{"err":"AVC_BAD_PAYLOAD"}}\n')
+                    return
+                avc_resp.clear()
+                for rule in parsed:
+                    avc_resp.add(*rule)
+                usb_out.put('{"id":0,"d":{"msg":"AVC_RESP_OK","n":' + str(avc_resp.n) + '}}\n')
+
+            # --- ACTION: resps (Response rule statistics) ---
+            elif action == "resps":
+                parts = []
+                for i in range(avc_resp.n):
+                    parts.append('{"hit":' + str(avc_resp.hits[i]) + ',"fail":' + str(avc_resp.failed[i]) + ',"us":' + str(avc_resp.lat_us[i]) + ',"us_max":' + str(avc_resp.lat_max[i]) + '}')
+                usb_out.put('{"id":0,"d":{"avc_resps":[' + ','.join(parts) + ']}}\n')
+
+            # --- ACTION: snap (Dump the device state cache, a few entries per line) ---
+            elif action == "snap":
+                # {"id":2,"d":{"a":"snap"}} or {"id":2,"d":{"a":"snap","clr":true}} to reset after the dump
+                # A snap while one is running restarts it from the first slot
+                global avc_snap, avc_snap_part, avc_snap_clr
+                avc_snap = 0
+                avc_snap_part = 0
+                avc_snap_clr = bool(data.get("clr"))
+
+            else:
+                usb_out.put('{"id":0,"d":{"err":"UNKNOWN_ACTION"}}\n')
 
         elif dev_id == DEV_ID_CAN:
             if not can_ready:
-                sys.stdout.write('{"id":0,"d":{"err":"CAN_OFFLINE"}}\n')
+                usb_out.put('{"id":0,"d":{"err":"CAN_OFFLINE"}}\n')
                 return
             
             action = data.get("a", "tx")  # Default action is "tx" (send frame)
@@ -426,11 +962,11 @@ def process_usb_command(json_line):
                     if can.enable_tx():
                         CAN_TX_ENABLED = True
                     else:
-                        sys.stdout.write('{"id":0,"d":{"err":"CAN_MODE_SWITCH_FAIL"}}\n')
+                        usb_out.put('{"id":0,"d":{"err":"CAN_MODE_SWITCH_FAIL"}}\n')
                         return
                 
                 if not can.send(can_id, can_data, is_ext):
-                    sys.stdout.write('{"id":0,"d":{"err":"CAN_TX_FULL"}}\n')
+                    usb_out.put('{"id":0,"d":{"err":"CAN_TX_FULL"}}\n')
             
             # --- ACTION: req (Single request-response query) ---
             elif action == "req":
@@ -467,11 +1003,12 @@ def process_usb_command(json_line):
                     if can.enable_tx():
                         CAN_TX_ENABLED = True
                     else:
-                        sys.stdout.write('{"id":0,"d":{"err":"CAN_MODE_SWITCH_FAIL"}}\n')
+                        usb_out.put('{"id":0,"d":{"err":"CAN_MODE_SWITCH_FAIL"}}\n')
                         return
                 
+                avc_tx_settle()
                 if use_isotp:
-                    result = can.send_and_wait_isotp(can_id, can_data, resp_ids, timeout, is_ext, ENABLE_ISOTP_DEBUG)
+                    result = can.send_and_wait_isotp(can_id, can_data, resp_ids, timeout, is_ext, ENABLE_ISOTP_DEBUG, log_cb=usb_out.put)
                 else:
                     result = can.send_and_wait(can_id, can_data, resp_ids, timeout, is_ext)
                 
@@ -479,10 +1016,10 @@ def process_usb_command(json_line):
                     resp_id, resp_data = result
                     # Single write for USB CDC efficiency
                     d_str = ','.join(str(b) for b in resp_data)
-                    seq_str = ',"seq":' + str(get_next_seq()) if ENABLE_SEQ_COUNTER else ''
-                    sys.stdout.write('{"id":1,"ts":' + str(utime.ticks_ms()) + seq_str + ',"d":{"a":"resp","i":"0x' + '{:X}'.format(resp_id) + '","d":[' + d_str + ']}}\n')
+                    seq_str = ',"seq":' + str(get_next_seq(DEV_ID_CAN)) if ENABLE_SEQ_COUNTER else ''
+                    usb_out.put('{"id":1,"ts":' + clk.now().ts_str() + seq_str + ',"d":{"a":"resp","i":"0x' + '{:X}'.format(resp_id) + '","d":[' + d_str + ']}}\n')
                 else:
-                    sys.stdout.write('{"id":1,"d":{"a":"resp","err":"TIMEOUT"}}\n')
+                    usb_out.put('{"id":1,"d":{"a":"resp","err":"TIMEOUT"}}\n')
             
             # --- ACTION: sub (Subscribe to periodic polling) ---
             elif action == "sub":
@@ -490,7 +1027,7 @@ def process_usb_command(json_line):
                 # {"id":1,"d":{"a":"sub","slot":0,"i":"0x7DF","d":[2,1,12],"r":["0x7E8"],"int":500,"t":100}}
                 slot = data.get("slot")
                 if slot is None or slot < 0 or slot >= MAX_SUBSCRIPTIONS:
-                    sys.stdout.write('{"id":0,"d":{"err":"INVALID_SLOT"}}\n')
+                    usb_out.put('{"id":0,"d":{"err":"INVALID_SLOT"}}\n')
                     return
                 
                 can_id_str = data.get("i")
@@ -536,23 +1073,23 @@ def process_usb_command(json_line):
                     if can.enable_tx():
                         CAN_TX_ENABLED = True
                     else:
-                        sys.stdout.write('{"id":0,"d":{"err":"CAN_MODE_SWITCH_FAIL"}}\n')
+                        usb_out.put('{"id":0,"d":{"err":"CAN_MODE_SWITCH_FAIL"}}\n')
                         del CAN_SUBSCRIPTIONS[slot]
                         return
                 
-                sys.stdout.write('{"id":0,"d":{"msg":"SUB_OK","slot":' + str(slot) + '}}\n')
+                usb_out.put('{"id":0,"d":{"msg":"SUB_OK","slot":' + str(slot) + '}}\n')
             
             # --- ACTION: unsub (Unsubscribe from slot) ---
             elif action == "unsub":
                 slot = data.get("slot")
                 if slot is not None and slot in CAN_SUBSCRIPTIONS:
                     del CAN_SUBSCRIPTIONS[slot]
-                    sys.stdout.write('{"id":0,"d":{"msg":"UNSUB_OK","slot":' + str(slot) + '}}\n')
+                    usb_out.put('{"id":0,"d":{"msg":"UNSUB_OK","slot":' + str(slot) + '}}\n')
                 elif slot == "all":
                     CAN_SUBSCRIPTIONS.clear()
-                    sys.stdout.write('{"id":0,"d":{"msg":"UNSUB_ALL"}}\n')
+                    usb_out.put('{"id":0,"d":{"msg":"UNSUB_ALL"}}\n')
                 else:
-                    sys.stdout.write('{"id":0,"d":{"err":"SLOT_NOT_FOUND"}}\n')
+                    usb_out.put('{"id":0,"d":{"err":"SLOT_NOT_FOUND"}}\n')
             
             # --- ACTION: mode (Switch CAN mode) ---
             elif action == "mode":
@@ -560,19 +1097,156 @@ def process_usb_command(json_line):
                 if mode == "normal" or mode == "tx":
                     if can.enable_tx():
                         CAN_TX_ENABLED = True
-                        sys.stdout.write('{"id":0,"d":{"msg":"CAN_MODE","m":"NORMAL"}}\n')
+                        usb_out.put('{"id":0,"d":{"msg":"CAN_MODE","m":"NORMAL"}}\n')
                     else:
-                        sys.stdout.write('{"id":0,"d":{"err":"MODE_SWITCH_FAIL"}}\n')
+                        usb_out.put('{"id":0,"d":{"err":"MODE_SWITCH_FAIL"}}\n')
                 elif mode == "listen":
                     if can.disable_tx():
                         CAN_TX_ENABLED = False
                         CAN_SUBSCRIPTIONS.clear()  # Clear subscriptions when going passive
-                        sys.stdout.write('{"id":0,"d":{"msg":"CAN_MODE","m":"LISTEN"}}\n')
+                        usb_out.put('{"id":0,"d":{"msg":"CAN_MODE","m":"LISTEN"}}\n')
                     else:
-                        sys.stdout.write('{"id":0,"d":{"err":"MODE_SWITCH_FAIL"}}\n')
+                        usb_out.put('{"id":0,"d":{"err":"MODE_SWITCH_FAIL"}}\n')
+                else:
+                    usb_out.put('{"id":0,"d":{"err":"INVALID_MODE"}}\n')
+
+            # --- ACTION: filter (Program MCP2515 hardware acceptance filters) ---
+            elif action == "filter":
+                # {"id":1,"d":{"a":"filter","m":["0x7FF","0x7F8"],"f":["0x2C4","0x3CA","0x7E8"]}}
+                # "f": 1-6 IDs; RXF0-1 (mask m[0]) feed RXB0, RXF2-5 (mask m[1]) RXB1.
+                # Unused filters repeat one of their buffer's; with at most two IDs
+                # RXB1 gets RXB0's set. {"a":"filter","off":true} receives everything.
+                if data.get("off"):
+                    ok = can.set_filters(None, None)
+                    n = 0
+                else:
+                    ext = bool(data.get("e", False))
+                    ids = [int(v, 16) if isinstance(v, str) else int(v) for v in data.get("f", [])]
+                    masks = [int(v, 16) if isinstance(v, str) else int(v) for v in data.get("m", [])]
+                    if not 0 < len(ids) <= 6 or len(masks) > 2:
+                        usb_out.put('{"id":0,"d":{"err":"CAN_FILTER_BAD"}}\n')
+                        return
+                    if not masks:
+                        masks = [0x1FFFFFFF if ext else 0x7FF]
+                    if len(masks) == 1:
+                        masks.append(masks[0])
+                    b0 = ids[:2]
+                    b1 = ids[2:]
+                    if not b1:
+                        b1 = b0
+                        masks[1] = masks[0]
+                    filters = [(b0[i % len(b0)], ext) for i in range(2)] + [(b1[i % len(b1)], ext) for i in range(4)]
+                    ok = can.set_filters([(masks[0], ext), (masks[1], ext)], filters)
+                    n = len(ids)
+                if ok:
+                    usb_out.put('{"id":0,"d":{"msg":"CAN_FILTER_OK","n":' + str(n) + '}}\n')
                 else:
-                    sys.stdout.write('{"id":0,"d":{"err":"INVALID_MODE"}}\n')
+                    usb_out.put('{"id":0,"d":{"err":"CAN_MODE_SWITCH_FAIL"}}\n')
+
+            # --- ACTION: filters (Read the active filter set back from the MCP2515) ---
+            elif action == "filters":
+                enabled, masks, filters = can.get_filters()
+                fmt = lambda v: '"0x' + ('{:08X}' if v[1] else '{:03X}').format(v[0]) + '"'
+                usb_out.put('{"id":0,"d":{"can_filters":{"on":' + str(enabled).lower() + ',"m":[' + ','.join(fmt(v) for v in masks) + '],"f":[' + ','.join(fmt(v) for v in filters) + ']}}}\n')
+
+            # --- ACTION: swfilter (Install software ID allow/deny ranges) ---
+            elif action == "swfilter":
+                # {"id":1,"d":{"a":"swfilter","r":[{"p":"allow","i":"0x2C4"},{"p":"allow","lo":"0x3C8","hi":"0x3CF"}],"def":"deny"}}
+                # Later rules override earlier ones; "e":true marks an extended
+                # rule. Replaces the whole set and its drop counts; "r":[] turns
+                # the filter off.
+                rules = data.get("r", [])
+                if len(rules) > can_idfilter.max_rules:
+                    usb_out.put('{"id":0,"d":{"err":"FILTER_FULL"}}\n')
+                    return
+                # Every rule is checked before the filter is touched, so a bad
+                # request leaves the previous filter installed.
+                parsed = []
+                try:
+                    for r in rules:
+                        lo = r.get("lo", r.get("i", 0))
+                        lo = int(lo, 16) if isinstance(lo, str) else int(lo)
+                        hi = r.get("hi", lo)
+                        hi = int(hi, 16) if isinstance(hi, str) else int(hi)
+                        ext = bool(r.get("e", False))
+                        if not 0 <= lo <= hi <= (0x1FFFFFFF if ext else 0x7FF):
+                            raise ValueError
+                        parsed.append((r.get("p", "allow") == "allow", lo, hi, ext))
+                except (ValueError, TypeError, AttributeError):
+                    usb_out.put('{"id":0,"d":{"err":"CAN_FILTER_BAD"}}\n')
+                    return
+                can.id_filter = None
+                can_idfilter.clear(data.get("def", "allow") == "allow")
+                for rule in parsed:
+                    can_idfilter.add(*rule)
+                if can_idfilter.n:
+                    can.id_filter = can_idfilter
+                usb_out.put('{"id":0,"d":{"msg":"CAN_SWFILTER_OK","n":' + str(can_idfilter.n) + '}}\n')
+
+            # --- ACTION: swfilters (List software ID rules with drop counts) ---
+            elif action == "swfilters":
+                idf = can_idfilter
+                rule_list = []
+                for i in range(idf.n):
+                    fmt = '0x{:08X}' if idf.ext[i] else '0x{:03X}'
+                    rule_list.append({
+                        "p": "allow" if idf.allow[i] else "deny",
+                        "lo": fmt.format(idf.lo[i]), "hi": fmt.format(idf.hi[i]),
+                        "e": idf.ext[i] == 1,
+                        "drop": idf.drops[i + 1]
+                    })
+                usb_out.put('{"id":0,"d":{"can_swfilters":{"on":' + str(can.id_filter is not None).lower() + ',"r":' + ujson.dumps(rule_list) + ',"def":"' + ("allow" if idf.default_allow else "deny") + '","def_drop":' + str(idf.drops[0]) + '}}}\n')
             
+            # --- ACTION: policy (Install per-ID output policies) ---
+            elif action == "policy":
+                # {"id":1,"d":{"a":"policy","p":[{"i":"0x2C4","m":"change"},{"i":"0x3CA","m":"dec","hz":10},{"i":"0x0B4","m":"mute"}],"def":"pass","kf":1000}}
+                # Replaces the whole table. "def" applies to unlisted IDs ("dhz"
+                # for "dec"), "kf" is the keyframe interval in ms (0 = off).
+                # Every rule is checked before the table is touched, so a bad
+                # request leaves the previous policy in place.
+                rules = data.get("p", [])
+                if len(rules) > can_policy.limit:
+                    usb_out.put('{"id":0,"d":{"err":"CAN_POLICY_FULL"}}\n')
+                    return
+                try:
+                    default = CAN_POLICY_MODES.get(data.get("def", "pass"))
+                    d_hz = int(data.get("dhz", 10))
+                    key_ms = int(data.get("kf", CAN_KEYFRAME_MS))
+                    if default is None or key_ms < 0 or (default == canrx.DECIMATE and not 0 < d_hz <= 1000000):
+                        raise ValueError
+                    pol = []
+                    for p in rules:
+                        mode = CAN_POLICY_MODES.get(p.get("m", "pass"))
+                        p_id = p.get("i", 0)
+                        p_id = int(p_id, 16) if isinstance(p_id, str) else int(p_id)
+                        p_ext = bool(p.get("e", False))
+                        hz = int(p.get("hz", 10))
+                        if mode is None or not 0 < hz <= 1000000 or not 0 <= p_id <= (0x1FFFFFFF if p_ext else 0x7FF):
+                            raise ValueError
+                        pol.append((p_id, p_ext, mode, 1000000 // hz))
+                except (ValueError, TypeError):
+                    usb_out.put('{"id":0,"d":{"err":"CAN_POLICY_BAD"}}\n')
+                    return
+                can_policy.clear(default, 1000000 // d_hz if default == canrx.DECIMATE else 0)
+                for p_id, p_ext, mode, period in pol:
+                    can_policy.set(p_id, p_ext, mode, period)
+                can_policy.key_ms = key_ms
+                usb_out.put('{"id":0,"d":{"msg":"CAN_POLICY_OK","n":' + str(can_policy.n) + '}}\n')
+
+            # --- ACTION: policies (List per-ID policies with held-back counts) ---
+            elif action == "policies":
+                names = ("pass", "change", "dec", "mute")
+                pol_list = []
+                for i in range(can_policy.size):
+                    if can_policy.keys[i] < 0: continue
+                    p_id, p_ext, _ = can_policy.entry(i)
+                    p = {"i": ("0x{:08X}" if p_ext else "0x{:03X}").format(p_id), "m": names[can_policy.mode[i]], "sup": can_policy.sup[i]}
+                    if can_policy.mode[i] == canrx.DECIMATE: p["hz"] = 1000000 // can_policy.period[i]
+                    if p_ext: p["e"] = True
+                    if can_policy.auto[i]: p["auto"] = True
+                    pol_list.append(p)
+                usb_out.put('{"id":0,"d":{"can_policies":{"p":' + ujson.dumps(pol_list) + ',"def":"' + names[can_policy.default] + '","kf":' + str(can_policy.key_ms) + ',"sup":' + str(can_policy.suppressed) + ',"full":' + str(can_policy.full) + '}}}\n')
+
             # --- ACTION: subs (List active subscriptions) ---
             elif action == "subs":
                 subs_list = []
@@ -582,15 +1256,15 @@ def process_usb_command(json_line):
                         "i": "0x{:X}".format(sub["req_id"]),
                         "int": sub["interval_ms"]
                     })
-                sys.stdout.write('{"id":0,"d":{"subs":' + ujson.dumps(subs_list) + '}}\n')
+                usb_out.put('{"id":0,"d":{"subs":' + ujson.dumps(subs_list) + '}}\n')
             
             else:
-                sys.stdout.write('{"id":0,"d":{"err":"UNKNOWN_ACTION"}}\n')
+                usb_out.put('{"id":0,"d":{"err":"UNKNOWN_ACTION"}}\n')
         
         elif dev_id > 5:
             # RS485 Forwarding
             if not rs485_ready:
-                sys.stdout.write('{"id":0,"d":{"err":"RS485_OFFLINE"}}\n')
+                usb_out.put('{"id":0,"d":{"err":"RS485_OFFLINE"}}\n')
                 return
             
             # Forward the original command object as NDJSON
@@ -599,36 +1273,106 @@ def process_usb_command(json_line):
             rs485_send(msg)
 
     except:
-        sys.stdout.write('{"id":0,"d":{"err":"JSON_PARSE"}}\n')
+        usb_out.put('{"id":0,"d":{"err":"JSON_PARSE"}}\n')
 
 # Initial Status Report
 can_msg = "CAN_READY" if can_ready else "CAN_INIT_FAIL"
 rs485_msg = "READY" if rs485_ready else "FAIL"
 print('{"id":0,"d":{"msg":"GATEWAY_READY","ver":"' + FW_VERSION + '","can":"' + can_msg + '","rs485":"' + rs485_msg + '","cores":1}}')
 
-rx_idx = 0
 last_rx_time = utime.ticks_ms()
 last_gc_time = utime.ticks_ms()
 GC_INTERVAL_MS = 2000  # GC at most every 2 seconds (was every idle cycle)
 
 # Helper: Output subscription response frame
-def print_sub_response(ts, slot, resp_id, resp_data):
-    # Single sys.stdout.write() to minimize USB CDC packet fragmentation
+def print_sub_response(t_us, slot, resp_id, resp_data):
+    seq = get_next_seq(DEV_ID_CAN) if ENABLE_SEQ_COUNTER else -1
+    clk.stamp(t_us)
+    # ISO-TP responses longer than a record holds stay NDJSON
+    if ENABLE_BINARY_OUTPUT and len(resp_data) <= binrec.MAX_DATA:
+        o = usb_out.reserve(binrec.MAX_FRAMED, DEV_ID_CAN)
+        if o >= 0:
+            usb_out.commit(bin_writer.can(usb_out.buf, o, clk.sec, clk.us, max(seq, 0), resp_id, resp_data, slot=slot), DEV_ID_CAN)
+        return
+    need = jsonrec.SUB_LINE_FIXED + 4 * len(resp_data)
+    if need <= usb_out.size:
+        o = usb_out.reserve(need, DEV_ID_CAN)
+        if o >= 0:
+            usb_out.commit(jsonrec.sub_line(usb_out.buf, o, clk.sec, clk.frac, clk.digits, seq, slot, resp_id, resp_data), DEV_ID_CAN)
+        return
+    # Long ISO-TP payload: bigger than the ring, build it as a string (dropped if it cannot fit)
     d_str = ','.join(str(b) for b in resp_data)
-    seq_str = ',"seq":' + str(get_next_seq()) if ENABLE_SEQ_COUNTER else ''
-    sys.stdout.write('{"id":1,"ts":' + str(ts) + seq_str + ',"d":{"a":"sub","slot":' + str(slot) + ',"i":"0x' + '{:X}'.format(resp_id) + '","d":[' + d_str + ']}}\n')
-
-# AVC-LAN drain callback: called during blocking CAN waits to prevent PIO FIFO overflow.
-# The RP2040 PIO FIFO is only 8 entries deep. At AVC-LAN data rates, it fills in ~2ms.
-# Without draining, any CAN send_and_wait (100-500ms) causes total AVC-LAN data loss.
-def drain_avclan_fifo():
-    global rx_idx, last_rx_time
-    while sm_rx.rx_fifo() > 0:
-        val = sm_rx.get()
-        if rx_idx < RX_BUF_SIZE:
-            rx_buffer[rx_idx] = val
-            rx_idx += 1
+    seq_str = ',"seq":' + str(seq) if seq >= 0 else ''
+    usb_out.put('{"id":1,"ts":' + clk.ts_str() + seq_str + ',"d":{"a":"sub","slot":' + str(slot) + ',"i":"0x' + '{:X}'.format(resp_id) + '","d":[' + d_str + ']}}\n', DEV_ID_CAN)
+
+# Raw capture batch: words waiting to be sent, first word's µs timestamp
+# and the running word index (lets the host detect lost batches)
+avc_raw_buf = array.array('I', [0] * AVC_RAW_WORDS)
+avc_raw_mv = memoryview(avc_raw_buf)
+avc_raw_n = 0
+avc_raw_us = 0
+avc_raw_ms = 0
+avc_raw_index = 0
+
+def avc_raw_flush():
+    global avc_raw_n, avc_raw_index
+    if avc_raw_n == 0: return
+    b64 = ubinascii.b2a_base64(avc_raw_mv[:avc_raw_n])[:-1]
+    clk.stamp(avc_raw_us)
+    usb_out.put('{"id":2,"ts":' + clk.ts_str() + ',"d":{"raw":"' + b64.decode() + '","us":' + clk.us_str() + ',"w":' + str(avc_raw_index) + ',"drop":' + str(avc_rx.dropped) + '}}\n', DEV_ID_AVCLAN)
+    avc_raw_index = (avc_raw_index + avc_raw_n) & 0x3FFFFFFF
+    avc_raw_n = 0
+
+def avc_raw_put(word):
+    global avc_raw_n, avc_raw_us, avc_raw_ms
+    if avc_raw_n == 0:
+        avc_raw_us = utime.ticks_us()
+        avc_raw_ms = utime.ticks_ms()
+    avc_raw_buf[avc_raw_n] = word
+    avc_raw_n += 1
+    if avc_raw_n == AVC_RAW_WORDS:
+        avc_raw_flush()
+
+# AVC-LAN capture poll: hand every word DMA has completed to the decoder.
+# Called once per main loop iteration; blocking waits elsewhere no longer
+# need to drain the PIO FIFO because DMA keeps capturing meanwhile.
+def poll_avclan_capture():
+    global last_rx_time, avc_dma_done, avc_hwm, avc_rx_us
+    if avc_dma is None:
+        # Fallback (firmware without rp2.DMA): poll the 8-word FIFO directly
+        level = sm_rx.rx_fifo()
+        if level > avc_hwm: avc_hwm = level
+        loops = 0
+        sink = avc_raw_put if AVC_RAW_ENABLED else avc_rx.feed
+        while sm_rx.rx_fifo() > 0:
+            sink(sm_rx.get())
+            last_rx_time = utime.ticks_ms()
+            avc_rx_us = utime.ticks_us()
+            loops += 1
+            if loops > 50: break
+        return
+
+    written = AVC_DMA_COUNT - avc_dma.count
+    new = written - avc_dma_done
+    if new > 0:
+        if new > avc_hwm: avc_hwm = new
+        if new > AVC_DMA_WORDS:
+            # Ring lapped while the loop was blocked: oldest words are gone
+            avc_rx.dropped += new - AVC_DMA_WORDS
+            avc_dma_done = written - AVC_DMA_WORDS
+        ring = avc_dma_raw
+        base = avc_dma_base
+        mask = AVC_DMA_WORDS - 1
+        sink = avc_raw_put if AVC_RAW_ENABLED else avc_rx.feed
+        i = avc_dma_done
+        while i < written:
+            sink(ring[base + (i & mask)])
+            i += 1
+        avc_dma_done = written
         last_rx_time = utime.ticks_ms()
+        avc_rx_us = utime.ticks_us()
+    if written >= AVC_DMA_COUNT:
+        avc_dma_arm()
 
 while True:
     # 1. USB Poll
@@ -636,59 +1380,77 @@ while True:
         ch = sys.stdin.read(1)
         if ch:
             if ch == '\n':
+                usb_rx_us = utime.ticks_us()
                 process_usb_command(input_buffer)
                 input_buffer = ""
             else:
                 input_buffer += ch
     
-    # 2. AVC-LAN RX Poll
-    loops = 0
-    while sm_rx.rx_fifo() > 0:
-        val = sm_rx.get()
-        if rx_idx < RX_BUF_SIZE:
-            rx_buffer[rx_idx] = val
-            rx_idx += 1
-        last_rx_time = utime.ticks_ms()
-        loops += 1
-        if loops > 50: break
+    # 2. AVC-LAN RX Poll (DMA ring -> streaming decoder)
+    poll_avclan_capture()
 
     current_time = utime.ticks_ms()
+    clk.now()   # Keeps the clock extension current while the buses are quiet
 
     # 3. CAN RX - Direct polling on Core 0 (burst read up to 8 frames)
     # MCP2515 has 2 RX buffers. Burst read catches new frames that arrive
     # while processing. No lock needed — single-core, no thread contention.
-    # drain_avclan_fifo() between SPI reads prevents PIO FIFO overflow.
     if can_ready:
+        n_rx = 0
         for _ in range(8):
-            drain_avclan_fifo()
             res = can.recv_fast()
+            if res is None:
+                break
             if res:
+                t_rx = utime.ticks_us()
                 c_id, c_data, c_ext = res
-                print_can_frame(current_time, c_id, tuple(c_data), c_ext)
-            else:
-                break
+                if CAN_SUMMARY_ENABLED:
+                    can_sum.add(c_id, c_ext, c_data)
+                if CAN_SUMMARY_RAW or not CAN_SUMMARY_ENABLED:
+                    c_data = tuple(c_data)
+                    send = True
+                    if can_policy.active:
+                        clk.stamp(t_rx)
+                        send = can_policy.check(c_id, c_ext, c_data, clk.sec, clk.us)
+                    if send:
+                        print_can_frame(t_rx, c_id, c_data, c_ext)
+            n_rx += 1   # Frames rejected by the software filter (False) count too
+        # An overrun needs both RX buffers full, which leaves at least two
+        # frames for this burst: only then can EFLG have an overrun latched
+        if n_rx >= 2:
+            can.check_rx_overrun()
+
+        if CAN_SUMMARY_ENABLED and utime.ticks_diff(current_time, can_sum_ms) >= CAN_SUMMARY_MS:
+            can_summary_flush()
+
+        # Keyframe: latest payload of every held-back ID, a few per iteration
+        if can_policy.active:
+            clk.now()
+            can_policy.tick(clk.sec, clk.us)
+            if can_policy.kf >= 0:
+                t_kf = utime.ticks_us()
+                for _ in range(CAN_KEYFRAME_BATCH):
+                    i = can_policy.next_key()
+                    if i < 0: break
+                    k_id, k_ext, k_data = can_policy.entry(i)
+                    print_can_frame(t_kf, k_id, k_data, k_ext)
         
         # Periodic CAN diagnostics (every 5 seconds)
         if utime.ticks_diff(current_time, can_diag_last) > CAN_DIAG_INTERVAL:
             can_diag_last = current_time
             try:
-                drain_avclan_fifo()
                 tec, rec, eflg = can.get_errors()
-                drain_avclan_fifo()
                 rx_stat = can.rx_status()
-                drain_avclan_fifo()
                 mode = can.get_mode()
-                drain_avclan_fifo()
                 stats = can.get_rx_stats()
                 overflow = stats.get("rx_overflow", 0)
-                sys.stdout.write('{\"id\":0,\"d\":{\"can_diag\":{\"mode\":\"' + mode + '\",\"tec\":' + str(tec) + ',\"rec\":' + str(rec) + ',\"eflg\":\"' + '{:02X}'.format(eflg) + '\",\"rxs\":\"' + '{:02X}'.format(rx_stat) + '\",\"ovf\":' + str(overflow) + '}}}\n')
+                usb_out.put('{\"id\":0,\"d\":{\"can_diag\":{\"mode\":\"' + mode + '\",\"tec\":' + str(tec) + ',\"rec\":' + str(rec) + ',\"eflg\":\"' + '{:02X}'.format(eflg) + '\",\"rxs\":\"' + '{:02X}'.format(rx_stat) + '\",\"ovf\":' + str(overflow) + ',\"sum_full\":' + str(can_sum.full) + '}}}\n')
             except:
                 pass
 
     # 4. RS485 RX Poll
     if rs485_ready:
         while rs485.any():
-            drain_avclan_fifo()
             try:
                 line = rs485.readline()
                 if line:
@@ -700,15 +1462,15 @@ while True:
                             
                             # Inject Metadata if missing
                             if "ts" not in obj:
-                                obj["ts"] = current_time
+                                obj["ts"] = clk.now().ts_int()
                             if ENABLE_SEQ_COUNTER and "seq" not in obj:
-                                obj["seq"] = get_next_seq()
+                                obj["seq"] = get_next_seq(CH_RS485)
                                 
                             # Re-serialize to Stdout
-                            sys.stdout.write(ujson.dumps(obj) + '\n')
+                            usb_out.put(ujson.dumps(obj) + '\n', CH_RS485)
                     except ValueError:
-                        # Malformed JSON or garbage on bus - ignore
-                        pass
+                        # Malformed JSON or garbage on bus - count and ignore
+                        rs485_bad += 1
             except Exception:
                 pass
 
@@ -731,6 +1493,7 @@ while True:
         
         if sub_to_poll:
             slot, sub = sub_to_poll
+            avc_tx_settle()
             try:
                 if sub.get("isotp", False):
                     result = can.send_and_wait_isotp(
@@ -740,7 +1503,7 @@ while True:
                         sub["timeout_ms"],
                         sub["ext"],
                         ENABLE_ISOTP_DEBUG,
-                        poll_cb=drain_avclan_fifo
+                        log_cb=usb_out.put
                     )
                 else:
                     result = can.send_and_wait(
@@ -748,37 +1511,100 @@ while True:
                         sub["req_data"],
                         sub["resp_ids"],
                         sub["timeout_ms"],
-                        sub["ext"],
-                        poll_cb=drain_avclan_fifo
+                        sub["ext"]
                     )
             except Exception as e:
                 result = None
-                sys.stdout.write('{"id":0,"d":{"err":"SUB_POLL_ERR","slot":' + str(slot) + '}}\n')
+                usb_out.put('{"id":0,"d":{"err":"SUB_POLL_ERR","slot":' + str(slot) + '}}\n')
             
+            t_rx = utime.ticks_us()
             CAN_SUBSCRIPTIONS[slot]["last_poll"] = current_time
             if result:
                 resp_id, resp_data = result
-                print_sub_response(current_time, slot, resp_id, resp_data)
+                print_sub_response(t_rx, slot, resp_id, resp_data)
 
     # 6. AVC-LAN Processing
-    # Process as soon as we have data and a brief silence (frame boundary).
-    # Low threshold to minimize UI delay for button presses, track changes, etc.
-    should_process = (rx_idx > 0 and utime.ticks_diff(current_time, last_rx_time) > 8)
-
-    if should_process:
-        total_bits = rx_idx * 32
-        ptr = 0
-        while ptr < total_bits - 40:
-            frame_tuple, bit_len = decode_smart_static(rx_buffer, ptr, rx_idx)
-            if frame_tuple:
-                print_avclan_frame(current_time, *frame_tuple)
-                ptr += bit_len
-            else:
-                ptr += 1
-        rx_idx = 0
+    # Streaming decode: every frame whose bits have all arrived is emitted now,
+    # without waiting for bus silence. After AVC_IDLE_MS of silence a frame
+    # that is still incomplete is treated as garbage and the tail discarded.
+    if avc_rx.count > 0:
+        t_pass = utime.ticks_us()
+        avc_idle = utime.ticks_diff(current_time, last_rx_time) > AVC_IDLE_MS
+        while True:
+            frame_tuple = avc_rx.next_frame(avc_idle)
+            if not frame_tuple: break
+            m, s, c, d = frame_tuple
+            # Loopback: first frame decoded after our frame left completely
+            own = False
+            if avc_tx_echo and avc_tx_left():
+                own = frame_tuple == avc_tx_echo
+                avc_tx_verdict(own)
+            # Emulated devices answer before the address filter, never to our own frames
+            if avc_resp.n and not own:
+                avc_respond(m, s, c, d)
+            clk.stamp(avc_rx_us)
+            avc_cache.update(clk.sec, clk.us, m, s, c, d)
+            if avc_filter.n and not avc_filter.accept(m, s): continue
+            emit_avclan_frame(avc_rx_us, m, s, c, d, avc_rx.last_skipped, avc_rx.last_tried)
+        avc_pass_us = utime.ticks_diff(utime.ticks_us(), t_pass)
+        if avc_pass_us > avc_pass_max: avc_pass_max = avc_pass_us
+
+    # Running "snap": next chunk once the USB ring has room
+    if avc_snap >= 0:
+        avc_snap_step()
+
+    # AVC-LAN TX: after the decode pass, so anything captured before a new
+    # frame starts has already been decoded and cannot pass for its echo
+    drain_avclan_tx()
+
+    # Sample point sweep: next delay once this one has seen enough traffic
+    if avc_cal.active:
+        if (avc_cal.step_frames(avc_rx.frames) >= AVC_CAL_STEP_FRAMES
+                or utime.ticks_diff(current_time, avc_cal_step_ms) > AVC_CAL_STEP_MS):
+            avc_cal_step_ms = current_time
+            avc_set_sample_delay(avc_cal.sample(avc_rx.frames, avc_rx.rescues, avc_fault_total()))
+            if not avc_cal.active:
+                avc_cal_base = (avc_rx.frames, avc_rx.rescues)
+                usb_out.put('{"id":0,"d":{"avc_cal":{"dly":' + str(avc_sample_delay) + ',"prev":' + str(avc_cal.prev) + ',"from":' + str(AVC_CAL_LO) + ',"yield":[' + ','.join(str(v) for v in avc_cal.scores) + ']}}}\n')
+
+    # Raw capture: send a partial batch once it is old enough
+    if avc_raw_n and utime.ticks_diff(current_time, avc_raw_ms) >= AVC_RAW_FLUSH_MS:
+        avc_raw_flush()
+
+    # Burst window expired: emit the folded line
+    if avc_agg and utime.ticks_diff(utime.ticks_us(), avc_agg[0]) >= AVC_AGG_WINDOW_MS * 1000:
+        avc_agg_flush()
+
+    # Periodic AVC-LAN health telemetry (counters are cumulative since boot,
+    # us_max covers the last interval)
+    if utime.ticks_diff(current_time, avc_diag_last) > CAN_DIAG_INTERVAL:
+        avc_diag_last = current_time
+        hf = avc_rx.header_faults
+        usb_out.put('{"id":0,"d":{"avc_diag":{"frm":' + str(avc_rx.frames) + ',"resc":' + str(avc_rx.rescues) + ',"drop":' + str(avc_rx.dropped) + ',"hwm":' + str(avc_hwm) + ',"par":[' + str(hf[0]) + ',' + str(hf[1]) + ',' + str(hf[2]) + ',' + str(hf[3]) + '],"len":' + str(hf[4]) + ',"mark":' + str(avc_rx.frames_marked) + ',"rsync":' + str(avc_rx.resyncs) + ',"us":' + str(avc_pass_us) + ',"us_max":' + str(avc_pass_max) + ',"tx":' + str(avc_txq.sent) + ',"tx_fail":' + str(avc_txq.failed) + ',"tx_rt":' + str(avc_txq.retried) + ',"txq":[' + str(avc_txq.n) + ',' + str(avc_txq.hwm) + '],"tx_full":' + str(avc_txq.dropped) + ',"tx_us":' + str(avc_tx_us) + ',"tx_us_max":' + str(avc_tx_us_max) + ',"enc":[' + str(avc_encoder.hits) + ',' + str(avc_encoder.misses) + '],"dly":' + str(avc_sample_delay) + '}}}\n')
+        avc_pass_max = 0
+        avc_tx_us_max = 0
+        # Sample point drifting: too many frames only decode with the rescue
+        cal_frm = avc_rx.frames - avc_cal_base[0]
+        cal_resc = avc_rx.rescues - avc_cal_base[1]
+        avc_cal_base = (avc_rx.frames, avc_rx.rescues)
+        if (not avc_cal.active and cal_frm >= AVC_CAL_MIN_FRAMES
+                and cal_resc * 1000 > cal_frm * AVC_CAL_RESCUE_PERMILLE
+                and utime.ticks_diff(current_time, avc_cal_last_ms) > AVC_CAL_HOLDOFF_MS):
+            avc_cal_start(current_time)
+            usb_out.put('{"id":0,"d":{"msg":"AVC_CAL_STARTED","resc":' + str(cal_resc) + ',"frm":' + str(cal_frm) + '}}\n')
+
+    # USB output: write as much of a due burst as the endpoint accepts
+    usb_out.poll()
+
+    # Periodic USB output statistics and drop summary (cumulative since boot)
+    if utime.ticks_diff(current_time, usb_diag_last) > CAN_DIAG_INTERVAL:
+        usb_diag_last = current_time
+        usb_out.put('{"id":0,"d":{"usb_diag":{"rec":' + str(usb_out.records) + ',"fl":' + str(usb_out.flushes) + ',"fl_sz":' + str(usb_out.flush_size) + ',"fl_dl":' + str(usb_out.flush_time) + ',"avg":' + str(usb_out.avg_batch()) + ',"q":' + str(usb_out.used) + ',"hwm":' + str(usb_out.hwm) + '}}}\n')
+        dr = usb_out.drops
+        usb_out.put('{"id":0,"d":{"drops":{"can":{"usb":' + str(dr[DEV_ID_CAN]) + ',"ovr":' + str(can.rx_overrun) + '},"avc":{"usb":' + str(dr[DEV_ID_AVCLAN]) + ',"cap":' + str(avc_rx.dropped) + '},"rs485":{"usb":' + str(dr[CH_RS485]) + ',"bad":' + str(rs485_bad) + '},"sys":' + str(dr[DEV_ID_GATEWAY]) + ',"bytes":' + str(usb_out.drop_bytes) + ',"stall":' + str(usb_out.stalls) + ',"pol":"' + ("low" if usb_out.policy == usbout.DROP_LOW else "old") + '"},"seq":{"can":' + str(seq_counters[DEV_ID_CAN]) + ',"avc":' + str(seq_counters[DEV_ID_AVCLAN]) + ',"rs485":' + str(seq_counters[CH_RS485]) + '}}}\n')
 
     # Run GC only periodically during idle (was every idle cycle, now every 2s)
-    if rx_idx == 0:
+    if avc_rx.count == 0:
         if utime.ticks_diff(current_time, last_gc_time) > GC_INTERVAL_MS:
             gc.collect()
             last_gc_time = current_time
@@ -53,6 +53,9 @@ TXB0CTRL  = 0x30
 TXB0SIDH  = 0x31
 RXB0CTRL  = 0x60
 RXB0SIDH  = 0x61
+RXB1CTRL  = 0x70
+RXF_ADDR  = (0x00, 0x04, 0x08, 0x10, 0x14, 0x18)  # RXF0-RXF5 (SIDH, SIDL, EID8, EID0)
+RXM_ADDR  = (0x20, 0x24)                          # RXM0 (RXB0), RXM1 (RXB1)
 RX0IF     = 0x01
 RX1IF     = 0x02
 TXB0REQ   = 0x08
@@ -330,6 +333,10 @@ class MCP2515:
         # Statistics for monitoring
         self.rx_count = 0
         self.rx_overflow = 0
+        self.rx_overrun = 0         # RX buffer overruns flagged in EFLG (hardware drops)
+
+        # Software ID filter (canrx.IdFilter), checked in recv_fast(); None = off
+        self.id_filter = None
         
         # IRQ-based reception (optional, for lowest latency)
         self._irq_enabled = False
@@ -562,7 +569,7 @@ class MCP2515:
         
         return None  # Timeout, no matching response
 
-    def send_and_wait_isotp(self, tx_can_id, data, response_ids, timeout_ms=500, ext=False, debug=False, retries=3, poll_cb=None):
+    def send_and_wait_isotp(self, tx_can_id, data, response_ids, timeout_ms=500, ext=False, debug=False, retries=3, poll_cb=None, log_cb=None):
         """Send a CAN frame and wait for an ISO-TP response with multi-frame reassembly.
         
         This handles both Single Frame (SF) and multi-frame (FF + CF) responses per ISO 15765-2.
@@ -581,6 +588,8 @@ class MCP2515:
             debug: If True, emit debug log messages for ISO-TP state machine
             retries: Number of retry attempts for multi-frame responses (default 3)
             poll_cb: Optional callback called during wait loops to service other I/O
+            log_cb: Callback taking one NDJSON debug line (the USB output ring's
+                put); debug lines are dropped without it
             
         Returns:
             tuple: (response_id, reassembled_data) if response received, None if timeout
@@ -591,7 +600,7 @@ class MCP2515:
         import sys
         
         for attempt in range(retries + 1):
-            result = self._send_and_wait_isotp_once(tx_can_id, data, response_ids, timeout_ms, ext, debug, attempt, poll_cb)
+            result = self._send_and_wait_isotp_once(tx_can_id, data, response_ids, timeout_ms, ext, debug, attempt, poll_cb, log_cb)
             if result is not None:
                 return result
             # Small delay before retry
@@ -600,15 +609,14 @@ class MCP2515:
         
         return None
     
-    def _send_and_wait_isotp_once(self, tx_can_id, data, response_ids, timeout_ms, ext, debug, attempt, poll_cb=None):
+    def _send_and_wait_isotp_once(self, tx_can_id, data, response_ids, timeout_ms, ext, debug, attempt, poll_cb=None, log_cb=None):
         """Internal: Single attempt at ISO-TP transaction."""
         import utime
-        import sys
         
         def log(msg):
-            if debug:
+            if debug and log_cb:
                 retry_info = f" (attempt {attempt+1})" if attempt > 0 else ""
-                sys.stdout.write(f'{{"id":0,"d":{{"isotp":"{msg}{retry_info}"}}}}\n')
+                log_cb(f'{{"id":0,"d":{{"isotp":"{msg}{retry_info}"}}}}\n')
         
         # Clear only TX interrupt flags, preserve RX flags
         # ISO-TP sessions pause Core 1, so we own the SPI bus here
@@ -784,11 +792,10 @@ class MCP2515:
         # RXB0CTRL: RXM=11 (Receive Any Message), BUKT=1 (Rollover to RXB1)
         self.write_reg(RXB0CTRL, 0x64) # RXM=11 (Any msg), BUKT=1
         # RXB1CTRL: RXM=11 (Receive Any Message)
-        self.write_reg(0x70, 0x60) # RXB1CTRL, RXM=11
+        self.write_reg(RXB1CTRL, 0x60) # RXM=11
         
-        # Clear all filter/mask registers to receive everything
-        for addr in [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07]: # RXF0-RXF5, RXM0-RXM1
-            pass # RXM=11 already disables filters
+        # Filters/masks stay unprogrammed: RXM=11 ignores them. The host can
+        # install hardware filtering later with set_filters().
         
         # Use Listen-Only Mode for sniffing (does not ACK frames)
         if not self.set_listen_only_mode():
@@ -901,7 +908,8 @@ class MCP2515:
         2. Using readinto() instead of read() (no copy)
         3. Inlined parsing (no function call overhead)
         
-        Returns: (can_id, data_list, is_extended) or None
+        Returns: (can_id, data_list, is_extended), None if no frame is
+        waiting, or False if a frame was read but rejected by id_filter
         """
         # Check RX status using fast register read
         status = self.rx_status()
@@ -926,12 +934,22 @@ class MCP2515:
             dlc = 8
             
         can_id = (sidh << 3) | (sidl >> 5)
+        ext = False
+        if sidl & 0x08:
+            can_id = (can_id << 18) | ((sidl & 0x03) << 16) | (self._frame_buf[2] << 8) | self._frame_buf[3]
+            ext = True
+        
+        self.rx_count += 1
+        
+        # Software filter before anything is built for the frame
+        idf = self.id_filter
+        if idf is not None and not idf.accept(can_id, ext):
+            return False
         
         # Build data list from buffer
         data = [self._frame_buf[5 + i] for i in range(dlc)]
         
-        self.rx_count += 1
-        return (can_id, data, False)
+        return (can_id, data, ext)
     
     def recv_to_ring(self):
         """
@@ -1043,11 +1061,103 @@ class MCP2515:
         buffer_num = 0 if (msg_location & 0x01) else 1
         return self.pio_accel.read_rx_buffer_fast(buffer_num)
     
+    def _write_id(self, addr, value, ext, exide):
+        """Write an ID into a filter/mask register group (SIDH, SIDL, EID8, EID0)."""
+        if ext:
+            sidh = (value >> 21) & 0xFF
+            sidl = ((value >> 13) & 0xE0) | ((value >> 16) & 0x03) | (0x08 if exide else 0)
+            eid8 = (value >> 8) & 0xFF
+            eid0 = value & 0xFF
+        else:
+            # EID bits of a standard mask would filter on the first two data bytes
+            sidh = (value >> 3) & 0xFF
+            sidl = (value & 0x07) << 5
+            eid8 = eid0 = 0
+        self.cs.value(0)
+        self.spi.write(bytes([WRITE, addr, sidh, sidl, eid8, eid0]))
+        self.cs.value(1)
+
+    def _read_id(self, addr, is_mask):
+        """Read a filter/mask register group back as (value, ext)."""
+        self.cs.value(0)
+        self.spi.write(bytes([READ, addr]))
+        r = self.spi.read(4)
+        self.cs.value(1)
+        sidh, sidl, eid8, eid0 = r[0], r[1], r[2], r[3]
+        # Filters carry EXIDE; masks count as extended once any EID bit is set
+        ext = (sidl & 0x08) if not is_mask else (eid8 | eid0 | (sidl & 0x03))
+        if ext:
+            return ((sidh << 21) | ((sidl & 0xE0) << 13) | ((sidl & 0x03) << 16) | (eid8 << 8) | eid0, True)
+        return ((sidh << 3) | (sidl >> 5), False)
+
+    def _request_mode(self, mode):
+        self.modify_reg(CANCTRL, 0xE0, mode)
+        for _ in range(10):
+            if (self.read_reg(CANSTAT) & 0xE0) == mode: return True
+            time.sleep_ms(1)
+        return False
+
+    def set_filters(self, masks, filters):
+        """
+        Program the hardware acceptance masks and filters and switch both RX
+        buffers to filtered mode, so frames nobody asked for never reach the
+        RX buffers (no SPI reads, no Python work, no overruns).
+
+        masks:   2 x (value, ext): RXM0 (RXB0), RXM1 (RXB1)
+        filters: 6 x (value, ext): RXF0-RXF1 (RXB0), RXF2-RXF5 (RXB1)
+        A frame is accepted if (id & mask) == (filter & mask) for any filter
+        of a buffer. masks=None turns filtering off (receive everything).
+
+        The registers are only writable in config mode: the controller goes
+        through config mode and back to its previous mode (listen-only or
+        normal); frames arriving meanwhile are lost.
+
+        Returns False if a mode switch failed.
+        """
+        prev = self.read_reg(CANSTAT) & 0xE0
+        if not self._request_mode(0x80):
+            return False
+        if masks is None:
+            self.write_reg(RXB0CTRL, 0x64)  # RXM=11 (Any msg), BUKT=1
+            self.write_reg(RXB1CTRL, 0x60)  # RXM=11
+        else:
+            for i in range(6):
+                self._write_id(RXF_ADDR[i], filters[i][0], filters[i][1], True)
+            for i in range(2):
+                self._write_id(RXM_ADDR[i], masks[i][0], masks[i][1], False)
+            self.write_reg(RXB0CTRL, 0x04)  # RXM=00 (filtered), BUKT=1
+            self.write_reg(RXB1CTRL, 0x00)  # RXM=00
+        return self._request_mode(prev)
+
+    def get_filters(self):
+        """
+        Read the active filter set back from the controller.
+        Returns (enabled, masks, filters) in the format set_filters() takes.
+        """
+        enabled = (self.read_reg(RXB0CTRL) & 0x60) != 0x60
+        masks = [self._read_id(a, True) for a in RXM_ADDR]
+        filters = [self._read_id(a, False) for a in RXF_ADDR]
+        return (enabled, masks, filters)
+
+    def check_rx_overrun(self):
+        """
+        Count and clear the RX buffer overrun flags (EFLG RX0OVR/RX1OVR).
+        A flag latches, so all frames lost while it was set count as one.
+        Returns the number of flags that were set.
+        """
+        eflg = self.read_reg_fast(EFLG)
+        n = ((eflg >> 6) & 1) + (eflg >> 7)
+        if n:
+            self.modify_reg(EFLG, 0xC0, 0x00)
+            self.rx_overrun += n
+        return n
+
     def get_rx_stats(self):
         """Returns RX statistics for monitoring."""
         return {
             "rx_count": self.rx_count,
             "rx_overflow": self.rx_overflow,
+            "rx_overrun": self.rx_overrun,
             "ring_available": self.fast_ring.available(),
             "pio_enabled": self.pio_accelerated
         }
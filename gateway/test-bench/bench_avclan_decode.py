@@ -0,0 +1,264 @@
+"""
+AVC-LAN decoder benchmark: legacy bit-by-bit path vs avclan.py word-level path.
+
+All decoders scan the same synthetic rx_buffer (valid frames separated by
+idle gaps of random length, like a busy head unit) with the main-loop resync logic
+(ptr += bit_len on success, ptr += 1 otherwise) and must produce identical
+frames. The "stream" run feeds the same words one at a time through
+avclan.StreamDecoder (64-word buffer), as the main loop does; "framed"
+decodes the same traffic laid out as the PIO emits it (partial last word +
+bit-count trailer per frame), starting at the marked frame offsets. The
+0xFF payloads put all-ones data words into the framed stream, which must
+not be taken for trailers; TRAILER_TRAPS are frames whose data words
+passed every trailer check but the header length one.
+
+Run on the host:   python3 test-bench/bench_avclan_decode.py
+Run on the RP2040: copy avclan.py to the board, then
+                   mpremote run test-bench/bench_avclan_decode.py
+"""
+
+import array
+import sys
+
+try:
+    import utime as _time
+    def now_us(): return _time.ticks_us()
+    def elapsed_us(t0): return _time.ticks_diff(_time.ticks_us(), t0)
+except ImportError:
+    import time as _time
+    def now_us(): return int(_time.perf_counter() * 1000000)
+    def elapsed_us(t0): return now_us() - t0
+
+try:
+    import avclan
+except ImportError:
+    import os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import avclan
+
+RX_BUF_SIZE = 512
+ROUNDS = 5
+
+# ============================================================================
+# LEGACY DECODER (verbatim copy of gateway/main.py v2.27.0)
+# ============================================================================
+
+def get_bits_static(buf, start_bit, count):
+    result = 0
+    for i in range(count):
+        curr_ptr = start_bit + i
+        word_idx = curr_ptr // 32
+        if word_idx >= RX_BUF_SIZE: return -1
+        bit_in_word = 31 - (curr_ptr % 32)
+        bit = (buf[word_idx] >> bit_in_word) & 1
+        result = (result << 1) | bit
+    return result
+
+def check_parity_fast(val, width, parity_bit):
+    count = 0
+    v = val
+    while v: v &= (v - 1); count += 1
+    return ((count + parity_bit) % 2) != 0
+
+def try_decode(buf, ptr):
+    m = get_bits_static(buf, ptr, 12)
+    p = get_bits_static(buf, ptr+12, 1)
+    if not check_parity_fast(m, 12, p): return None
+    s = get_bits_static(buf, ptr+13, 12)
+    p = get_bits_static(buf, ptr+25, 1)
+    if not check_parity_fast(s, 12, p): return None
+    c = get_bits_static(buf, ptr+26, 4)
+    p = get_bits_static(buf, ptr+30, 1)
+    if not check_parity_fast(c, 4, p): return None
+    l = get_bits_static(buf, ptr+31, 8)
+    p = get_bits_static(buf, ptr+39, 1)
+    if not check_parity_fast(l, 8, p): return None
+    if l > 32: return None
+    d_list = []
+    curr = ptr + 40
+    for _ in range(l):
+        val = get_bits_static(buf, curr, 8)
+        d_list.append(val)
+        curr += 9
+    return (m, s, c, bytes(d_list), 40 + (l*9))
+
+def decode_smart_static(buf, ptr, limit_idx):
+    if (ptr // 32) > limit_idx: return None, 0
+    res = try_decode(buf, ptr)
+    if res:
+        m, s, c, d, length = res
+        return (m, s, c, d), length
+    res = try_decode(buf, ptr + 1)
+    if res:
+        m, s, c, d, length = res
+        return (m, s, c, d), length + 1
+    return None, 0
+
+# ============================================================================
+# TEST DATA
+# ============================================================================
+
+# Typical head unit traffic: pings, status broadcasts, button events
+FRAMES = [
+    (0x190, 0x110, 0xF, [0x00, 0x01]),
+    (0x110, 0x190, 0xF, [0x00, 0x01, 0x12, 0x10, 0x63]),
+    (0x1D6, 0x1FF, 0xF, [0x10, 0x74, 0x31, 0xF1, 0x90, 0x00]),
+    (0x040, 0x110, 0x0, [0x00, 0x25, 0x61, 0x80, 0x00, 0x00, 0x00, 0x00]),
+    (0x110, 0x490, 0xF, [0x00, 0x11, 0x01, 0x63, 0x06, 0x00, 0x00, 0x00, 0x80, 0x00, 0x00, 0x00]),
+    (0x190, 0x140, 0x0, []),
+    # 0xFF runs capture as 0xFFFFxxxx words that carry the trailer tag
+    (0x110, 0x490, 0xF, [0xFF] * 8),
+    (0x190, 0x110, 0xF, [0x00, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0x01]),
+    (0x1D6, 0x1FF, 0xF, [0xFF] * 32),
+]
+
+# Each holds a 0xFFFFxxxx data word whose bit count implies exactly the
+# words stored so far, right after a word that is clean above that count
+TRAILER_TRAPS = [
+    (0xB77, 0xB6E, 0x1, avclan.parse_payload("ffffe0ffffffffffff40ff7effffffff")),
+    (0x92C, 0x58B, 0xD, avclan.parse_payload("ff2dfffffff810ff")),
+    (0xB78, 0x447, 0xA, avclan.parse_payload("ddfffffffff8b3")),
+    (0xBDD, 0x8CA, 0xE, avclan.parse_payload("ffffd180edffffffff41a0ffffffffffa1ffffffffffffff96ffff1fffff")),
+    (0x497, 0xA71, 0x0, avclan.parse_payload("ffff50ffffffffffff4013ffffff")),
+]
+
+class BitWriter:
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def put(self, val, width):
+        for i in range(width - 1, -1, -1):
+            if (val >> i) & 1:
+                idx = self.pos >> 5
+                self.buf[idx] |= 1 << (31 - (self.pos & 31))
+            self.pos += 1
+
+    def frame(self, m, s, c, data):
+        for val, w in [(m, 12), (s, 12), (c, 4), (len(data), 8)] + [(b, 8) for b in data]:
+            self.put(val, w)
+            self.put(avclan.parity_bit(val), 1)
+
+def build_capture():
+    """Fill rx_buffer with frames separated by short garbage gaps."""
+    buf = array.array('I', [0] * RX_BUF_SIZE)
+    w = BitWriter(buf)
+    seed = 0x1234
+    expected = 0
+    limit = (RX_BUF_SIZE - 4) * 32
+    i = 0
+    while True:
+        m, s, c, data = FRAMES[i % len(FRAMES)]
+        if w.pos + 40 + len(data) * 9 + 16 > limit: break
+        w.frame(m, s, c, data)
+        expected += 1
+        # Inter-frame gap: 3..15 idle (zero) bits of pseudo-random length
+        seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF
+        w.pos += 3 + (seed >> 16) % 13
+        i += 1
+    return buf, (w.pos + 31) // 32, expected
+
+def build_framed_capture(frames=FRAMES):
+    """Same traffic as the PIO emits it: full words, partial push, trailer."""
+    buf = array.array('I', [0] * RX_BUF_SIZE)
+    n = 0
+    i = 0
+    while True:
+        m, s, c, data = frames[i % len(frames)]
+        tmp = array.array('I', [0] * 12)
+        w = BitWriter(tmp)
+        w.frame(m, s, c, data)
+        nbits = w.pos
+        full = nbits >> 5
+        rem = nbits & 31
+        if n + full + 2 > RX_BUF_SIZE: break
+        for k in range(full):
+            buf[n] = tmp[k]; n += 1
+        buf[n] = (tmp[full] >> (32 - rem)) if rem else 0; n += 1
+        buf[n] = 0xFFFFFFFF - nbits; n += 1
+        i += 1
+    return buf, n, i
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def scan_legacy(buf, rx_idx, out):
+    total_bits = rx_idx * 32
+    ptr = 0
+    while ptr < total_bits - 40:
+        frame_tuple, bit_len = decode_smart_static(buf, ptr, rx_idx)
+        if frame_tuple:
+            out.append(frame_tuple)
+            ptr += bit_len
+        else:
+            ptr += 1
+
+def scan_word(buf, rx_idx, out):
+    total_bits = rx_idx * 32
+    ptr = 0
+    while ptr < total_bits - 40:
+        frame_tuple, bit_len = avclan.decode_smart(buf, ptr, total_bits)
+        if frame_tuple:
+            out.append(frame_tuple)
+            ptr += bit_len
+        else:
+            ptr += 1
+
+def scan_stream(buf, rx_idx, out):
+    dec = avclan.StreamDecoder(64)
+    for i in range(rx_idx):
+        dec.feed(buf[i])
+        while True:
+            frame_tuple = dec.next_frame()
+            if not frame_tuple: break
+            out.append(frame_tuple)
+    while True:
+        frame_tuple = dec.next_frame(True)
+        if not frame_tuple: break
+        out.append(frame_tuple)
+
+def scan_framed(buf, rx_idx, out):
+    dec = avclan.StreamDecoder(64, framed=True)
+    for i in range(rx_idx):
+        dec.feed(buf[i])
+        while True:
+            frame_tuple = dec.next_frame()
+            if not frame_tuple: break
+            out.append(frame_tuple)
+
+def run(name, scan, buf, rx_idx):
+    frames = []
+    t0 = now_us()
+    for _ in range(ROUNDS):
+        frames = []
+        scan(buf, rx_idx, frames)
+    dt = elapsed_us(t0)
+    fps = len(frames) * ROUNDS * 1000000 // max(dt, 1)
+    print("{:<8} {:>6} frames  {:>10} us  {:>8} frames/s".format(name, len(frames), dt, fps))
+    return frames, fps
+
+def main():
+    buf, rx_idx, expected = build_capture()
+    print("rx_buffer: {} words, {} frames encoded, {} rounds".format(rx_idx, expected, ROUNDS))
+    ref, fps_ref = run("legacy", scan_legacy, buf, rx_idx)
+    new, fps_new = run("word", scan_word, buf, rx_idx)
+    stream, _ = run("stream", scan_stream, buf, rx_idx)
+    if ref != new or ref != stream:
+        print("MISMATCH: decoders disagree")
+        return
+    fbuf, f_idx, f_expected = build_framed_capture()
+    framed, _ = run("framed", scan_framed, fbuf, f_idx)
+    if len(framed) != f_expected or framed != ref[:f_expected]:
+        print("MISMATCH: framed decoder lost frames")
+        return
+    tbuf, t_idx, t_expected = build_framed_capture(TRAILER_TRAPS)
+    trap = []
+    scan_framed(tbuf, t_idx, trap)
+    if trap != [(m, s, c, bytes(d)) for m, s, c, d in (TRAILER_TRAPS * t_expected)[:t_expected]]:
+        print("MISMATCH: framed decoder took a data word for a trailer")
+        return
+    print("speedup: {}.{:02d}x".format(fps_new // max(fps_ref, 1), (fps_new * 100 // max(fps_ref, 1)) % 100))
+
+if __name__ == "__main__":
+    main()
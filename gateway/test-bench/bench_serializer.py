@@ -0,0 +1,167 @@
+"""
+NDJSON serializer benchmark: string-building formatters vs jsonrec.py.
+
+Formats the same mix of CAN frames, subscription responses and AVC-LAN
+frames with the formatters main.py used before (str/format/join and
+concatenation, verbatim copies of v2.43.0) and with the table-driven
+jsonrec functions writing into one preallocated bytearray. Both must
+produce identical bytes.
+
+Reported per variant: lines/s and output bytes/s (best of PASSES timed
+passes, as single passes are noisy on a busy host) and heap bytes
+allocated per line (MicroPython only: gc.mem_alloc() with the collector
+disabled; CPython frees temporaries immediately, so it shows "-" there),
+then the jsonrec/legacy speed ratio.
+
+jsonrec is not faster. Its loops run bytecode per output byte where the
+string builtins run C, so on CPython 3.11 it reaches about 0.4x the
+legacy rate (0.40-0.42x over 15 runs on an x86-64 host; single passes
+scatter from 0.3x to 0.7x). It is kept for the device: it allocates
+nothing per line, while the legacy path creates a str per field. At bus
+rates that garbage fills the heap continuously, and every collection
+stops the whole main loop, CAN RX included, at once; slower formatting
+is spread evenly over the lines. No RP2040 figures are recorded in this
+tree yet; run the script on the board before quoting device numbers.
+
+Run on the host:   python3 test-bench/bench_serializer.py
+Run on the RP2040: copy jsonrec.py to the board, then
+                   mpremote run test-bench/bench_serializer.py
+"""
+
+import gc
+import sys
+
+try:
+    import utime as _time
+    def now_us(): return _time.ticks_us()
+    def elapsed_us(t0): return _time.ticks_diff(_time.ticks_us(), t0)
+except ImportError:
+    import time as _time
+    def now_us(): return int(_time.perf_counter() * 1000000)
+    def elapsed_us(t0): return now_us() - t0
+
+try:
+    import jsonrec
+except ImportError:
+    import os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import jsonrec
+
+ROUNDS = 200
+PASSES = 5
+
+# ============================================================================
+# LEGACY FORMATTERS (main.py v2.43.0, seq passed in, returning the line)
+# ============================================================================
+
+def legacy_can(ts, seq, can_id, data):
+    d_str = ','.join(str(b) for b in data)
+    seq_str = ',"seq":' + str(seq) if seq >= 0 else ''
+    return '{"id":1,"ts":' + str(ts) + seq_str + ',"d":{"i":"0x' + '{:X}'.format(can_id) + '","d":[' + d_str + ']}}\n'
+
+def legacy_sub(ts, seq, slot, resp_id, resp_data):
+    d_str = ','.join(str(b) for b in resp_data)
+    seq_str = ',"seq":' + str(seq) if seq >= 0 else ''
+    return '{"id":1,"ts":' + str(ts) + seq_str + ',"d":{"a":"sub","slot":' + str(slot) + ',"i":"0x' + '{:X}'.format(resp_id) + '","d":[' + d_str + ']}}\n'
+
+def legacy_avc(ts, seq, m, s, c, data_bytes, rs_skip=0, rs_try=1, cnt=0):
+    d_str = ','.join('"' + '{:02X}'.format(b) + '"' for b in data_bytes)
+    seq_str = ',"seq":' + str(seq) if seq >= 0 else ''
+    rs_str = ',"rs":[' + str(rs_skip) + ',' + str(rs_try) + ']' if (rs_skip or rs_try > 1) else ''
+    cnt_str = ',"cnt":' + str(cnt) if cnt else ''
+    return '{"id":2,"ts":' + str(ts) + seq_str + ',"d":{"m":"' + '{:03X}'.format(m) + '","s":"' + '{:03X}'.format(s) + '","c":' + str(c) + ',"d":[' + d_str + ']' + cnt_str + rs_str + '}}\n'
+
+# ============================================================================
+# TEST DATA
+# ============================================================================
+
+# (kind, args): Prius body/powertrain CAN traffic plus typical AVC-LAN frames
+FRAMES = [
+    ("can", (0x2C4, (0, 0, 12, 55, 0, 0, 0, 146))),
+    ("can", (0x3CA, (0, 0, 0, 0, 0))),
+    ("can", (0x0B4, (0, 0, 0, 0, 0, 0, 0, 188))),
+    ("can", (0x244, (0, 0, 0, 0, 0, 0))),
+    ("sub", (0, 0x7E8, (4, 65, 12, 11, 184))),
+    ("avc", (0x190, 0x110, 15, b"\x00\x01")),
+    ("avc", (0x110, 0x490, 15, b"\x00\x11\x01\x63\x06\x00\x00\x00\x80\x00\x00\x00")),
+]
+
+def run_legacy(out):
+    ts = 123456
+    seq = 0
+    n = 0
+    for kind, args in FRAMES:
+        if kind == "can":
+            line = legacy_can(ts, seq, args[0], args[1])
+        elif kind == "sub":
+            line = legacy_sub(ts, seq, args[0], args[1], args[2])
+        else:
+            line = legacy_avc(ts, seq, args[0], args[1], args[2], args[3])
+        n += len(line)
+        if out is not None: out.append(line.encode())
+        seq += 1
+        ts += 3
+    return n
+
+buf = bytearray(jsonrec.AVC_LINE_MAX)
+
+def run_table(out):
+    ts = 123456
+    seq = 0
+    n = 0
+    for kind, args in FRAMES:
+        if kind == "can":
+            k = jsonrec.can_line(buf, 0, 0, ts, 3, seq, args[0], args[1])
+        elif kind == "sub":
+            k = jsonrec.sub_line(buf, 0, 0, ts, 3, seq, args[0], args[1], args[2])
+        else:
+            k = jsonrec.avc_line(buf, 0, 0, ts, 3, seq, args[0], args[1], args[2], args[3])
+        n += k
+        if out is not None: out.append(bytes(buf[:k]))
+        seq += 1
+        ts += 3
+    return n
+
+def mem_alloc():
+    try:
+        return gc.mem_alloc()
+    except AttributeError:
+        return None
+
+def run(name, fn):
+    lines = len(FRAMES) * ROUNDS
+    dt = 0
+    for _ in range(PASSES):
+        gc.collect()
+        gc.disable()
+        a0 = mem_alloc()
+        t0 = now_us()
+        total = 0
+        for _ in range(ROUNDS):
+            total += fn(None)
+        t = max(elapsed_us(t0), 1)
+        a1 = mem_alloc()
+        gc.enable()
+        if not dt or t < dt: dt = t
+    alloc = "-" if a0 is None else str((a1 - a0) // lines)
+    lps = lines * 1000000 // dt
+    print("{:<8} {:>8} lines/s  {:>9} bytes/s  {:>6} B alloc/line".format(
+        name, lps, total * 1000000 // dt, alloc))
+    return lps
+
+def main():
+    ref = []
+    new = []
+    run_legacy(ref)
+    run_table(new)
+    if ref != new:
+        print("MISMATCH: serializers disagree")
+        return
+    print("{} lines x {} rounds, {} bytes per round".format(len(FRAMES), ROUNDS, sum(len(x) for x in ref)))
+    lps_ref = run("legacy", run_legacy)
+    lps_new = run("jsonrec", run_table)
+    r = lps_new * 100 // max(lps_ref, 1)
+    print("jsonrec/legacy: {}.{:02d}x".format(r // 100, r % 100))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Wrap-Safe Microsecond Clock
+===========================
+
+utime.ticks_us() wraps every 2^30 µs (about 17.9 minutes) on the RP2040.
+Clock extends it to a monotonic time since boot that does not wrap, kept
+as (seconds, microseconds) so every value stays a small int: a single
+µs counter would leave the small int range after 18 minutes and allocate
+a long int for every timestamp.
+
+Frames are stamped with a raw ticks_us() taken when they are read;
+stamp(t) converts it afterwards:
+
+    t = utime.ticks_us()
+    ...
+    clk.stamp(t)            # sets clk.sec, clk.us, clk.frac, clk.digits
+    jsonrec.can_line(buf, o, clk.sec, clk.frac, clk.digits, ...)
+
+`frac`/`digits` are the sub-second part in the output unit (ms, 3 digits,
+or µs, 6 digits), so a serializer writes the time as sec followed by frac
+zero-padded to `digits`, without any arithmetic on the full value.
+
+Lines built as strings (command replies, status lines) use ts_str(),
+which follows the same units, so every "ts" of a channel is comparable.
+
+stamp() relies on utime.ticks_diff(), which covers ±2^29 µs (about 9
+minutes), so it must see a time at least that often (once per main loop
+is plenty), and t must be within that range of the last one.
+"""
+
+import utime
+
+US_PER_S = 1000000
+
+class Clock:
+
+    def __init__(self, units_us=False):
+        t = utime.ticks_us()
+        self._last = t
+        # ticks_us() counts from boot and has not wrapped yet at import
+        self._sec = t // US_PER_S
+        self._us = t % US_PER_S
+        self.set_units(units_us)
+        self.stamp(t)
+
+    def set_units(self, units_us):
+        """Output unit for frac/digits: µs (True) or ms (False)."""
+        self.units_us = units_us
+        self.digits = 6 if units_us else 3
+
+    def stamp(self, t):
+        """Convert a ticks_us() value into sec/us (and frac) since boot."""
+        d = utime.ticks_diff(t, self._last)
+        if d >= 0:
+            # Newest time seen so far: advance the base
+            us = self._us + d
+            if us >= US_PER_S:
+                q = us // US_PER_S
+                self._sec += q
+                us -= q * US_PER_S
+            self._us = us
+            self._last = t
+            sec = self._sec
+        else:
+            # Taken before the last stamp (frames stamped after a later call)
+            us = self._us + d
+            sec = self._sec
+            if us < 0:
+                q = (US_PER_S - 1 - us) // US_PER_S
+                sec -= q
+                us += q * US_PER_S
+        self.sec = sec
+        self.us = us
+        self.frac = us if self.units_us else us // 1000
+        return self
+
+    def now(self):
+        return self.stamp(utime.ticks_us())
+
+    def ts_str(self):
+        """Last stamp as the "ts" text of a line (ms or µs, allocates)."""
+        return self.fmt(self.sec, self.us)
+
+    def fmt(self, sec, us):
+        """Any (sec, us) time since boot as "ts" text in the output unit."""
+        frac = us if self.units_us else us // 1000
+        if sec:
+            return str(sec) + ('{:06d}' if self.units_us else '{:03d}').format(frac)
+        return str(frac)
+
+    def ts_int(self):
+        """Last stamp as a "ts" number (may be a long int)."""
+        return self.sec * (US_PER_S if self.units_us else 1000) + self.frac
+
+    def us_str(self):
+        """Last stamp as a decimal µs string (command replies, allocates)."""
+        if self.sec:
+            return str(self.sec) + '{:06d}'.format(self.us)
+        return str(self.us)
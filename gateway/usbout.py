@@ -0,0 +1,230 @@
+"""
+USB Output Ring
+===============
+
+Everything the main loop sends to the host goes into one bounded ring
+buffer; nothing in the loop writes to USB directly. If the host stops
+reading for a moment, sys.stdout.write would block and stall CAN and
+AVC-LAN reception. The ring only writes when the CDC endpoint reports
+room (POLLOUT), one USB packet per write and at most `budget` bytes per
+poll(), so a stalled host costs dropped records instead of lost frames.
+
+Records are kept whole and contiguous (the ring wraps between records,
+never inside one), so frame serializers (jsonrec.py, binrec.py) still
+write straight into `buf`:
+
+    o = out.reserve(jsonrec.CAN_LINE_MAX, ch)
+    if o >= 0:
+        out.commit(jsonrec.can_line(out.buf, o, ...), ch)
+    ...
+    out.put(line, ch)   # a ready-made str/bytes line
+    ...
+    out.poll()          # once per main loop iteration
+
+Coalescing: a burst is written out once `threshold` bytes are queued or
+the oldest record has waited `deadline_us`, whichever comes first.
+threshold = 0 writes on the next poll().
+
+Drop policy when a record does not fit, per channel `ch` (0 = gateway,
+1 = CAN, 2 = AVC-LAN, 3 = RS485):
+    DROP_OLDEST  the oldest queued records are discarded to make room
+    DROP_LOW     a record is refused once the ring holds more than its
+                 channel's share (limits[ch] bytes), so low-priority
+                 channels give way first; if the ring is still full the
+                 oldest records are discarded as with DROP_OLDEST
+A record already partly written is never discarded, and a record larger
+than the ring (or, with DROP_LOW, than its channel's share) is refused
+without evicting anything. Drops are counted per channel in `drops`.
+"""
+
+import array
+import uselect
+import utime
+
+DROP_OLDEST = 0
+DROP_LOW = 1
+
+CHANNELS = 4
+
+class OutputRing:
+
+    def __init__(self, stream, size=8192, threshold=512, deadline_us=2000,
+                 records=512, chunk=64, budget=1024, policy=DROP_LOW, limits=(100, 75, 50, 75)):
+        self.stream = stream
+        self.size = size
+        self.buf = bytearray(size)
+        self.threshold = threshold
+        self.deadline_us = deadline_us
+        self.chunk = chunk          # Bytes per write (one full-speed bulk packet)
+        self.budget = budget        # Max bytes written per poll()
+        self.policy = policy
+        self.limits = array.array('H', [size * p // 100 for p in limits])
+
+        self._poll = uselect.poll()
+        self._poll.register(stream, uselect.POLLOUT)
+
+        # Byte ring: data is [tail, head), or [tail, wrap) + [0, head) once wrapped
+        self.head = 0
+        self.tail = 0
+        self.wrap = 0               # End of the upper segment, 0 = not wrapped
+        self.used = 0
+
+        # Record index ring: start offset, length and channel of each queued record
+        self.cap = records
+        self.rpos = array.array('H', [0] * records)
+        self.rlen = array.array('H', [0] * records)
+        self.rch = bytearray(records)
+        self.rhead = 0              # Oldest record
+        self.rn = 0
+        self.rsent = 0              # Bytes of the oldest record already written
+
+        self.draining = False
+        self._first_us = 0          # ticks_us when the oldest queued record was committed
+
+        # Statistics (cumulative)
+        self.records = 0
+        self.flushes = 0            # Total write calls
+        self.flush_size = 0         # Bursts triggered by the byte threshold
+        self.flush_time = 0         # ... by the deadline
+        self.bytes = 0
+        self.drops = array.array('I', [0] * CHANNELS)
+        self.drop_bytes = 0
+        self.stalls = 0             # Polls that found the endpoint full
+        self.hwm = 0                # Most bytes queued at once
+
+    def _reset(self):
+        self.head = self.tail = self.wrap = self.used = 0
+        self.rsent = 0
+
+    def _evict(self):
+        """Discard the oldest record (never one partly written)."""
+        i = self.rhead
+        self.drops[self.rch[i]] += 1
+        self.drop_bytes += self.rlen[i]
+        self.used -= self.rlen[i]
+        self.rhead = (i + 1) % self.cap
+        self.rn -= 1
+        self._advance()
+
+    def _advance(self):
+        """Move tail to the oldest record after the index ring changed."""
+        if self.rn == 0:
+            self._reset()
+            return
+        t = self.rpos[self.rhead] + self.rsent
+        if self.wrap and t < self.tail:
+            self.wrap = 0           # Upper segment used up
+        self.tail = t
+
+    def reserve(self, need, ch=0):
+        """
+        Offset to serialize the next record at, with `need` contiguous bytes
+        free, or -1 if the record is dropped (counted in drops[ch]).
+        """
+        if need > self.size or (self.policy == DROP_LOW and (self.used > self.limits[ch] or need > self.limits[ch])):
+            # Cannot fit (or never fits the channel's share): refuse before evicting anything
+            self.drops[ch] += 1
+            return -1
+        while True:
+            if self.rn == 0:
+                self._reset()
+                if need <= self.size:
+                    return 0
+                break
+            if self.rn < self.cap:
+                if self.wrap:
+                    if need <= self.tail - self.head:
+                        return self.head
+                elif need <= self.size - self.head:
+                    return self.head
+                elif need <= self.tail:
+                    self.wrap = self.head
+                    self.head = 0
+                    return 0
+            if self.rsent:
+                break               # Oldest record is in flight
+            self._evict()
+        self.drops[ch] += 1
+        return -1
+
+    def commit(self, end, ch=0):
+        """Queue the record serialized from the last reserve() up to `end`."""
+        o = self.head
+        n = end - o
+        i = (self.rhead + self.rn) % self.cap
+        self.rpos[i] = o
+        self.rlen[i] = n
+        self.rch[i] = ch
+        if self.rn == 0:
+            self._first_us = utime.ticks_us()
+        self.rn += 1
+        self.head = end
+        self.used += n
+        if self.used > self.hwm:
+            self.hwm = self.used
+        self.records += 1
+        if not self.draining and self.used >= self.threshold:
+            self.draining = True
+            self.flush_size += 1
+
+    def put(self, data, ch=0, urgent=False):
+        """Queue a ready-made line (str or bytes); urgent starts a burst now."""
+        if isinstance(data, str):
+            data = data.encode()
+        n = len(data)
+        o = self.reserve(n, ch)
+        if o < 0:
+            return
+        self.buf[o:o + n] = data
+        self.commit(o + n, ch)
+        if urgent and not self.draining:
+            self.draining = True
+            self.flush_size += 1
+
+    def _writable(self):
+        for _ in self._poll.ipoll(0):
+            return True
+        return False
+
+    def poll(self):
+        """Write queued records if a burst is due, without blocking."""
+        if self.rn == 0:
+            return
+        if not self.draining:
+            if utime.ticks_diff(utime.ticks_us(), self._first_us) < self.deadline_us:
+                return
+            self.draining = True
+            self.flush_time += 1
+        left = self.budget
+        while self.rn and left > 0:
+            if not self._writable():
+                self.stalls += 1
+                break
+            t = self.tail
+            n = (self.wrap if self.wrap else self.head) - t
+            if n > self.chunk: n = self.chunk
+            if n > left: n = left
+            w = self.stream.write(self.buf, t, n)
+            if not w:
+                self.stalls += 1
+                break
+            self.flushes += 1
+            self.bytes += w
+            self.used -= w
+            left -= w
+            # Retire the records this write completed
+            while w:
+                rest = self.rlen[self.rhead] - self.rsent
+                if w < rest:
+                    self.rsent += w
+                    break
+                w -= rest
+                self.rsent = 0
+                self.rhead = (self.rhead + 1) % self.cap
+                self.rn -= 1
+            self._advance()
+        if self.rn == 0:
+            self.draining = False
+
+    def avg_batch(self):
+        return self.bytes // self.flushes if self.flushes else 0